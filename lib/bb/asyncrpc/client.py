@@ -6,12 +6,15 @@
 
 import abc
 import asyncio
+import atexit
 import json
 import os
 import socket
 import sys
 import re
 import contextlib
+import threading
+import time
 from threading import Thread
 from .connection import StreamConnection, WebsocketConnection, DEFAULT_MAX_CHUNK
 from .exceptions import ConnectionClosedError, InvokeError
@@ -24,6 +27,12 @@ ADDR_TYPE_UNIX = 0
 ADDR_TYPE_TCP = 1
 ADDR_TYPE_WS = 2
 
+# Maximum number of idle connections kept for each key of a ClientPool, and
+# how long (in seconds) a connection may be idle before it is pinged to check
+# it is still alive before being reused
+DEFAULT_POOL_MAX_IDLE = 4
+DEFAULT_POOL_HEALTH_CHECK_INTERVAL = 30
+
 WEBSOCKETS_MIN_VERSION = (9, 1)
 # Need websockets 10 with python 3.10+
 if sys.version_info >= (3, 10, 0):
@@ -47,6 +56,11 @@ def parse_address(addr):
 
 
 class AsyncClient(object):
+    # Request binary framing on stream (TCP and unix domain socket)
+    # connections. This costs a round trip to receive the server headers
+    # when the connection is set up, if they weren't needed anyway
+    binary_framing = True
+
     def __init__(
         self,
         proto_name,
@@ -65,6 +79,7 @@ class AsyncClient(object):
         self.needs_server_headers = server_headers
         self.server_headers = {}
         self.headers = headers
+        self.next_request_id = 1
 
     async def connect_tcp(self, address, port):
         async def connect_sock():
@@ -127,11 +142,18 @@ class AsyncClient(object):
         self._connect_sock = connect_sock
 
     async def setup_connection(self):
+        binary_framing = (
+            self.binary_framing and self.socket.supports_binary_framing
+        )
+        needs_server_headers = self.needs_server_headers or binary_framing
+
         # Send headers
         await self.socket.send("%s %s" % (self.proto_name, self.proto_version))
         await self.socket.send(
-            "needs-headers: %s" % ("true" if self.needs_server_headers else "false")
+            "needs-headers: %s" % ("true" if needs_server_headers else "false")
         )
+        if binary_framing:
+            await self.socket.send("framing: binary")
         for k, v in self.headers.items():
             await self.socket.send("%s: %s" % (k, v))
 
@@ -139,7 +161,7 @@ class AsyncClient(object):
         await self.socket.send("")
 
         self.server_headers = {}
-        if self.needs_server_headers:
+        if needs_server_headers:
             while True:
                 line = await self.socket.recv()
                 if not line:
@@ -148,6 +170,11 @@ class AsyncClient(object):
                 tag, value = line.split(":", 1)
                 self.server_headers[tag.lower()] = value.strip()
 
+        # Older servers don't know about binary framing, and won't have
+        # acknowledged it
+        if binary_framing and self.server_headers.get("framing") == "binary":
+            self.socket.enable_binary_framing()
+
     async def get_header(self, tag, default):
         await self.connect()
         return self.server_headers.get(tag, default)
@@ -190,15 +217,88 @@ class AsyncClient(object):
         if isinstance(msg, dict) and "invoke-error" in msg:
             raise InvokeError(msg["invoke-error"]["message"])
 
+    async def _send_request(self, msg):
+        # Request IDs are sent as 32 bit values and 0 isn't used
+        request_id = self.next_request_id
+        self.next_request_id = request_id % 0xFFFFFFFF + 1
+        await self.socket.send_message(msg, request_id)
+        return request_id
+
+    async def _recv_response(self, request_id):
+        result = await self.socket.recv_message()
+        # The request ID is only known if binary framing is in use
+        if self.socket.request_id is not None and self.socket.request_id != request_id:
+            raise ConnectionError(
+                "Response for request %d received while expecting %d"
+                % (self.socket.request_id, request_id)
+            )
+        return result
+
     async def invoke(self, msg):
         async def proc():
-            await self.socket.send_message(msg)
-            return await self.socket.recv_message()
+            request_id = await self._send_request(msg)
+            return await self._recv_response(request_id)
 
         result = await self._send_wrapper(proc)
         self.check_invoke_error(result)
         return result
 
+    async def invoke_pipelined(self, msgs):
+        """
+        Invokes all of msgs without waiting for the response to each one
+        before sending the next, which hides the latency to the server.
+        Returns the responses in the same order.
+
+        The server handles the messages in order, so this must only be used
+        for messages whose handling does not depend on the response to an
+        earlier one. If the server reports an error for any of the messages,
+        it is raised once all the messages have been sent.
+        """
+        msgs = list(msgs)
+
+        async def proc():
+            request_ids = asyncio.Queue()
+
+            async def send():
+                for m in msgs:
+                    request_ids.put_nowait(await self._send_request(m))
+
+            async def recv():
+                results = []
+                for _ in msgs:
+                    request_id = await request_ids.get()
+                    results.append(await self._recv_response(request_id))
+                    # The server closes the connection after an error
+                    if isinstance(results[-1], dict) and "invoke-error" in results[-1]:
+                        break
+                return results
+
+            send_task = asyncio.ensure_future(send())
+            recv_task = asyncio.ensure_future(recv())
+            try:
+                while not recv_task.done():
+                    await asyncio.wait(
+                        [t for t in (send_task, recv_task) if not t.done()],
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    # If sending failed, the responses will never arrive
+                    if send_task.done() and send_task.exception() is not None:
+                        raise send_task.exception()
+                return recv_task.result()
+            finally:
+                for t in (send_task, recv_task):
+                    if t.done():
+                        if not t.cancelled():
+                            # Mark any exception as retrieved
+                            t.exception()
+                    else:
+                        t.cancel()
+
+        results = await self._send_wrapper(proc)
+        for r in results:
+            self.check_invoke_error(r)
+        return results
+
     async def ping(self):
         return await self.invoke({"ping": {}})
 
@@ -224,7 +324,7 @@ class Client(object):
         # required (but harmless) with it.
         asyncio.set_event_loop(self.loop)
 
-        self._add_methods("connect_tcp", "ping")
+        self._add_methods("connect_tcp", "ping", "invoke_pipelined")
 
     @abc.abstractmethod
     def _get_async_client(self):
@@ -245,6 +345,12 @@ class Client(object):
         self.loop.run_until_complete(self.client.connect_unix(path))
         self.loop.run_until_complete(self.client.connect())
 
+    def connect(self):
+        """
+        Connect now rather than on the first request, if not already connected
+        """
+        self.loop.run_until_complete(self.client.connect())
+
     @property
     def max_chunk(self):
         return self.client.max_chunk
@@ -269,3 +375,98 @@ class Client(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
         return False
+
+
+class ClientPool(object):
+    """
+    A pool of idle (sync) clients, keyed by anything that identifies how the
+    client was connected (e.g. the server address and credentials), so that
+    the cost of setting up connections (and authenticating them) is only paid
+    once per process.
+
+    Clients are borrowed with client(); they must be handed back in the same
+    state they were created in (e.g. not after become_user()). Connections
+    cannot be shared between processes, so a forked child starts with an
+    empty pool, and leaves the connections of its parent alone.
+    """
+
+    def __init__(
+        self,
+        max_idle=DEFAULT_POOL_MAX_IDLE,
+        health_check_interval=DEFAULT_POOL_HEALTH_CHECK_INTERVAL,
+    ):
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+        atexit.register(self.close)
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+
+    def acquire(self, key, create):
+        """
+        Returns an idle client for key, or a new one made by calling create()
+        """
+        while True:
+            with self.lock:
+                self._check_pid()
+                clients = self.idle.get(key)
+                if not clients:
+                    break
+                client, last_used = clients.pop()
+
+            if time.monotonic() - last_used < self.health_check_interval:
+                return client
+
+            try:
+                client.ping()
+                return client
+            except Exception:
+                client.close()
+
+        return create()
+
+    def release(self, key, client):
+        with self.lock:
+            self._check_pid()
+            clients = self.idle.setdefault(key, [])
+            if len(clients) < self.max_idle:
+                clients.append((client, time.monotonic()))
+                return
+
+        client.close()
+
+    @contextlib.contextmanager
+    def client(self, key, create):
+        client = self.acquire(key, create)
+        try:
+            yield client
+        except BaseException:
+            # The connection could have been left in any state
+            client.close()
+            raise
+        self.release(key, client)
+
+    def close(self, key=None):
+        """
+        Closes the idle clients for key, or all of them if key is None
+        """
+        with self.lock:
+            self._check_pid()
+            if key is None:
+                idle = self.idle
+                self.idle = {}
+            else:
+                idle = {key: self.idle.pop(key, [])}
+
+        for clients in idle.values():
+            for client, _ in clients:
+                client.close()
+
+
+# The pool shared by all clients of the process
+client_pool = ClientPool()
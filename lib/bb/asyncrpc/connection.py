@@ -7,6 +7,7 @@
 import asyncio
 import itertools
 import json
+import struct
 from datetime import datetime
 from .exceptions import ClientError, ConnectionClosedError
 
@@ -18,6 +19,16 @@ from .exceptions import ClientError, ConnectionClosedError
 # is necessary
 DEFAULT_MAX_CHUNK = 32 * 1024
 
+# Stream connections can negotiate binary framing with the "framing: binary"
+# header. Each frame is then a header of (frame type, request ID, payload
+# length) followed by the UTF-8 payload, which is either a JSON encoded
+# message, or a raw line when in a stream mode. Responses carry the ID of the
+# request they answer, so that clients can have many requests in flight.
+FRAME_MESSAGE = 1
+FRAME_LINE = 2
+FRAME_HEADER = struct.Struct(">BII")
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
 
 def chunkify(msg, max_chunk):
     if len(msg) < max_chunk - 1:
@@ -38,22 +49,40 @@ def json_serialize(obj):
 
 
 class StreamConnection(object):
+    supports_binary_framing = True
+
     def __init__(self, reader, writer, timeout, max_chunk=DEFAULT_MAX_CHUNK):
         self.reader = reader
         self.writer = writer
         self.timeout = timeout
         self.max_chunk = max_chunk
+        self.binary_framing = False
+        self.request_id = None
 
     @property
     def address(self):
         return self.writer.get_extra_info("peername")
 
-    async def send_message(self, msg):
-        for c in chunkify(json.dumps(msg, default=json_serialize), self.max_chunk):
-            self.writer.write(c.encode("utf-8"))
+    def enable_binary_framing(self):
+        self.binary_framing = True
+        self.request_id = 0
+
+    async def send_message(self, msg, request_id=None):
+        data = json.dumps(msg, default=json_serialize)
+        if self.binary_framing:
+            # By default, reply to the last request received
+            if request_id is None:
+                request_id = self.request_id
+            self._write_frame(FRAME_MESSAGE, request_id, data)
+        else:
+            for c in chunkify(data, self.max_chunk):
+                self.writer.write(c.encode("utf-8"))
         await self.writer.drain()
 
     async def recv_message(self):
+        if self.binary_framing:
+            return json.loads(await self._recv_frame(FRAME_MESSAGE))
+
         l = await self.recv()
 
         m = json.loads(l)
@@ -73,10 +102,16 @@ class StreamConnection(object):
         return m
 
     async def send(self, msg):
-        self.writer.write(("%s\n" % msg).encode("utf-8"))
+        if self.binary_framing:
+            self._write_frame(FRAME_LINE, 0, msg)
+        else:
+            self.writer.write(("%s\n" % msg).encode("utf-8"))
         await self.writer.drain()
 
     async def recv(self):
+        if self.binary_framing:
+            return await self._recv_frame(FRAME_LINE)
+
         if self.timeout < 0:
             line = await self.reader.readline()
         else:
@@ -95,6 +130,41 @@ class StreamConnection(object):
 
         return line.rstrip()
 
+    def _write_frame(self, frame_type, request_id, data):
+        data = data.encode("utf-8")
+        self.writer.write(FRAME_HEADER.pack(frame_type, request_id, len(data)) + data)
+
+    async def _read_frame(self):
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            frame_type, request_id, length = FRAME_HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                raise ConnectionError("Frame of %d bytes is too large" % length)
+            data = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionClosedError("Connection closed")
+
+        return frame_type, request_id, data
+
+    async def _recv_frame(self, expected_type):
+        if self.timeout < 0:
+            frame_type, request_id, data = await self._read_frame()
+        else:
+            try:
+                frame_type, request_id, data = await asyncio.wait_for(
+                    self._read_frame(), self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise ConnectionError("Timed out waiting for data")
+
+        if frame_type != expected_type:
+            raise ConnectionError("Unexpected frame type %d" % frame_type)
+
+        if frame_type == FRAME_MESSAGE:
+            self.request_id = request_id
+
+        return data.decode("utf-8")
+
     async def close(self):
         self.reader = None
         if self.writer is not None:
@@ -103,15 +173,19 @@ class StreamConnection(object):
 
 
 class WebsocketConnection(object):
+    # Websockets already have their own message framing
+    supports_binary_framing = False
+
     def __init__(self, socket, timeout):
         self.socket = socket
         self.timeout = timeout
+        self.request_id = None
 
     @property
     def address(self):
         return ":".join(str(s) for s in self.socket.remote_address)
 
-    async def send_message(self, msg):
+    async def send_message(self, msg, request_id=None):
         await self.send(json.dumps(msg, default=json_serialize))
 
     async def recv_message(self):
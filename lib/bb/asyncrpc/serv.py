@@ -12,6 +12,7 @@ import signal
 import socket
 import sys
 from bb import multiprocessing
+from multiprocessing.connection import wait as wait_sentinels
 import logging
 from .connection import StreamConnection, WebsocketConnection
 from .exceptions import ClientError, ServerError, ConnectionClosedError, InvokeError
@@ -78,11 +79,25 @@ class AsyncServerConnection(object):
                 tag, value = header.split(":", 1)
                 self.client_headers[tag.lower()] = value.strip()
 
+            # Binary framing can only be acknowledged if the client asked for
+            # the server headers
+            binary_framing = (
+                self.client_headers.get("framing") == "binary"
+                and self.client_headers.get("needs-headers", "false") == "true"
+                and self.socket.supports_binary_framing
+            )
+
             if self.client_headers.get("needs-headers", "false") == "true":
-                for k, v in (await self.handle_headers(self.client_headers)).items():
+                headers = await self.handle_headers(self.client_headers)
+                if binary_framing:
+                    headers["framing"] = "binary"
+                for k, v in headers.items():
                     await self.socket.send("%s: %s" % (k, v))
                 await self.socket.send("")
 
+            if binary_framing:
+                self.socket.enable_binary_framing()
+
             # Handle messages
             while True:
                 d = await self.socket.recv_message()
@@ -272,6 +287,7 @@ class AsyncServer(object):
         self.logger = logger
         self.loop = None
         self.run_tasks = []
+        self.worker_index = None
 
     def start_tcp_server(self, host, port, *, reuseport=False):
         self.server = TCPStreamServer(
@@ -349,6 +365,103 @@ class AsyncServer(object):
         self._serve_forever(tasks)
         self.loop.close()
 
+    def serve_forever_workers(self, num_workers, queue=None):
+        """
+        Serve requests from num_workers forked processes. Each worker binds
+        its own listening socket, so the server must have been started with
+        reuseport=True on a TCP or websocket address for the kernel to
+        balance the incoming connections between them.
+
+        The workers are started one at a time so that any one time setup
+        they do (e.g. creating a database) cannot race. If the port is 0,
+        the remaining workers bind the port the first one was given. If any
+        worker exits, the remaining ones are stopped.
+
+        If queue is given, the address is put on it once all the workers are
+        listening, or None if they failed to start.
+        """
+
+        def run(index, queue):
+            self.worker_index = index
+            self._create_loop()
+            try:
+                self.address = None
+                tasks = self.start()
+            finally:
+                queue.put(self.address)
+                queue.close()
+
+            self._serve_forever(tasks)
+
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+        def terminate(signum, frame):
+            sys.exit(0)
+
+        processes = []
+        oldhandler = signal.signal(signal.SIGTERM, terminate)
+        try:
+            for index in range(num_workers):
+                worker_queue = multiprocessing.Queue()
+
+                # Block SIGTERM until the worker has installed its handler (see
+                # serve_as_process())
+                mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM])
+                try:
+                    p = multiprocessing.Process(target=run, args=(index, worker_queue))
+                    p.start()
+                    processes.append(p)
+
+                    address = worker_queue.get()
+                    worker_queue.close()
+                    worker_queue.join_thread()
+                finally:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+                if address is None:
+                    raise ServerError("Server worker %d failed to start" % index)
+
+                if index == 0:
+                    self.server.port = int(address.rsplit(":", 1)[1])
+
+                self.address = address
+                self.logger.debug("Worker %d (pid %d) listening on %s", index, p.pid, address)
+
+            if queue is not None:
+                queue.put(self.address)
+                queue.close()
+                queue = None
+
+            wait_sentinels([p.sentinel for p in processes])
+            self.logger.debug("Server worker exited, shutting down")
+        finally:
+            if queue is not None:
+                queue.put(None)
+                queue.close()
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+            for p in processes:
+                p.join()
+            signal.signal(signal.SIGTERM, oldhandler)
+
+    def serve_workers_as_process(self, num_workers):
+        """
+        Serve requests from num_workers forked processes (see
+        serve_forever_workers()) managed by a child process
+        """
+        queue = multiprocessing.Queue()
+
+        self.process = multiprocessing.Process(target=self.serve_forever_workers, args=(num_workers, queue))
+        self.process.start()
+
+        self.address = queue.get()
+        queue.close()
+        queue.join_thread()
+
+        return self.process
+
     def _create_loop(self):
         # Create loop and override any loop that may have existed in
         # a parent process.  It is possible that the usecases of
@@ -17,10 +17,14 @@
 #
 
 import os
+import glob
 import logging
 import pickle
+import struct
+import zlib
 from collections import defaultdict
-from collections.abc import Mapping
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager
 import bb.utils
 from bb import PrefixLoggerAdapter
 import re
@@ -28,7 +32,10 @@ import shutil
 
 logger = logging.getLogger("BitBake.Cache")
 
-__cache_version__ = "156"
+__cache_version__ = "158"
+
+# Upper limit on the number of shards each cache file is split into
+MAX_CACHE_SHARDS = 32
 
 def getCacheFile(path, filename, mc, data_hash):
     mcspec = ''
@@ -36,6 +43,26 @@ def getCacheFile(path, filename, mc, data_hash):
         mcspec = ".%s" % mc
     return os.path.join(path, filename + mcspec + "." + data_hash)
 
+def getCacheShards(cachefile, shards):
+    return ["%s.shard%dof%d" % (cachefile, i, shards) for i in range(shards)]
+
+def findCacheShards(cachefile):
+    """
+    Return the complete set of shard files for cachefile from a previous
+    sync (which may have used a different shard count), or an empty list
+    """
+    for first in glob.glob(glob.escape(cachefile) + ".shard0of*"):
+        shards = first[len(cachefile + ".shard0of"):]
+        if not shards.isdigit():
+            continue
+        shardfiles = getCacheShards(cachefile, int(shards))
+        if all(os.path.exists(f) for f in shardfiles):
+            return shardfiles
+    return []
+
+def cacheShard(key, shards):
+    return zlib.crc32(key.encode("utf-8")) % shards
+
 # RecipeInfoCommon defines common data retrieving methods
 # from meta data for caches. CoreRecipeInfo as well as other
 # Extra RecipeInfo needs to inherit this class
@@ -275,6 +302,7 @@ class SiggenRecipeInfo(RecipeInfoCommon):
     store = {}
     save_map = {}
     save_count = 1
+    save_table = None
     restore_map = {}
     restore_count = {}
 
@@ -297,6 +325,10 @@ class SiggenRecipeInfo(RecipeInfoCommon):
                 ret.append((dep, None, None))
             elif fs in cls.save_map:
                 ret.append((dep, None, cls.save_map[fs]))
+            elif cls.save_table is not None:
+                cls.save_map[fs] = len(cls.save_table)
+                cls.save_table.append(fs)
+                ret.append((dep, None, cls.save_map[fs]))
             else:
                 cls.save_map[fs] = cls.save_count
                 ret.append((dep, fs, cls.save_count))
@@ -329,7 +361,10 @@ class SiggenRecipeInfo(RecipeInfoCommon):
         ret = {}
         for key in ["siggen_gendeps", "siggen_taskdeps", "siggen_varvals"]:
             ret[key] = self._save(self.__dict__[key])
-        ret['pid'] = os.getpid()
+        if self.save_table is not None:
+            ret['pid'] = None
+        else:
+            ret['pid'] = os.getpid()
         return ret
 
     def __setstate__(self, state):
@@ -337,6 +372,36 @@ class SiggenRecipeInfo(RecipeInfoCommon):
         for key in ["siggen_gendeps", "siggen_taskdeps", "siggen_varvals"]:
             setattr(self, key, self._restore(state[key], pid))
 
+    # Records in the indexed cache files have to be loadable on their own, so
+    # rather than referencing objects saved in earlier records they refer to
+    # a table shared by all the records of a file (see IndexedCacheFile).
+    # These switch to such a table without disturbing any streamed state in
+    # progress (e.g. parser results arriving over IPC).
+    @classmethod
+    @contextmanager
+    def table_save(cls, table, table_map):
+        saved = (cls.save_map, cls.save_count, cls.save_table)
+        cls.save_map = table_map
+        cls.save_table = table
+        try:
+            yield
+        finally:
+            (cls.save_map, cls.save_count, cls.save_table) = saved
+
+    @classmethod
+    @contextmanager
+    def table_restore(cls, table):
+        saved = cls.restore_map
+        cls.restore_map = {None: table}
+        try:
+            yield
+        finally:
+            cls.restore_map = saved
+
+    @classmethod
+    def intern(cls, fs):
+        return cls.store.setdefault(fs, fs)
+
 
 def virtualfn2realfn(virtualfn):
     """
@@ -378,6 +443,264 @@ def variant2virtual(realfn, variant):
         return "mc:" + elems[1] + ":" + realfn
     return "virtual:" + variant + ":" + realfn
 
+class InvalidCacheFile(Exception):
+    pass
+
+class IndexedCacheFile(object):
+    """
+    A cache file of pickled RecipeInfoCommon records with a trailing index
+    mapping each key to the (offset, length) of its record. Records can be
+    loaded individually on demand and updated entries are appended to the
+    file along with a new index rather than rewriting the whole file.
+
+    Objects the records share (see SiggenRecipeInfo) are stored once per
+    file in a table beside the records, which the records refer to by
+    number. Each write appends the objects it added to the table as a new
+    chunk.
+
+    Layout: magic, pickled (cache version, bitbake version), the records and
+    table chunks, the pickled (index, dead bytes, table chunk locations) and
+    a fixed size trailer holding the offset of the index.
+    """
+    magic = b"BBCACHE\x02"
+    trailer = struct.Struct("<8sQ")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.index = {}
+        self.index_offset = None
+        self.dead = 0
+        self.chunks = []
+        self.table = None
+        self.table_map = None
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self):
+        """
+        Read the header and index of the file, returning the (cache version,
+        bitbake version) it was written with. Raises InvalidCacheFile if the
+        file isn't in the expected format.
+        """
+        self.close()
+        fd = os.open(self.filename, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size < len(self.magic) + self.trailer.size or os.pread(fd, len(self.magic), 0) != self.magic:
+                raise InvalidCacheFile(self.filename)
+            magic, index_offset = self.trailer.unpack(os.pread(fd, self.trailer.size, size - self.trailer.size))
+            if magic != self.magic or index_offset >= size - self.trailer.size:
+                raise InvalidCacheFile(self.filename)
+            # Only the header is read, unpickling stops at its end rather than
+            # needing its length
+            with open(fd, "rb", closefd=False) as f:
+                f.seek(len(self.magic))
+                versions = pickle.load(f)
+            index, dead, chunks = pickle.loads(os.pread(fd, size - self.trailer.size - index_offset, index_offset))
+        except InvalidCacheFile:
+            os.close(fd)
+            raise
+        except Exception as e:
+            os.close(fd)
+            raise InvalidCacheFile("%s: %s" % (self.filename, e))
+
+        self.fd = fd
+        self.index = index
+        self.index_offset = index_offset
+        self.dead = dead
+        self.chunks = chunks
+        return versions
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.index = {}
+        self.index_offset = None
+        self.dead = 0
+        self.chunks = []
+        self.table = None
+        self.table_map = None
+
+    def _load_table(self):
+        if self.table is None:
+            self.table = []
+            for offset, length in self.chunks:
+                self.table.extend(SiggenRecipeInfo.intern(fs) for fs in pickle.loads(os.pread(self.fd, length, offset)))
+        return self.table
+
+    def read(self, key):
+        offset, length = self.index[key]
+        data = os.pread(self.fd, length, offset)
+        with SiggenRecipeInfo.table_restore(self._load_table()):
+            return pickle.loads(data)
+
+    @staticmethod
+    def _pickle_records(entries, table, table_map):
+        records = []
+        with SiggenRecipeInfo.table_save(table, table_map):
+            for key, info in entries.items():
+                records.append((key, pickle.dumps(info, pickle.HIGHEST_PROTOCOL)))
+        return records
+
+    def _write_records(self, f, offset, records, index):
+        for key, data in records:
+            f.write(data)
+            index[key] = (offset, len(data))
+            offset += len(data)
+        return offset
+
+    def _write_chunk(self, f, offset, objects, chunks):
+        if objects:
+            data = pickle.dumps(objects, pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+            chunks.append((offset, len(data)))
+            offset += len(data)
+        return offset
+
+    def _write_index(self, f, offset, index, dead, chunks):
+        f.write(pickle.dumps((index, dead, chunks), pickle.HIGHEST_PROTOCOL))
+        f.write(self.trailer.pack(self.magic, offset))
+
+    def update(self, entries, removed=()):
+        """
+        Store the RecipeInfoCommon objects in entries (a dict of key -> info)
+        and drop the keys in removed. If the file was loaded, new records are
+        appended to it unless too much of the file would be superseded data,
+        in which case it is compacted.
+        """
+        if self.fd is None:
+            self._rewrite(entries, ())
+            return
+
+        index = dict(self.index)
+        dead = self.dead
+        for key in list(entries) + list(removed):
+            if key in index:
+                dead += index.pop(key)[1]
+
+        table = self._load_table()
+        if self.table_map is None:
+            self.table_map = dict((fs, num) for num, fs in enumerate(table))
+        tablesize = len(table)
+        records = self._pickle_records(entries, table, self.table_map)
+
+        live = sum(length for _, length in index.values()) + sum(len(data) for _, data in records)
+        if dead > live:
+            self._rewrite(entries, list(index))
+            return
+
+        chunks = list(self.chunks)
+        with open(self.filename, "r+b") as f:
+            f.truncate(self.index_offset)
+            f.seek(self.index_offset)
+            offset = self._write_records(f, self.index_offset, records, index)
+            offset = self._write_chunk(f, offset, table[tablesize:], chunks)
+            self._write_index(f, offset, index, dead, chunks)
+        self.index = index
+        self.index_offset = offset
+        self.dead = dead
+        self.chunks = chunks
+
+    def _rewrite(self, entries, keep):
+        # The records we're keeping are pickled again too so the new table
+        # only holds objects which are still referenced
+        entries = dict(entries)
+        for key in keep:
+            entries[key] = self.read(key)
+        self.close()
+
+        table = []
+        table_map = {}
+        records = self._pickle_records(entries, table, table_map)
+
+        tmpfile = self.filename + ".tmp"
+        index = {}
+        chunks = []
+        with open(tmpfile, "wb") as f:
+            f.write(self.magic)
+            f.write(pickle.dumps((__cache_version__, bb.__version__), pickle.HIGHEST_PROTOCOL))
+            offset = self._write_records(f, f.tell(), records, index)
+            offset = self._write_chunk(f, offset, table, chunks)
+            self._write_index(f, offset, index, 0, chunks)
+        os.replace(tmpfile, self.filename)
+
+        self.fd = os.open(self.filename, os.O_RDONLY)
+        self.index = index
+        self.index_offset = offset
+        self.chunks = chunks
+        self.table = table
+        self.table_map = table_map
+
+class RecipeInfoMap(MutableMapping):
+    """
+    Mapping of filename -> list of RecipeInfoCommon objects (one per cache
+    class) backed by IndexedCacheFile objects. Entries are only read from
+    disk on first access and changes are tracked so they can be written
+    back incrementally.
+    """
+    def __init__(self):
+        self.cachefiles = []
+        self.loaded = {}
+        self.removed = set()
+        self.dirty = set()
+
+    def __getitem__(self, key):
+        try:
+            return self.loaded[key]
+        except KeyError:
+            pass
+        if key in self.removed:
+            raise KeyError(key)
+        info_array = [c.read(key) for c in self.cachefiles if key in c]
+        if not info_array:
+            raise KeyError(key)
+        self.loaded[key] = info_array
+        return info_array
+
+    def __setitem__(self, key, info_array):
+        if self.loaded.get(key) is info_array:
+            return
+        self.loaded[key] = info_array
+        self.removed.discard(key)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.dirty.discard(key)
+        self.removed.add(key)
+
+    def __contains__(self, key):
+        if key in self.loaded:
+            return True
+        if key in self.removed:
+            return False
+        return any(key in c for c in self.cachefiles)
+
+    def __iter__(self):
+        seen = set(self.loaded)
+        yield from self.loaded
+        for c in self.cachefiles:
+            for key in c.index:
+                if key not in seen and key not in self.removed:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def close(self):
+        for c in self.cachefiles:
+            c.close()
+        self.cachefiles = []
+
 #
 # Cooker calls cacheValid on its recipe list, then either calls loadCached
 # from it's main thread or parse from separate processes to generate an up to
@@ -400,12 +723,16 @@ class Cache(object):
         self.cachedir = self.data.getVar("CACHE")
         self.clean = set()
         self.checked = set()
-        self.depends_cache = {}
+        self.depends_cache = RecipeInfoMap()
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
         self.filelist_regex = re.compile(r'(?:(?<=:True)|(?<=:False))\s+')
 
+        # Split the cache files so that syncing or compacting one only
+        # rewrites a fraction of the recipes
+        self.shards = min(int(self.data.getVar("BB_NUMBER_PARSE_THREADS") or bb.utils.cpu_count()), MAX_CACHE_SHARDS)
+
         if self.cachedir in [None, '']:
             bb.fatal("Please ensure CACHE is set to the cache directory for BitBake to use")
 
@@ -424,13 +751,13 @@ class Cache(object):
         if self.caches_array:
             for cache_class in self.caches_array:
                 cachefile = self.getCacheFile(cache_class.cachefile)
-                cache_exists = os.path.exists(cachefile)
+                cache_exists = bool(findCacheShards(cachefile))
                 self.logger.debug2("Checking if %s exists: %r", cachefile, cache_exists)
                 cache_ok = cache_ok and cache_exists
                 cache_class.init_cacheData(self)
         if cache_ok:
             loaded = self.load_cachefile(progress)
-        elif os.path.isfile(self.cachefile):
+        elif findCacheShards(self.cachefile):
             self.logger.info("Out of date cache found, rebuilding...")
         else:
             self.logger.debug("Cache file %s not found, building..." % self.cachefile)
@@ -444,7 +771,7 @@ class Cache(object):
         if os.path.exists(symlink) or os.path.islink(symlink):
             bb.utils.remove(symlink)
         try:
-            os.symlink(os.path.basename(self.cachefile), symlink)
+            os.symlink(os.path.basename(getCacheShards(self.cachefile, self.shards)[0]), symlink)
         except OSError:
             pass
 
@@ -453,62 +780,44 @@ class Cache(object):
     def cachesize(self):
         cachesize = 0
         for cache_class in self.caches_array:
-            cachefile = self.getCacheFile(cache_class.cachefile)
-            try:
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
-            except FileNotFoundError:
-                pass
+            for cachefile in findCacheShards(self.getCacheFile(cache_class.cachefile)):
+                try:
+                    cachesize += os.stat(cachefile).st_size
+                except FileNotFoundError:
+                    pass
 
         return cachesize
 
     def load_cachefile(self, progress):
         previous_progress = 0
 
+        # Only the headers and indexes are read here, the recipe information
+        # itself is loaded on demand as it is accessed
         for cache_class in self.caches_array:
-            cachefile = self.getCacheFile(cache_class.cachefile)
-            self.logger.debug('Loading cache file: %s' % cachefile)
-            with open(cachefile, "rb") as cachefile:
-                pickled = pickle.Unpickler(cachefile)
-                # Check cache version information
+            for shardfile in findCacheShards(self.getCacheFile(cache_class.cachefile)):
+                cachefile = IndexedCacheFile(shardfile)
+                self.logger.debug('Loading cache file: %s' % cachefile.filename)
                 try:
-                    cache_ver = pickled.load()
-                    bitbake_ver = pickled.load()
-                except Exception:
+                    cache_ver, bitbake_ver = cachefile.load()
+                except (OSError, InvalidCacheFile):
                     self.logger.info('Invalid cache, rebuilding...')
+                    self.depends_cache.close()
                     return 0
 
                 if cache_ver != __cache_version__:
                     self.logger.info('Cache version mismatch, rebuilding...')
+                    cachefile.close()
+                    self.depends_cache.close()
                     return 0
                 elif bitbake_ver != bb.__version__:
                     self.logger.info('Bitbake version mismatch, rebuilding...')
+                    cachefile.close()
+                    self.depends_cache.close()
                     return 0
 
-                # Load the rest of the cache file
-                current_progress = 0
-                while cachefile:
-                    try:
-                        key = pickled.load()
-                        value = pickled.load()
-                    except Exception:
-                        break
-                    if not isinstance(key, str):
-                        bb.warn("%s from extras cache is not a string?" % key)
-                        break
-                    if not isinstance(value, RecipeInfoCommon):
-                        bb.warn("%s from extras cache is not a RecipeInfoCommon class?" % value)
-                        break
-
-                    if key in self.depends_cache:
-                        self.depends_cache[key].append(value)
-                    else:
-                        self.depends_cache[key] = [value]
-                    # only fire events on even percentage boundaries
-                    current_progress = cachefile.tell() + previous_progress
-                    progress(cachefile.tell() + previous_progress)
-
-                previous_progress += current_progress
+                self.depends_cache.cachefiles.append(cachefile)
+                previous_progress += os.fstat(cachefile.fd).st_size
+                progress(previous_progress)
 
         return len(self.depends_cache)
 
@@ -575,41 +884,38 @@ class Cache(object):
             self.logger.debug2("%s is not cached", fn)
             return False
 
+        info = self.depends_cache[fn][0]
+        return self._updateValid(fn, appends, info, self._checkFiles(fn, info))
+
+    def _checkFiles(self, fn, info):
+        """
+        Check the files the cached info for fn depends on, returning None if
+        they're unchanged or the log message arguments saying why not.
+        """
         mtime = bb.parse.cached_mtime_noerror(fn)
 
         # Check file still exists
         if mtime == 0:
-            self.logger.debug2("%s no longer exists", fn)
-            self.remove(fn)
-            return False
+            return ("%s no longer exists", fn)
 
-        info_array = self.depends_cache[fn]
         # Check the file's timestamp
-        if mtime != info_array[0].timestamp:
-            self.logger.debug2("%s changed", fn)
-            self.remove(fn)
-            return False
+        if mtime != info.timestamp:
+            return ("%s changed", fn)
 
         # Check dependencies are still valid
-        depends = info_array[0].file_depends
+        depends = info.file_depends
         if depends:
             for f, old_mtime in depends:
                 fmtime = bb.parse.cached_mtime_noerror(f)
                 # Check if file still exists
                 if old_mtime != 0 and fmtime == 0:
-                    self.logger.debug2("%s's dependency %s was removed",
-                                         fn, f)
-                    self.remove(fn)
-                    return False
+                    return ("%s's dependency %s was removed", fn, f)
 
                 if (fmtime != old_mtime):
-                    self.logger.debug2("%s's dependency %s changed",
-                                         fn, f)
-                    self.remove(fn)
-                    return False
+                    return ("%s's dependency %s changed", fn, f)
 
-        if hasattr(info_array[0], 'file_checksums'):
-            for _, fl in info_array[0].file_checksums.items():
+        if hasattr(info, 'file_checksums'):
+            for _, fl in info.file_checksums.items():
                 fl = fl.strip()
                 if not fl:
                     continue
@@ -620,19 +926,28 @@ class Cache(object):
                         continue
                     f, exist = f.rsplit(":", 1)
                     if (exist == "True" and not os.path.exists(f)) or (exist == "False" and os.path.exists(f)):
-                        self.logger.debug2("%s's file checksum list file %s changed",
-                                             fn, f)
-                        self.remove(fn)
-                        return False
+                        return ("%s's file checksum list file %s changed", fn, f)
+
+        return None
 
-        if tuple(appends) != tuple(info_array[0].appends):
+    def _updateValid(self, fn, appends, info, reason):
+        """
+        Record whether the cache for fn is valid given the result of
+        _checkFiles()
+        """
+        if reason is not None:
+            self.logger.debug2(*reason)
+            self.remove(fn)
+            return False
+
+        if tuple(appends) != tuple(info.appends):
             self.logger.debug2("appends for %s changed", fn)
-            self.logger.debug2("%s to %s" % (str(appends), str(info_array[0].appends)))
+            self.logger.debug2("%s to %s" % (str(appends), str(info.appends)))
             self.remove(fn)
             return False
 
         invalid = False
-        for cls in info_array[0].variants:
+        for cls in info.variants:
             virtualfn = variant2virtual(fn, cls)
             self.clean.add(virtualfn)
             if virtualfn not in self.depends_cache:
@@ -644,7 +959,7 @@ class Cache(object):
 
         # If any one of the variants is not present, mark as invalid for all
         if invalid:
-            for cls in info_array[0].variants:
+            for cls in info.variants:
                 virtualfn = variant2virtual(fn, cls)
                 if virtualfn in self.clean:
                     self.logger.debug2("Removing %s from cache", virtualfn)
@@ -678,21 +993,48 @@ class Cache(object):
             self.logger.debug2("Cache is clean, not saving.")
             return
 
+        cachefiles = dict((c.filename, c) for c in self.depends_cache.cachefiles)
+        written = []
         for cache_class in self.caches_array:
             cache_class_name = cache_class.__name__
             cachefile = self.getCacheFile(cache_class.cachefile)
-            self.logger.debug2("Writing %s", cachefile)
-            with open(cachefile, "wb") as f:
-                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
-                p.dump(__cache_version__)
-                p.dump(bb.__version__)
-
-                for key, info_array in self.depends_cache.items():
-                    for info in info_array:
-                        if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
-                            p.dump(key)
-                            p.dump(info)
+            shardfiles = getCacheShards(cachefile, self.shards)
 
+            if all(f in cachefiles for f in shardfiles):
+                # Only write out what changed since the files were loaded
+                indexed = [cachefiles[f] for f in shardfiles]
+                changed = self.depends_cache.dirty
+            else:
+                # No cache or the shard count changed, write everything
+                indexed = [IndexedCacheFile(f) for f in shardfiles]
+                changed = list(self.depends_cache)
+            written.extend(indexed)
+
+            entries = [{} for _ in shardfiles]
+            removed = [set() for _ in shardfiles]
+            for key in self.depends_cache.removed:
+                removed[cacheShard(key, self.shards)].add(key)
+            for key in changed:
+                shard = cacheShard(key, self.shards)
+                for info in self.depends_cache[key]:
+                    if isinstance(info, RecipeInfoCommon) and info.__class__.__name__ == cache_class_name:
+                        entries[shard][key] = info
+                        break
+                else:
+                    removed[shard].add(key)
+
+            for shard, shardfile in enumerate(shardfiles):
+                if entries[shard] or removed[shard] or indexed[shard].fd is None:
+                    self.logger.debug2("Writing %s", shardfile)
+                    indexed[shard].update(entries[shard], removed[shard])
+
+            for f in glob.glob(glob.escape(cachefile) + ".shard*") + [cachefile]:
+                if f not in shardfiles:
+                    bb.utils.remove(f)
+
+        for c in written:
+            c.close()
+        self.depends_cache.close()
         del self.depends_cache
         SiggenRecipeInfo.reset()
 
@@ -891,6 +1233,13 @@ class MultiProcessCache(object):
                 if h not in dest[j]:
                     dest[j][h] = source[j][h]
 
+    def prune_data(self, data):
+        """
+        Drop stale entries from data before it is saved, returning True if
+        there were any
+        """
+        return False
+
     def save_merge(self):
         if not self.cachefile:
             return
@@ -919,6 +1268,9 @@ class MultiProcessCache(object):
             self.merge_data(extradata, data)
             os.unlink(f)
 
+        if self.prune_data(data):
+            have_data = True
+
         if have_data:
             with open(self.cachefile, "wb") as f:
                 p = pickle.Pickler(f, -1)
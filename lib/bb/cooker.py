@@ -136,6 +136,8 @@ class BBCooker:
 
     def __init__(self, featureSet=None, server=None):
         self.recipecaches = None
+        # The last task dependency graph resolved by the runqueue and its inputs
+        self.taskgraph_cache = None
         self.baseconfig_valid = False
         self.parsecache_valid = False
         self.eventlog = None
@@ -2084,6 +2086,7 @@ class Parser(multiprocessing.Process):
         signal.signal(signal.SIGINT, self.catch_sig)
         bb.utils.set_process_name(multiprocessing.current_process().name)
         multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
+        multiprocessing.util.Finalize(None, bb.parse.BBHandler.statement_cache_save, exitpriority=1)
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
 
         pending = []
@@ -2132,16 +2135,18 @@ class Parser(multiprocessing.Process):
             bb.event.set_class_handlers(self.handlers.copy())
             bb.event.LogHandler.filter = parse_filter
 
-            return True, mc, cache.parse(filename, appends, layername)
+            start = time.monotonic()
+            infos = cache.parse(filename, appends, layername)
+            return True, mc, infos, time.monotonic() - start
         except Exception as exc:
             tb = sys.exc_info()[2]
             exc.recipe = filename
-            return True, None, exc
+            return True, None, exc, None
         # Need to turn BaseExceptions into Exceptions here so we gracefully shutdown
         # and for example a worker thread doesn't just exit on its own in response to
         # a SystemExit event for example.
         except BaseException as exc:
-            return True, None, ParsingFailure(exc, filename)
+            return True, None, ParsingFailure(exc, filename), None
         finally:
             bb.event.LogHandler.filter = origfilter
 
@@ -2181,6 +2186,23 @@ class CookerParser(object):
         self.toparse = len(self.willparse)
         self.progress_chunk = int(max(self.toparse / 100, 1))
 
+        # Parse the recipes which took longest last time first, the parser
+        # processes take the next job whenever they are idle so this stops a
+        # few big recipes from running on their own at the end
+        self.parsetimes_cache = bb.cache.SimpleCache("1")
+        self.parsetimes = self.parsetimes_cache.init_cache(self.cfgdata, "bb_parsetimes.dat", {})
+        self.predicted = {}
+        self.actual = {}
+        keys = [self.parsetime_key(mc, filename) for mc, _, filename, _, _ in self.willparse]
+        known = [self.parsetimes[key] for key in keys if key in self.parsetimes]
+        if known:
+            # Recipes we have no time for yet are assumed to be average
+            default = sum(known) / len(known)
+            for key in keys:
+                self.predicted[key] = self.parsetimes.get(key, default)
+            order = sorted(range(len(keys)), key=lambda i: self.predicted[keys[i]], reverse=True)
+            self.willparse = [self.willparse[i] for i in order]
+
         self.num_processes = min(int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS") or
                                  multiprocessing.cpu_count()), self.toparse)
 
@@ -2189,6 +2211,26 @@ class CookerParser(object):
         self.haveshutdown = False
         self.syncthread = None
 
+    @staticmethod
+    def parsetime_key(mc, filename):
+        return bb.cache.realfn2virtual(filename, "", mc)
+
+    def save_parsetimes(self):
+        if self.actual:
+            keys = set(self.parsetime_key(mc, filename) for mc, _, filename, _, _ in self.fromcache)
+            keys |= set(self.parsetime_key(mc, filename) for mc, _, filename, _, _ in self.willparse)
+            parsetimes = {key: self.parsetimes[key] for key in keys if key in self.parsetimes}
+            parsetimes.update(self.actual)
+            self.parsetimes_cache.save(parsetimes)
+
+        predicted = [key for key in self.actual if key in self.predicted]
+        if predicted:
+            logger.debug("Parse time of %d recipes: %.2fs predicted, %.2fs actual",
+                         len(predicted), sum(self.predicted[key] for key in predicted),
+                         sum(self.actual[key] for key in predicted))
+            for key in sorted(predicted, key=lambda key: self.actual[key], reverse=True)[:5]:
+                logger.debug("  %s: %.2fs predicted, %.2fs actual", key, self.predicted[key], self.actual[key])
+
     def start(self):
         self.results = self.load_cached()
         self.processes = []
@@ -2196,6 +2238,12 @@ class CookerParser(object):
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
 
+            # The parser processes are forked from here and each recipe
+            # datastore starts out as a copy of these, memoise their lookups
+            # once up front
+            for mc in self.cooker.multiconfigs:
+                self.cfgbuilder.mcdata[mc].flatten()
+
             next_job_id = multiprocessing.Value(ctypes.c_int, 0)
             self.parser_quit = multiprocessing.Event()
             self.result_queue = multiprocessing.Queue()
@@ -2277,8 +2325,11 @@ class CookerParser(object):
 
         bb.codeparser.parser_cache_save()
         bb.codeparser.parser_cache_savemerge()
+        bb.parse.BBHandler.statement_cache_save()
+        bb.parse.BBHandler.statement_cache_savemerge()
         bb.cache.SiggenRecipeInfo.reset()
         bb.fetch.fetcher_parse_done()
+        self.save_parsetimes()
         if self.cooker.configuration.profile:
             profiles = []
             for i in self.process_names:
@@ -2298,7 +2349,7 @@ class CookerParser(object):
     def load_cached(self):
         for mc, cache, filename, appends, layername in self.fromcache:
             infos = cache.loadCached(filename, appends)
-            yield False, mc, infos
+            yield False, mc, infos, None
 
     def parse_generator(self):
         empty = False
@@ -2315,7 +2366,7 @@ class CookerParser(object):
                 result = self.result_queue.get(timeout=0.25)
             except queue.Empty:
                 empty = True
-                yield None, None, None
+                yield None, None, None, None
             else:
                 empty = False
                 yield result
@@ -2328,7 +2379,7 @@ class CookerParser(object):
         result = []
         parsed = None
         try:
-            parsed, mc, result = next(self.results)
+            parsed, mc, result, duration = next(self.results)
             if isinstance(result, BaseException):
                 # Turn exceptions back into exceptions
                 raise result
@@ -2398,6 +2449,9 @@ class CookerParser(object):
         self.virtuals += len(result)
         if parsed:
             self.parsed += 1
+            if result:
+                (fn, _, _) = bb.cache.virtualfn2realfn(result[0][0])
+                self.actual[self.parsetime_key(mc, fn)] = duration
             if self.parsed % self.progress_chunk == 0:
                 bb.event.fire(bb.event.ParseProgress(self.parsed, self.toparse),
                               self.cfgdata)
@@ -374,6 +374,7 @@ class CookerDataBuilder(object):
                 data.setVar("BB_CACHEDIR", "${TOPDIR}/cache")
 
             bb.codeparser.parser_cache_init(data.getVar("BB_CACHEDIR"))
+            bb.parse.BBHandler.statement_cache_init(data.getVar("BB_CACHEDIR"))
 
             layers = (data.getVar('BBLAYERS') or "").split()
             broken_layers = []
@@ -481,6 +482,7 @@ class CookerDataBuilder(object):
         if not data.getVar("BB_CACHEDIR"):
             data.setVar("BB_CACHEDIR", "${TOPDIR}/cache")
         bb.codeparser.parser_cache_init(data.getVar("BB_CACHEDIR"))
+        bb.parse.BBHandler.statement_cache_init(data.getVar("BB_CACHEDIR"))
 
         data = parse_config_file(os.path.join("conf", "bitbake.conf"), data)
 
@@ -522,7 +524,7 @@ class CookerDataBuilder(object):
 
         return bb.parse.handle(bbfile, bb_data)
 
-    def parseRecipeVariants(self, bbfile, appends, virtonly=False, mc=None, layername=None):
+    def parseRecipeVariants(self, bbfile, appends, virtonly=False, mc=None, layername=None, basedata=None):
         """
         Load and parse one .bb build file
         Return the data and whether parsing resulted in the file being skipped
@@ -530,7 +532,9 @@ class CookerDataBuilder(object):
 
         if virtonly:
             (bbfile, virtual, mc) = bb.cache.virtualfn2realfn(bbfile)
-            bb_data = self.mcdata[mc].createCopy()
+            if basedata is None:
+                basedata = self.mcdata[mc]
+            bb_data = basedata.createCopy()
             bb_data.setVar("__ONLYFINALISE", virtual or "default")
             return self._parse_recipe(bb_data, bbfile, appends, mc, layername)
 
@@ -551,12 +555,13 @@ class CookerDataBuilder(object):
 
         return datastores
 
-    def parseRecipe(self, virtualfn, appends, layername):
+    def parseRecipe(self, virtualfn, appends, layername, basedata=None):
         """
         Return a complete set of data for fn.
-        To do this, we need to parse the file.
+        To do this, we need to parse the file. The recipe is parsed on top
+        of a copy of basedata if given, else of its multiconfig's data.
         """
         logger.debug("Parsing %s (full)" % virtualfn)
         (fn, virtual, mc) = bb.cache.virtualfn2realfn(virtualfn)
-        datastores = self.parseRecipeVariants(virtualfn, appends, virtonly=True, layername=layername)
+        datastores = self.parseRecipeVariants(virtualfn, appends, virtonly=True, layername=layername, basedata=basedata)
         return datastores[virtual]
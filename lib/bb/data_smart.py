@@ -23,6 +23,7 @@ import sys
 from collections.abc import MutableMapping
 import logging
 import hashlib
+import weakref
 import bb, bb.codeparser
 import bb.filter
 from bb   import utils
@@ -105,6 +106,7 @@ class VariableParse:
         self.references = set()
         self.execs = set()
         self.contains = {}
+        self.python = False
 
     def var_sub(self, match):
         key = match.group()[2:-1]
@@ -129,6 +131,7 @@ class VariableParse:
         if __expand_var_regexp__.findall(code):
             return "${@" + code + "}"
 
+        self.python = True
         if self.varname:
             varname = 'Var <%s>' % self.varname
         else:
@@ -433,7 +436,17 @@ class DataSmart(MutableMapping):
         self._var_renames = {}
         self._var_renames.update(bitbake_renamed_vars)
 
-        self.expand_cache = {}
+        self._clear_expand_cache()
+
+        # Lookups of variables inherited from the datastores this one was
+        # copied from, see flatten()
+        self._lookupmemo = None
+        self._parentfind = None
+        # Weak references to the datastores this was copied from, nearest
+        # first, and the flattened copies which have to drop their memo when
+        # the variables of this one change
+        self._ancestors = ()
+        self._flatcopies = None
 
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
@@ -450,6 +463,51 @@ class DataSmart(MutableMapping):
     def disableTracking(self):
         self._tracking = False
 
+    def _clear_expand_cache(self):
+        self.expand_cache = {}
+        # Map of variable name to the cache entries whose value was built
+        # from it, and the set of entries which ran inline python and
+        # could therefore have read anything
+        self.expand_deps = {}
+        self.expand_volatile = set()
+
+    def _cache_expansion(self, cachename, parser, deps):
+        self.expand_cache[cachename] = parser
+        for dep in deps:
+            if dep not in self.expand_deps:
+                self.expand_deps[dep] = set()
+            self.expand_deps[dep].add(cachename)
+        if parser.python:
+            self.expand_volatile.add(cachename)
+
+    def _invalidate_expand_cache(self, var):
+        """
+        Drop the cached expansions which depend on var, including those of
+        its override base names and, transitively, anything referencing
+        the variables whose entries were dropped.
+        """
+        if not self.expand_cache:
+            return
+
+        todo = [var]
+        while ":" in var:
+            var = var.rsplit(":", 1)[0]
+            todo.append(var)
+        for cachename in self.expand_volatile:
+            if self.expand_cache.pop(cachename, None) is not None:
+                todo.append(cachename.split("[", 1)[0])
+        self.expand_volatile = set()
+
+        seen = set()
+        while todo:
+            var = todo.pop()
+            if var in seen:
+                continue
+            seen.add(var)
+            for cachename in self.expand_deps.pop(var, ()):
+                if self.expand_cache.pop(cachename, None) is not None:
+                    todo.append(cachename.split("[", 1)[0])
+
     def expandWithRefs(self, s, varname):
 
         if not isinstance(s, str): # sanity check
@@ -502,7 +560,7 @@ class DataSmart(MutableMapping):
             overrride_stack.append(self.overrides)
             self.overridesset = set(self.overrides)
             self.inoverride = False
-            self.expand_cache = {}
+            self._clear_expand_cache()
             newoverrides = (self.getVar("OVERRIDES") or "").split(":") or []
             if newoverrides == self.overrides:
                 break
@@ -512,20 +570,71 @@ class DataSmart(MutableMapping):
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work. The list of failing override expansions: %s" % "\n".join(str(s) for s in overrride_stack))
 
     def initVar(self, var):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
         if not var in self.dict:
             self.dict[var] = {}
+            self._layout_changed()
+
+    def _layout_changed(self):
+        if self._flatcopies:
+            for data in self._flatcopies.values():
+                data._lookupmemo.clear()
 
     def _findVar(self, var):
         dest = self.dict
-        while dest:
-            if var in dest:
-                return dest[var]
+        if var in dest:
+            return dest[var]
 
-            if "_data" not in dest:
-                break
-            dest = dest["_data"]
-        return None
+        memo = self._lookupmemo
+        if memo is not None and var in memo:
+            return memo[var]
+
+        local_var = None
+        if self._parentfind is not None:
+            local_var = self._parentfind(var)
+        else:
+            while dest:
+                if var in dest:
+                    local_var = dest[var]
+                    break
+
+                if "_data" not in dest:
+                    break
+                dest = dest["_data"]
+
+        if memo is not None:
+            memo[var] = local_var
+        return local_var
+
+    def flatten(self):
+        """
+        Memoise the lookups of variables inherited from the datastores this
+        one was copied from, so that reads no longer walk the whole copy
+        chain. Copies made from this datastore resolve inherited variables
+        through the memo too. Writes still go to this datastore only and
+        the memo is dropped whenever a variable is added to or removed from
+        one of the datastores it was copied from.
+        """
+        if self._lookupmemo is not None:
+            return
+        self._lookupmemo = {}
+        for ref in self._ancestors:
+            parent = ref()
+            if parent is None:
+                continue
+            if parent._flatcopies is None:
+                # Datastores aren't hashable, so no WeakSet
+                parent._flatcopies = weakref.WeakValueDictionary()
+            parent._flatcopies[id(self)] = self
+
+    def __getstate__(self):
+        # The lookup memo refers to other datastores, pickle without it
+        state = self.__dict__.copy()
+        state["_lookupmemo"] = None
+        state["_parentfind"] = None
+        state["_ancestors"] = ()
+        state["_flatcopies"] = None
+        return state
 
     def _makeShadowCopy(self, var):
         if var in self.dict:
@@ -535,6 +644,7 @@ class DataSmart(MutableMapping):
 
         if local_var:
             self.dict[var] = copy.copy(local_var)
+            self._layout_changed()
         else:
             self.initVar(var)
 
@@ -558,7 +668,7 @@ class DataSmart(MutableMapping):
             # Mark that we have seen a renamed variable
             self.setVar("_FAILPARSINGERRORHANDLED", True)
 
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
         parsing=False
         if 'parsing' in loginfo:
             parsing=True
@@ -638,7 +748,7 @@ class DataSmart(MutableMapping):
                 nextnew.update(vardata.contains.keys())
             new = nextnew
         self.overrides = None
-        self.expand_cache = {}
+        self._clear_expand_cache()
 
     def _setvar_update_overrides(self, var, **loginfo):
         # aka pay the cookie monster
@@ -725,12 +835,13 @@ class DataSmart(MutableMapping):
         self.setVar(var + ":prepend", value, ignore=True, parsing=True)
 
     def delVar(self, var, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
 
         loginfo['detail'] = ""
         loginfo['op'] = 'del'
         self.varhistory.record(**loginfo)
         self.dict[var] = {}
+        self._layout_changed()
         if var in self.overridedata:
             del self.overridedata[var]
         if ':' in var:
@@ -752,7 +863,7 @@ class DataSmart(MutableMapping):
                          override = None
 
     def setVarFlag(self, var, flag, value, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
 
         if var == "BB_RENAMED_VARIABLES":
             self._var_renames[flag] = value
@@ -781,6 +892,7 @@ class DataSmart(MutableMapping):
             if not "_content" in self.dict["__exportlist"]:
                 self.dict["__exportlist"]["_content"] = set()
             self.dict["__exportlist"]["_content"].add(var)
+            self._invalidate_expand_cache("__exportlist")
 
     def getVarFlag(self, var, flag, expand=True, noweakdefault=False, parsing=False, retparser=False):
         if flag == "_content":
@@ -800,6 +912,7 @@ class DataSmart(MutableMapping):
         local_var = self._findVar(var)
         value = None
         removes = set()
+        deps = set([var])
         if flag == "_content" and not parsing:
             overridedata = self.overridedata.get(var, None)
         if flag == "_content" and not parsing and overridedata is not None:
@@ -891,7 +1004,11 @@ class DataSmart(MutableMapping):
             if removes and parser:
                 expanded_removes = {}
                 for r in removes:
-                    expanded_removes[r] = self.expand(r).split()
+                    removeparser = self.expandWithRefs(r, None)
+                    deps |= removeparser.references
+                    if removeparser.python:
+                        parser.python = True
+                    expanded_removes[r] = removeparser.value.split()
 
                 parser.removes = set()
                 val = []
@@ -915,7 +1032,8 @@ class DataSmart(MutableMapping):
                 parser.value = value
 
         if parser and not noweakdefault:
-            self.expand_cache[cachename] = parser
+            deps |= parser.references
+            self._cache_expansion(cachename, parser, deps)
 
         if retparser:
             return value, parser
@@ -923,7 +1041,7 @@ class DataSmart(MutableMapping):
         return value
 
     def delVarFlag(self, var, flag, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
 
         local_var = self._findVar(var)
         if not local_var:
@@ -956,7 +1074,7 @@ class DataSmart(MutableMapping):
         self.setVarFlag(var, flag, newvalue, ignore=True)
 
     def setVarFlags(self, var, flags, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
         infer_caller_details(loginfo)
         if not var in self.dict:
             self._makeShadowCopy(var)
@@ -991,7 +1109,7 @@ class DataSmart(MutableMapping):
         return flags
 
     def delVarFlags(self, var, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
         if not var in self.dict:
             self._makeShadowCopy(var)
 
@@ -1008,6 +1126,7 @@ class DataSmart(MutableMapping):
                 self.dict[var]["_content"] = content
             else:
                 del self.dict[var]
+            self._layout_changed()
 
     def createCopy(self):
         """
@@ -1024,6 +1143,10 @@ class DataSmart(MutableMapping):
         data._tracking = self._tracking
         data._var_renames = self._var_renames
 
+        data._ancestors = (weakref.ref(self),) + self._ancestors
+        if self._lookupmemo is not None or self._parentfind is not None:
+            data._parentfind = self._findVar
+
         data.overrides = None
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
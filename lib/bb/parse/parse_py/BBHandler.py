@@ -15,6 +15,7 @@
 import re, bb, os
 import bb.build, bb.utils, bb.data_smart
 
+from bb.cache import MultiProcessCache
 from . import ConfHandler
 from .. import resolve_file, ast, logger, ParseError
 from .ConfHandler import include, init
@@ -38,6 +39,74 @@ __residue__ = []
 
 cached_statements = {}
 
+class StatementCache(MultiProcessCache):
+    """
+    The parsed statements of .bb, .bbclass and .inc files, kept on disk so
+    that parser processes and later servers don't have to lex them again.
+    Entries are keyed by file name and only used if the file's mtime, size
+    and inode still match.
+    """
+    cache_file_name = "bb_statements.dat"
+    # NOTE: you must increment this if you change the ast node classes
+    CACHE_VERSION = 1
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.cachedir = None
+        self.loaded = False
+
+    def init_cache(self, cachedir):
+        # The cache is only read from disk the first time it is needed
+        if not cachedir or cachedir == self.cachedir:
+            return
+        bb.utils.mkdirhier(cachedir)
+        self.cachedir = cachedir
+        self.cachefile = os.path.join(cachedir, self.cache_file_name)
+        self.cachedata = self.create_cachedata()
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded and self.cachedir:
+            MultiProcessCache.init_cache(self, self.cachedir)
+            self.loaded = True
+
+    def get(self, filename, mtime):
+        self.load()
+        entry = self.cachedata[0].get(filename)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        return None
+
+    def add(self, filename, mtime, statements):
+        if self.cachefile:
+            self.cachedata_extras[0][filename] = (mtime, statements)
+
+    def merge_data(self, source, dest):
+        # Entries are only written when the cached one was missing or stale
+        dest[0].update(source[0])
+
+    def prune_data(self, data):
+        # Forget the files which have been removed
+        stale = [fn for fn in data[0] if not os.path.exists(fn)]
+        for fn in stale:
+            del data[0][fn]
+        return bool(stale)
+
+    def save_merge(self):
+        self.load()
+        MultiProcessCache.save_merge(self)
+
+statementcache = StatementCache()
+
+def statement_cache_init(cachedir):
+    statementcache.init_cache(cachedir)
+
+def statement_cache_save():
+    statementcache.save_extras()
+
+def statement_cache_savemerge():
+    statementcache.save_merge()
+
 def supports(fn, d):
     """Return True if fn has a supported extension"""
     return os.path.splitext(fn)[-1] in [".bb", ".bbclass", ".inc"]
@@ -96,6 +165,15 @@ def get_statements(filename, absolute_filename, base_name):
     try:
         return cached_statements[absolute_filename]
     except KeyError:
+        # Recipes are only parsed once per process, so are only cached on disk
+        cacheable = filename.endswith(".bbclass") or filename.endswith(".inc")
+        mtime = bb.parse.cached_mtime_noerror(absolute_filename)
+        statements = statementcache.get(absolute_filename, mtime)
+        if statements is not None:
+            if cacheable:
+                cached_statements[absolute_filename] = statements
+            return statements
+
         with open(absolute_filename, 'r') as f:
             statements = ast.StatementGroup()
 
@@ -116,8 +194,9 @@ def get_statements(filename, absolute_filename, base_name):
         if __body__:
             raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
 
-        if filename.endswith(".bbclass") or filename.endswith(".inc"):
+        if cacheable:
             cached_statements[absolute_filename] = statements
+        statementcache.add(absolute_filename, mtime, statements)
         return statements
 
 def handle(fn, d, include, baseconfig=False):
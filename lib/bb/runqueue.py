@@ -15,6 +15,7 @@ import os
 import sys
 import stat
 import errno
+import heapq
 import itertools
 import logging
 import re
@@ -25,6 +26,7 @@ import subprocess
 import pickle
 import shlex
 import pprint
+import struct
 import time
 
 Process = bb.multiprocessing.Process
@@ -36,6 +38,15 @@ psi_logger = logging.getLogger("BitBake.RunQueue.PSI")
 
 __find_sha256__ = re.compile( r'(?i)(?<![a-z0-9])[a-f0-9]{64}(?![a-z0-9])' )
 
+# Messages from bitbake-worker were historically delimited by tags, e.g.
+# <event>pickled data</event>, which means searching the stream for the end
+# tag. When asked to in the workerdata, the worker instead sends frames of a
+# type byte and a big endian length followed by the pickled data. The type
+# values can't be confused with the "<" starting a tagged message.
+WORKER_FRAME_EVENT = 1
+WORKER_FRAME_EXITCODE = 2
+WORKER_FRAME_HEADER = struct.Struct(">BI")
+
 def fn_from_tid(tid):
      return tid.rsplit(":", 1)[0]
 
@@ -149,12 +160,18 @@ class RunQueueScheduler(object):
         """
         The default scheduler just returns the first buildable task (the
         priority map is sorted by task number)
+
+        Subclasses implement their policy by ordering prio_map. The
+        buildable tasks are kept in a heap ordered by their position in
+        it so the next task can be found without scanning all of them.
+        Tasks which can't run yet are held back out of the heap until
+        whatever blocks them changes.
         """
         self.rq = runqueue
         self.rqdata = rqdata
         self.numTasks = len(self.rqdata.runtaskentries)
 
-        self.prio_map = [self.rqdata.runtaskentries.keys()]
+        self.prio_map = list(self.rqdata.runtaskentries.keys())
 
         self.buildable = set()
         self.skip_maxthread = {}
@@ -166,6 +183,13 @@ class RunQueueScheduler(object):
                 self.buildable.add(tid)
 
         self.rev_prio_map = None
+        self.ready = None
+        self.queued = set()
+        # Held back by holdoff/scenequeue coverage, by taskname for
+        # number_threads and by stamp for stamp clashes
+        self.held = set()
+        self.held_maxthread = {}
+        self.held_stamps = {}
         self.is_pressure_usable()
 
     def is_pressure_usable(self):
@@ -243,19 +267,12 @@ class RunQueueScheduler(object):
         """
         Return the id of the first task we find that is buildable
         """
-        # Once tasks are running we don't need to worry about them again
-        self.buildable.difference_update(self.rq.runq_running)
-        buildable = set(self.buildable)
-        buildable.difference_update(self.rq.holdoff_tasks)
-        buildable.intersection_update(self.rq.tasks_covered | self.rq.tasks_notcovered)
-        if not buildable:
-            return None
-
-        # Bitbake requires that at least one task be active. Only check for pressure if
-        # this is the case, otherwise the pressure limitation could result in no tasks
-        # being active and no new tasks started thereby, at times, breaking the scheduler.
-        if self.rq.stats.active and self.exceeds_max_pressure():
-            return None
+        if self.ready is None:
+            if not self.rev_prio_map:
+                self.rev_prio_map = dict((tid, prio) for prio, tid in enumerate(self.prio_map))
+            self.ready = [(self.rev_prio_map[tid], tid) for tid in self.buildable]
+            heapq.heapify(self.ready)
+            self.queued = set(self.buildable)
 
         # Filter out tasks that have a max number of threads that have been exceeded
         skip_buildable = {}
@@ -270,35 +287,71 @@ class RunQueueScheduler(object):
             else:
                 skip_buildable[rtaskname] = 1
 
-        if len(buildable) == 1:
-            tid = buildable.pop()
+        # Take tasks from the heap in priority order. Those which can't run
+        # yet are held back until requeued, those no longer buildable are dropped.
+        best = None
+        checked_pressure = False
+        build_stamps = set(self.rq.build_stamps.values())
+        while self.ready:
+            tid = self.ready[0][1]
+            if tid not in self.buildable or tid in self.rq.runq_running:
+                # Once tasks are running we don't need to worry about them again
+                heapq.heappop(self.ready)
+                self.queued.discard(tid)
+                self.buildable.discard(tid)
+                continue
+            if tid in self.rq.holdoff_tasks or (tid not in self.rq.tasks_covered and tid not in self.rq.tasks_notcovered):
+                heapq.heappop(self.ready)
+                self.held.add(tid)
+                continue
+
+            # Bitbake requires that at least one task be active. Only check for pressure if
+            # this is the case, otherwise the pressure limitation could result in no tasks
+            # being active and no new tasks started thereby, at times, breaking the scheduler.
+            if not checked_pressure:
+                checked_pressure = True
+                if self.rq.stats.active and self.exceeds_max_pressure():
+                    break
+
             taskname = taskname_from_tid(tid)
             if taskname in skip_buildable and skip_buildable[taskname] >= int(self.skip_maxthread[taskname]):
-                return None
-            stamp = self.stamps[tid]
-            if stamp not in self.rq.build_stamps.values():
-                return tid
+                heapq.heappop(self.ready)
+                self.held_maxthread.setdefault(taskname, set()).add(tid)
+                continue
+            if self.stamps[tid] in build_stamps:
+                heapq.heappop(self.ready)
+                self.held_stamps.setdefault(self.stamps[tid], set()).add(tid)
+                continue
+            best = tid
+            break
 
-        if not self.rev_prio_map:
-            self.rev_prio_map = {}
-            for tid in self.rqdata.runtaskentries:
-                self.rev_prio_map[tid] = self.prio_map.index(tid)
+        return best
 
-        best = None
-        bestprio = None
-        for tid in buildable:
-            prio = self.rev_prio_map[tid]
-            if bestprio is None or bestprio > prio:
-                taskname = taskname_from_tid(tid)
-                if taskname in skip_buildable and skip_buildable[taskname] >= int(self.skip_maxthread[taskname]):
-                    continue
-                stamp = self.stamps[tid]
-                if stamp in self.rq.build_stamps.values():
-                    continue
-                bestprio = prio
-                best = tid
+    def requeue(self, tids):
+        """
+        Put held back tasks on the heap again
+        """
+        for tid in tids:
+            heapq.heappush(self.ready, (self.rev_prio_map[tid], tid))
 
-        return best
+    def holdoff_changed(self):
+        """
+        The holdoff tasks or scenequeue coverage changed
+        """
+        self.requeue(self.held)
+        self.held = set()
+
+    def task_finished(self, task):
+        """
+        A running task exited so another of the same name may now fit under number_threads
+        """
+        self.requeue(self.held_maxthread.pop(taskname_from_tid(task), ()))
+
+    def stamp_released(self, stamp):
+        """
+        A task using stamp exited so others with the same stamp may run
+        """
+        self.requeue(self.held_stamps.pop(stamp, ()))
 
     def next(self):
         """
@@ -309,6 +362,9 @@ class RunQueueScheduler(object):
 
     def newbuildable(self, task):
         self.buildable.add(task)
+        if self.ready is not None and task not in self.queued:
+            heapq.heappush(self.ready, (self.rev_prio_map[task], task))
+            self.queued.add(task)
 
     def removebuildable(self, task):
         self.buildable.remove(task)
@@ -458,6 +514,38 @@ class RunTaskEntry(object):
         self.task = None
         self.weight = 1
 
+class TaskGraphIndex(object):
+    """
+    An integer numbering of the tasks in the runqueue with their dependencies
+    held as tuples of task numbers, for the graph algorithms which would
+    otherwise operate on large sets of tid strings. Sets of tasks can be held
+    as bitsets (python integers) which are far more compact and much faster
+    to combine. Tasks in 'first' are numbered first so bitsets of them stay
+    small.
+    """
+    def __init__(self, runtaskentries, first=()):
+        first = sorted(first)
+        self.tids = first + sorted(set(runtaskentries).difference(first))
+        self.index = dict((tid, i) for i, tid in enumerate(self.tids))
+        self.depends = [tuple(self.index[dep] for dep in runtaskentries[tid].depends) for tid in self.tids]
+        self.revdeps = [tuple(self.index[dep] for dep in runtaskentries[tid].revdeps) for tid in self.tids]
+
+    def __len__(self):
+        return len(self.tids)
+
+    def from_bits(self, bits):
+        """
+        Return the list of task numbers in a bitset
+        """
+        s = bin(bits)
+        top = len(s) - 1
+        result = []
+        i = s.find("1", 2)
+        while i != -1:
+            result.append(top - i)
+            i = s.find("1", i + 1)
+        return result
+
 class RunQueueData:
     """
     BitBake Run Queue implementation
@@ -476,10 +564,16 @@ class RunQueueData:
         self.setscene_enforce = (cfgData.getVar('BB_SETSCENE_ENFORCE') == "1")
         self.init_progress_reporter = bb.progress.DummyMultiStageProcessProgressReporter()
 
+        # Only a memory resident server (one with an idle timeout) runs
+        # another build which could reuse the task graph of this one
+        server = cooker.process_server
+        self.keep_taskgraph = bool(server and getattr(server, "timeout", None))
+
         self.reset()
 
     def reset(self):
         self.runtaskentries = {}
+        self.taskindex = None
 
     def runq_depends_names(self, ids):
         ret = []
@@ -606,25 +700,22 @@ class RunQueueData:
         possible to execute due to circular dependencies.
         """
 
-        numTasks = len(self.runtaskentries)
-        weight = {}
-        deps_left = {}
-        task_done = {}
-
-        for tid in self.runtaskentries:
-            task_done[tid] = False
-            weight[tid] = 1
-            deps_left[tid] = len(self.runtaskentries[tid].revdeps)
+        index = self.taskindex
+        numTasks = len(index)
+        weight = [1] * numTasks
+        deps_left = [len(revdeps) for revdeps in index.revdeps]
+        task_done = [False] * numTasks
 
-        for tid in endpoints:
-            weight[tid] = 10
-            task_done[tid] = True
+        endpoints = [index.index[tid] for tid in endpoints]
+        for i in endpoints:
+            weight[i] = 10
+            task_done[i] = True
 
         while True:
             next_points = []
-            for tid in endpoints:
-                for revdep in self.runtaskentries[tid].depends:
-                    weight[revdep] = weight[revdep] + weight[tid]
+            for i in endpoints:
+                for revdep in index.depends[i]:
+                    weight[revdep] = weight[revdep] + weight[i]
                     deps_left[revdep] = deps_left[revdep] - 1
                     if deps_left[revdep] == 0:
                         next_points.append(revdep)
@@ -636,11 +727,12 @@ class RunQueueData:
         # Circular dependency sanity check
         problem_tasks = []
         for tid in self.runtaskentries:
-            if task_done[tid] is False or deps_left[tid] != 0:
+            i = index.index[tid]
+            if task_done[i] is False or deps_left[i] != 0:
                 problem_tasks.append(tid)
                 logger.debug2("Task %s is not buildable", tid)
-                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[tid], deps_left[tid])
-            self.runtaskentries[tid].weight = weight[tid]
+                logger.debug2("(Complete marker was %s and the remaining dependency count was %s)\n", task_done[i], deps_left[i])
+            self.runtaskentries[tid].weight = weight[i]
 
         if problem_tasks:
             message = "%s unbuildable tasks were found.\n" % len(problem_tasks)
@@ -655,36 +747,47 @@ class RunQueueData:
                 message = message + msg
             bb.msg.fatal("RunQueue", message)
 
-        return weight
+        return dict(zip(index.tids, weight))
 
-    def prepare(self):
+    def graph_inputs(self):
         """
-        Turn a set of taskData into a RunQueue and compute data needed
-        to optimise the execution order.
+        Return a snapshot of the taskData and task_deps information that
+        resolve_dependencies() uses, so a graph resolved earlier can be
+        reused if they're unchanged. Ordering isn't significant there so
+        sets are used to avoid spurious mismatches.
         """
+        inputs = {}
+        for mc in self.taskData:
+            taskData = self.taskData[mc]
+            tasks = {}
+            taskfns = set()
+            for tid, entry in taskData.taskentries.items():
+                tasks[tid] = (frozenset(entry.tdepends), frozenset(entry.idepends), frozenset(entry.irdepends))
+                taskfns.add(tid.rsplit(":", 1)[0])
+            inputs[mc] = (
+                tasks,
+                dict((fn, dict(self.dataCaches[mc].task_deps[fn])) for fn in taskfns),
+                dict((fn, frozenset(deps)) for fn, deps in taskData.depids.items()),
+                dict((fn, frozenset(deps)) for fn, deps in taskData.rdepids.items()),
+                dict((target, fns[0] if fns else None) for target, fns in taskData.build_targets.items()),
+                dict((target, fns[0] if fns else None) for target, fns in taskData.run_targets.items()),
+                frozenset(taskData.failed_fns),
+                frozenset(taskData.failed_deps),
+                frozenset(taskData.mcdepends),
+            )
+        return inputs
 
-        runq_build = {}
+    def resolve_dependencies(self):
+        """
+        Resolve the dependencies of every task in taskData into task IDs,
+        filling in runtaskentries (Step A of prepare()).
+        """
         recursivetasks = {}
         recursiveitasks = {}
         recursivetasksselfref = set()
 
         taskData = self.taskData
 
-        found = False
-        for mc in self.taskData:
-            if taskData[mc].taskentries:
-                found = True
-                break
-        if not found:
-            # Nothing to do
-            return 0
-
-        bb.parse.siggen.setup_datacache(self.dataCaches)
-
-        self.init_progress_reporter.start()
-        self.init_progress_reporter.next_stage()
-        bb.event.check_for_interrupts()
-
         # Step A - Work out a list of tasks to run
         #
         # Taskdata gives us a list of possible providers for every build and run
@@ -930,6 +1033,55 @@ class RunQueueData:
         for tid in recursivetasksselfref:
             self.runtaskentries[tid].depends.difference_update(recursivetasksselfref)
 
+    def prepare(self):
+        """
+        Turn a set of taskData into a RunQueue and compute data needed
+        to optimise the execution order.
+        """
+
+        runq_build = {}
+
+        taskData = self.taskData
+
+        found = False
+        for mc in self.taskData:
+            if taskData[mc].taskentries:
+                found = True
+                break
+        if not found:
+            # Nothing to do
+            return 0
+
+        bb.parse.siggen.setup_datacache(self.dataCaches)
+
+        self.init_progress_reporter.start()
+        self.init_progress_reporter.next_stage()
+        bb.event.check_for_interrupts()
+
+        # Step A - Work out a list of tasks to run
+        #
+        # If the inputs are unchanged since the last build (e.g. in a memory
+        # resident server where few or no recipes were reparsed), reuse the
+        # dependency graph resolved then rather than recomputing it. The
+        # inputs aren't even looked at when no other build can use them.
+        graph_inputs = None
+        if self.keep_taskgraph:
+            graph_inputs = self.graph_inputs()
+        cached = self.cooker.taskgraph_cache
+        if cached and cached[0] == graph_inputs:
+            logger.verbose("Reusing the task dependency graph from the previous build")
+            for tid, depends in cached[1].items():
+                self.runtaskentries[tid] = RunTaskEntry()
+                self.runtaskentries[tid].depends = set(depends)
+            self.init_progress_reporter.next_stage()
+            bb.event.check_for_interrupts()
+        else:
+            self.cooker.taskgraph_cache = None
+            self.resolve_dependencies()
+            if graph_inputs is not None:
+                self.cooker.taskgraph_cache = (graph_inputs, dict((tid, frozenset(self.runtaskentries[tid].depends)) for tid in self.runtaskentries))
+
+
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts()
 
@@ -1103,11 +1255,27 @@ class RunQueueData:
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts()
 
+        # Iterate over the task list looking for tasks with a 'setscene' function
+        self.runq_setscene_tids = set()
+        if not self.cooker.configuration.nosetscene:
+            for tid in self.runtaskentries:
+                (mc, fn, taskname, _) = split_tid_mcfn(tid)
+                setscenetid = tid + "_setscene"
+                if setscenetid not in taskData[mc].taskentries:
+                    continue
+                self.runq_setscene_tids.add(tid)
+
+        self.init_progress_reporter.next_stage()
+        bb.event.check_for_interrupts()
+
         # Generate a list of reverse dependencies to ease future calculations
         for tid in self.runtaskentries:
             for dep in self.runtaskentries[tid].depends:
                 self.runtaskentries[dep].revdeps.add(tid)
 
+        # Number the tasks for the graph algorithms below and in the scenequeue
+        self.taskindex = TaskGraphIndex(self.runtaskentries, self.runq_setscene_tids)
+
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts()
 
@@ -1236,19 +1404,6 @@ class RunQueueData:
         self.init_progress_reporter.next_stage()
         bb.event.check_for_interrupts()
 
-        # Iterate over the task list looking for tasks with a 'setscene' function
-        self.runq_setscene_tids = set()
-        if not self.cooker.configuration.nosetscene:
-            for tid in self.runtaskentries:
-                (mc, fn, taskname, _) = split_tid_mcfn(tid)
-                setscenetid = tid + "_setscene"
-                if setscenetid not in taskData[mc].taskentries:
-                    continue
-                self.runq_setscene_tids.add(tid)
-
-        self.init_progress_reporter.next_stage()
-        bb.event.check_for_interrupts()
-
         # Invalidate task if force mode active
         if self.cooker.configuration.force:
             for tid in self.target_tids:
@@ -1284,28 +1439,45 @@ class RunQueueData:
         starttime = time.time()
         lasttime = starttime
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(self.runtaskentries)
-        while todeal:
-            ready = set()
-            for tid in todeal.copy():
-                if not (self.runtaskentries[tid].depends - dealtwith):
-                    self.runtaskentries[tid].taskhash_deps = bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-                    # get_taskhash for a given tid *must* be called before get_unihash* below
-                    self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
-                    ready.add(tid)
-            unihashes = bb.parse.siggen.get_unihashes(ready)
+        # Iterate over the task list and call into the siggen code. Tasks are
+        # handled in waves of those whose dependencies have all been hashed,
+        # tracked by counting the outstanding dependencies of each task rather
+        # than rescanning the remaining tasks for each wave. The unihash query
+        # for one wave runs while the next wave is prepared since preparation
+        # (e.g. file checksums) doesn't depend on the unihashes.
+        depsleft = {}
+        ready = set()
+        for tid in self.runtaskentries:
+            depsleft[tid] = len(self.runtaskentries[tid].depends)
+            if not depsleft[tid]:
+                ready.add(tid)
+        for tid in ready:
+            self.runtaskentries[tid].taskhash_deps = bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+        todeal = len(self.runtaskentries)
+        while ready:
+            for tid in ready:
+                # get_taskhash for a given tid *must* be called before get_unihash* below
+                self.runtaskentries[tid].hash = bb.parse.siggen.get_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+            pending = bb.parse.siggen.get_unihashes_async(ready)
+            nextready = set()
+            for tid in ready:
+                for revdep in self.runtaskentries[tid].revdeps:
+                    depsleft[revdep] -= 1
+                    if not depsleft[revdep]:
+                        nextready.add(revdep)
+            for tid in nextready:
+                self.runtaskentries[tid].taskhash_deps = bb.parse.siggen.prep_taskhash(tid, self.runtaskentries[tid].depends, self.dataCaches)
+            unihashes = pending()
             for tid in ready:
-                dealtwith.add(tid)
-                todeal.remove(tid)
                 self.runtaskentries[tid].unihash = unihashes[tid]
+            todeal -= len(ready)
+            ready = nextready
 
             bb.event.check_for_interrupts()
 
             if time.time() > (lasttime + 30):
                 lasttime = time.time()
-                hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (len(todeal), len(self.runtaskentries), lasttime - starttime))
+                hashequiv_logger.verbose("Initial setup loop progress: %s of %s in %s" % (todeal, len(self.runtaskentries), lasttime - starttime))
 
         endtime = time.time()
         if (endtime-starttime > 60):
@@ -1402,6 +1574,7 @@ class RunQueue:
             "time" : self.cfgData.getVar("TIME"),
             "hashservaddr" : self.cooker.hashservaddr,
             "umask" : self.cfgData.getVar("BB_DEFAULT_UMASK"),
+            "binary_framing" : True,
         }
 
         RunQueue.send_pickled_data(worker, self.cooker.configuration, "cookerconfig")
@@ -1974,6 +2147,7 @@ class RunQueueExecute:
         # self.build_stamps[pid] may not exist when use shared work directory.
         if task in self.build_stamps:
             self.build_stamps2.remove(self.build_stamps[task])
+            self.sched.stamp_released(self.build_stamps[task])
             del self.build_stamps[task]
 
         if task in self.sq_live:
@@ -1988,6 +2162,7 @@ class RunQueueExecute:
                 self.task_fail(task, status, fakerootlog=fakerootlog)
             else:
                 self.task_complete(task)
+            self.sched.task_finished(task)
         return True
 
     def finish_now(self):
@@ -2557,6 +2732,7 @@ class RunQueueExecute:
                     self.holdoff_tasks.add(dep)
 
         self.holdoff_need_update = False
+        self.sched.holdoff_changed()
 
     def process_possible_migrations(self):
 
@@ -2720,6 +2896,7 @@ class RunQueueExecute:
                 del self.stampcache[tid]
 
             if tid in self.build_stamps:
+                self.sched.stamp_released(self.build_stamps[tid])
                 del self.build_stamps[tid]
 
             update_tasks.append(tid)
@@ -2943,9 +3120,14 @@ class SQData(object):
 
 def build_scenequeue_data(sqdata, rqdata, sqrq):
 
-    sq_revdeps = {}
-    sq_revdeps_squash = {}
-    sq_collated_deps = {}
+    # The graph is processed using the task numbering with the sets of
+    # setscene tasks held as bitsets. Setscene tasks are numbered first
+    # so these remain small.
+    index = rqdata.taskindex
+    numsetscene = len(rqdata.runq_setscene_tids)
+    sq_revdeps = []
+    sq_revdeps_squash = [0] * len(index)
+    sq_covered_bits = {}
 
     # We can't skip specified target tasks which aren't setscene tasks
     sqdata.cantskip = set(rqdata.target_tids)
@@ -2961,91 +3143,85 @@ def build_scenequeue_data(sqdata, rqdata, sqrq):
 
     # First process the chains up to the first setscene task.
     endpoints = {}
+    for revdeps in index.revdeps:
+        sq_revdeps.append(set(revdeps))
     for tid in rqdata.runtaskentries:
-        sq_revdeps[tid] = copy.copy(rqdata.runtaskentries[tid].revdeps)
-        sq_revdeps_squash[tid] = set()
-        if not sq_revdeps[tid] and tid not in rqdata.runq_setscene_tids:
+        i = index.index[tid]
+        if not sq_revdeps[i] and i >= numsetscene:
             #bb.warn("Added endpoint %s" % (tid))
-            endpoints[tid] = set()
+            endpoints[i] = 0
 
     rqdata.init_progress_reporter.next_stage()
 
     # Secondly process the chains between setscene tasks.
     for tid in rqdata.runq_setscene_tids:
-        sq_collated_deps[tid] = set()
+        i = index.index[tid]
         #bb.warn("Added endpoint 2 %s" % (tid))
-        for dep in rqdata.runtaskentries[tid].depends:
-                if tid in sq_revdeps[dep]:
-                    sq_revdeps[dep].remove(tid)
-                if dep not in endpoints:
-                    endpoints[dep] = set()
+        for dep in index.depends[i]:
+                sq_revdeps[dep].discard(i)
                 #bb.warn("  Added endpoint 3 %s" % (dep))
-                endpoints[dep].add(tid)
+                endpoints[dep] = endpoints.get(dep, 0) | (1 << i)
 
     rqdata.init_progress_reporter.next_stage()
 
-    def process_endpoints(endpoints):
+    while endpoints:
         newendpoints = {}
         for point, task in endpoints.items():
-            tasks = set()
-            if task:
-                tasks |= task
-            if sq_revdeps_squash[point]:
-                tasks |= sq_revdeps_squash[point]
-            if point not in rqdata.runq_setscene_tids:
-                for t in tasks:
-                    sq_collated_deps[t].add(point)
-            sq_revdeps_squash[point] = set()
-            if point in rqdata.runq_setscene_tids:
+            tasks = task | sq_revdeps_squash[point]
+            if point < numsetscene:
                 sq_revdeps_squash[point] = tasks
                 continue
-            for dep in rqdata.runtaskentries[point].depends:
-                if point in sq_revdeps[dep]:
-                    sq_revdeps[dep].remove(point)
-                if tasks:
-                    sq_revdeps_squash[dep] |= tasks
-                if not sq_revdeps[dep] and dep not in rqdata.runq_setscene_tids:
+            if tasks:
+                sq_covered_bits[point] = sq_covered_bits.get(point, 0) | tasks
+            sq_revdeps_squash[point] = 0
+            for dep in index.depends[point]:
+                sq_revdeps[dep].discard(point)
+                sq_revdeps_squash[dep] |= tasks
+                if not sq_revdeps[dep] and dep >= numsetscene:
                     newendpoints[dep] = task
-        if newendpoints:
-            process_endpoints(newendpoints)
-
-    process_endpoints(endpoints)
+        endpoints = newendpoints
 
     rqdata.init_progress_reporter.next_stage()
 
     # Build a list of tasks which are "unskippable"
     # These are direct endpoints referenced by the build upto and including setscene tasks
     # Take the build endpoints (no revdeps) and find the sstate tasks they depend upon
-    new = True
-    for tid in rqdata.runtaskentries:
-        if not rqdata.runtaskentries[tid].revdeps:
-            sqdata.unskippable.add(tid)
-    sqdata.unskippable |= sqdata.cantskip
-    while new:
-        new = False
-        orig = sqdata.unskippable.copy()
-        for tid in sorted(orig, reverse=True):
-            if tid in rqdata.runq_setscene_tids:
-                continue
-            if not rqdata.runtaskentries[tid].depends:
-                # These are tasks which have no setscene tasks in their chain, need to mark as directly buildable
-                sqrq.setbuildable(tid)
-            sqdata.unskippable |= rqdata.runtaskentries[tid].depends
-            if sqdata.unskippable != orig:
-                new = True
+    unskippable = set(index.index[tid] for tid in sqdata.cantskip)
+    unskippable.update(i for i, revdeps in enumerate(index.revdeps) if not revdeps)
+    todo = list(unskippable)
+    while todo:
+        i = todo.pop()
+        if i < numsetscene:
+            continue
+        if not index.depends[i]:
+            # These are tasks which have no setscene tasks in their chain, need to mark as directly buildable
+            sqrq.setbuildable(index.tids[i])
+        for dep in index.depends[i]:
+            if dep not in unskippable:
+                unskippable.add(dep)
+                todo.append(dep)
+    sqdata.unskippable.update(index.tids[i] for i in unskippable)
 
     sqrq.tasks_scenequeue_done |= sqdata.unskippable.difference(rqdata.runq_setscene_tids)
 
     rqdata.init_progress_reporter.next_stage(len(rqdata.runtaskentries))
 
     # Sanity check all dependencies could be changed to setscene task references
-    for tid in rqdata.runtaskentries:
-        if tid in rqdata.runq_setscene_tids:
-            pass
-        elif sq_revdeps_squash[tid]:
+    for i in range(numsetscene, len(index)):
+        if sq_revdeps_squash[i]:
             bb.msg.fatal("RunQueue", "Something went badly wrong during scenequeue generation, halting. Please report this problem.")
-        else:
-            del sq_revdeps_squash[tid]
+
+    sqdata.sq_revdeps = {}
+    for tid in rqdata.runtaskentries:
+        i = index.index[tid]
+        if i < numsetscene:
+            sqdata.sq_revdeps[tid] = set(index.tids[dep] for dep in index.from_bits(sq_revdeps_squash[i]))
+    sqdata.sq_covered_tasks = {}
+    for tid in rqdata.runq_setscene_tids:
+        sqdata.sq_covered_tasks[tid] = set()
+    for point, tasks in sq_covered_bits.items():
+        for i in index.from_bits(tasks):
+            sqdata.sq_covered_tasks[index.tids[i]].add(index.tids[point])
 
     rqdata.init_progress_reporter.next_stage()
 
@@ -3082,15 +3258,12 @@ def build_scenequeue_data(sqdata, rqdata, sqrq):
 
     rqdata.init_progress_reporter.next_stage()
 
-    #for tid in sq_revdeps_squash:
+    #for tid in sqdata.sq_revdeps:
     #    data = ""
-    #    for dep in sq_revdeps_squash[tid]:
+    #    for dep in sqdata.sq_revdeps[tid]:
     #        data = data + "\n   %s" % dep
     #    bb.warn("Task %s_setscene: is %s " % (tid, data))
 
-    sqdata.sq_revdeps = sq_revdeps_squash
-    sqdata.sq_covered_tasks = sq_collated_deps
-
     # Build reverse version of revdeps to populate deps structure
     for tid in sqdata.sq_revdeps:
         sqdata.sq_deps[tid] = set()
@@ -3326,6 +3499,7 @@ class runQueuePipe():
             pipeout.close()
         bb.utils.nonblockingfd(self.input)
         self.queue = bytearray()
+        self.offset = 0
         self.d = d
         self.rq = rq
         self.rqexec = rqexec
@@ -3339,48 +3513,90 @@ class runQueuePipe():
                     bb.error("%s process (%s) exited unexpectedly (%s), shutting down..." % (name, worker.process.pid, str(worker.process.returncode)))
                     self.rq.finish_runqueue(True)
 
-        start = len(self.queue)
+        data = None
         try:
-            self.queue.extend(self.input.read(512 * 1024) or b"")
+            data = self.input.read(512 * 1024)
         except (OSError, IOError) as e:
             if e.errno != errno.EAGAIN:
                 raise
-        end = len(self.queue)
-        found = True
-        while found and self.queue:
-            found = False
-            index = self.queue.find(b"</event>")
-            while index != -1 and self.queue.startswith(b"<event>"):
+        if data:
+            self.queue.extend(data)
+
+        # Messages are consumed by advancing self.offset and the buffer is
+        # only compacted once all complete messages have been handled. The
+        # offset is kept on the object so this remains correct should a
+        # handler end up calling read() again.
+        while self.offset < len(self.queue):
+            if self.queue[self.offset] == ord("<"):
+                if not self.read_tagged():
+                    break
+            elif not self.read_frame():
+                break
+        if self.offset:
+            del self.queue[:self.offset]
+            self.offset = 0
+        return bool(data)
+
+    def read_frame(self):
+        if len(self.queue) - self.offset < WORKER_FRAME_HEADER.size:
+            return False
+        msgtype, length = WORKER_FRAME_HEADER.unpack_from(self.queue, self.offset)
+        begin = self.offset + WORKER_FRAME_HEADER.size
+        if len(self.queue) < begin + length:
+            return False
+        with memoryview(self.queue) as view, view[begin:begin + length] as payload:
+            try:
+                data = pickle.loads(payload)
+            except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
+                bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, bytes(payload)))
+        self.offset = begin + length
+        if msgtype == WORKER_FRAME_EVENT:
+            self.handle_event(data)
+        elif msgtype == WORKER_FRAME_EXITCODE:
+            self.handle_exitcode(*data)
+        else:
+            bb.msg.fatal("RunQueue", "Unknown message type %s from worker" % msgtype)
+        return True
+
+    def read_tagged(self):
+        if self.queue.startswith(b"<event>", self.offset):
+            index = self.queue.find(b"</event>", self.offset)
+            while index != -1:
                 try:
-                    event = pickle.loads(self.queue[7:index])
+                    event = pickle.loads(self.queue[self.offset + 7:index])
                 except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
                     if isinstance(e, pickle.UnpicklingError) and "truncated" in str(e):
                         # The pickled data could contain "</event>" so search for the next occurance
                         # unpickling again, this should be the only way an unpickle error could occur
                         index = self.queue.find(b"</event>", index + 1)
                         continue
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
-                bb.event.fire_from_worker(event, self.d)
-                if isinstance(event, taskUniHashUpdate):
-                    self.rqexec.updated_taskhash_queue.append((event.taskid, event.unihash))
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find(b"</event>")
-            index = self.queue.find(b"</exitcode>")
-            while index != -1 and self.queue.startswith(b"<exitcode>"):
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[self.offset + 7:index]))
+                self.offset = index + 8
+                self.handle_event(event)
+                return True
+        elif self.queue.startswith(b"<exitcode>", self.offset):
+            index = self.queue.find(b"</exitcode>", self.offset)
+            if index != -1:
                 try:
-                    task, status = pickle.loads(self.queue[10:index])
+                    task, status = pickle.loads(self.queue[self.offset + 10:index])
                 except (ValueError, pickle.UnpicklingError, AttributeError, IndexError) as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
-                (_, _, _, taskfn) = split_tid_mcfn(task)
-                fakerootlog = None
-                if self.fakerootlogs and taskfn and taskfn in self.fakerootlogs:
-                    fakerootlog = self.fakerootlogs[taskfn]
-                self.rqexec.runqueue_process_waitpid(task, status, fakerootlog=fakerootlog)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find(b"</exitcode>")
-        return (end > start)
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[self.offset + 10:index]))
+                self.offset = index + 11
+                self.handle_exitcode(task, status)
+                return True
+        return False
+
+    def handle_event(self, event):
+        bb.event.fire_from_worker(event, self.d)
+        if isinstance(event, taskUniHashUpdate):
+            self.rqexec.updated_taskhash_queue.append((event.taskid, event.unihash))
+
+    def handle_exitcode(self, task, status):
+        (_, _, _, taskfn) = split_tid_mcfn(task)
+        fakerootlog = None
+        if self.fakerootlogs and taskfn and taskfn in self.fakerootlogs:
+            fakerootlog = self.fakerootlogs[taskfn]
+        self.rqexec.runqueue_process_waitpid(task, status, fakerootlog=fakerootlog)
 
     def close(self):
         while self.read():
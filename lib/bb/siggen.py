@@ -9,12 +9,15 @@ import logging
 import os
 import re
 import tempfile
+import threading
+import time
 import pickle
 import bb.data
 import difflib
 from bb._vendor import simplediff
 import json
 import types
+import contextlib
 from contextlib import contextmanager
 import bb.compress.zstd
 from bb.checksum import FileChecksumCache
@@ -127,6 +130,10 @@ class SignatureGenerator(object):
     def get_unihashes(self, tids):
         return {tid: self.get_unihash(tid) for tid in tids}
 
+    def get_unihashes_async(self, tids):
+        result = self.get_unihashes(tids)
+        return lambda: result
+
     def prep_taskhash(self, tid, deps, dataCaches):
         return
 
@@ -253,6 +260,9 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
     def _build_data(self, mcfn, d):
 
+        # The recipe is fully parsed, every variable is about to be read
+        d.flatten()
+
         ignore_mismatch = ((d.getVar("BB_HASH_IGNORE_MISMATCH") or '') == '1')
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d, self.basehash_ignore_vars)
 
@@ -534,7 +544,80 @@ class SignatureGeneratorBasicHash(SignatureGeneratorBasic):
         with open(taintfn, 'w') as taintf:
             taintf.write(str(uuid.uuid4()))
 
+class UnihashLocalCache(object):
+    """
+    A local, persistent cache of the taskhash to unihash mappings resolved
+    from a hash equivalence server, shared between bitbake invocations.
+    Entries expire after a TTL. Misses are also recorded (as a NULL unihash)
+    with a separate, typically much shorter, TTL since hashes can appear on
+    the server over time.
+    """
+    def __init__(self, path, ttl, negative_ttl):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db = None
+        # The connection is used from whichever thread looks up hashes and
+        # may be closed from another one (see siggen.exit())
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        import sqlite3
+
+        if self.db is None:
+            bb.utils.mkdirhier(os.path.dirname(self.path))
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode = WAL")
+            with self.db:
+                self.db.execute("""
+                    CREATE TABLE IF NOT EXISTS unihashes (
+                        server TEXT NOT NULL,
+                        method TEXT NOT NULL,
+                        taskhash TEXT NOT NULL,
+                        unihash TEXT,
+                        expires REAL NOT NULL,
+                        PRIMARY KEY (server, method, taskhash)
+                    )""")
+                self.db.execute("DELETE FROM unihashes WHERE expires < ?", (time.time(),))
+        return self.db
+
+    def get(self, server, queries):
+        """
+        Look up an iterable of (method, taskhash) tuples. Returns a
+        dictionary of those present, mapping to the unihash or None for
+        a cached miss.
+        """
+        now = time.time()
+        result = {}
+        with self.lock:
+            db = self._connect()
+            for method, taskhash in queries:
+                row = db.execute("SELECT unihash FROM unihashes WHERE server=? AND method=? AND taskhash=? AND expires >= ?",
+                                 (server, method, taskhash, now)).fetchone()
+                if row is not None:
+                    result[(method, taskhash)] = row[0]
+        return result
+
+    def set(self, server, entries):
+        """
+        Store an iterable of (method, taskhash, unihash) tuples, where a
+        unihash of None records a miss
+        """
+        now = time.time()
+        with self.lock, self._connect() as db:
+            db.executemany("INSERT OR REPLACE INTO unihashes (server, method, taskhash, unihash, expires) VALUES (?, ?, ?, ?, ?)",
+                           ((server, method, taskhash, unihash, now + (self.ttl if unihash else self.negative_ttl))
+                            for method, taskhash, unihash in entries))
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
 class SignatureGeneratorUniHashMixIn(object):
+    local_cache = None
+
     def __init__(self, data):
         self.extramethod = {}
         # NOTE: The cache only tracks hashes that exist. Hashes that don't
@@ -553,6 +636,13 @@ class SignatureGeneratorUniHashMixIn(object):
                 value = origenv.getVar(e)
             if value:
                 self.env[e] = value
+
+        self.local_cache = None
+        local_cache = data.getVar("BB_HASHSERVE_LOCAL_CACHE")
+        if local_cache:
+            self.local_cache = UnihashLocalCache(local_cache,
+                    int(data.getVar("BB_HASHSERVE_LOCAL_CACHE_TTL") or 86400),
+                    int(data.getVar("BB_HASHSERVE_LOCAL_CACHE_NEGATIVE_TTL") or 300))
         super().__init__(data)
 
     def get_taskdata(self):
@@ -560,6 +650,8 @@ class SignatureGeneratorUniHashMixIn(object):
 
     def set_taskdata(self, data):
         self.server, self.method, self.extramethod, self.username, self.password, self.env = data[:6]
+        # Only the server process consults the local cache
+        self.local_cache = None
         super().set_taskdata(data[6:])
 
     def get_hashserv_creds(self):
@@ -589,9 +681,24 @@ class SignatureGeneratorUniHashMixIn(object):
     @contextmanager
     def client(self):
         with self._client_env():
-            if getattr(self, '_client', None) is None:
-                self._client = hashserv.create_client(self.server, **self.get_hashserv_creds())
-            yield self._client
+            # Connections are borrowed from the process wide pool so that they
+            # are shared with any other users of the same server
+            with hashserv.pooled_client(self.server, **self.get_hashserv_creds()) as client:
+                yield client
+
+    @contextmanager
+    def connected_client(self):
+        """
+        As client() but the client is connected up front and the environment
+        is only changed while connecting, so the client can then be used from
+        another thread. The environment is process wide so must only be
+        changed from this thread.
+        """
+        with contextlib.ExitStack() as stack:
+            with self._client_env():
+                client = stack.enter_context(hashserv.pooled_client(self.server, **self.get_hashserv_creds()))
+                client.connect()
+            yield client
 
     def reset(self, data):
         self.__close_clients()
@@ -602,13 +709,12 @@ class SignatureGeneratorUniHashMixIn(object):
         return super().exit()
 
     def __close_clients(self):
+        # Idle pooled connections keep the server from shutting down cleanly.
+        # Other users of the pool (e.g. the PR service) keep theirs
         with self._client_env():
-            if getattr(self, '_client', None) is not None:
-                self._client.close()
-                self._client = None
-            if getattr(self, '_client_pool', None) is not None:
-                self._client_pool.close()
-                self._client_pool = None
+            hashserv.close_pooled_clients(self.server, **self.get_hashserv_creds())
+        if self.local_cache is not None:
+            self.local_cache.close()
 
     def get_stampfile_hash(self, tid):
         if tid in self.taskhash:
@@ -622,6 +728,11 @@ class SignatureGeneratorUniHashMixIn(object):
         return super().get_stampfile_hash(tid)
 
     def set_unihash(self, tid, unihash):
+        self._set_unihash(tid, unihash)
+        if self.local_cache:
+            self.local_cache.set(self.server, [(self._get_method(tid), self.taskhash[tid], unihash)])
+
+    def _set_unihash(self, tid, unihash):
         (mc, fn, taskname, taskfn) = bb.runqueue.split_tid_mcfn(tid)
         key = mc + ":" + self.tidtopn[tid] + ":" + taskname
         self.unitaskhashes[key] = (self.taskhash[tid], unihash)
@@ -697,6 +808,65 @@ class SignatureGeneratorUniHashMixIn(object):
         For a iterable of tids, returns a dictionary that maps each tid to a
         unihash
         """
+        result, query_tids = self._get_cached_unihashes(tids)
+
+        unihashes = []
+        if query_tids:
+            try:
+                unihashes = self._query_unihashes(query_tids)
+            except (ConnectionError, FileNotFoundError, EOFError) as e:
+                bb.warn('Error contacting Hash Equivalence Server %s: %s' % (self.server, str(e)))
+
+        self._set_queried_unihashes(result, query_tids, unihashes)
+        return result
+
+    def get_unihashes_async(self, tids):
+        """
+        As get_unihashes() but any server query runs in a separate thread
+        so the caller can do other work (other than using the hash
+        equivalence client) meanwhile. Returns a function which waits for
+        and returns the dictionary of results.
+        """
+        result, query_tids = self._get_cached_unihashes(tids)
+        unihashes = []
+        error = None
+        thread = None
+        stack = contextlib.ExitStack()
+
+        def query(client, queries):
+            nonlocal unihashes, error
+            try:
+                unihashes = client.get_unihash_batch(queries)
+            except BaseException as e:
+                error = e
+
+        if query_tids:
+            queries = [(self._get_method(tid), self.taskhash[tid]) for tid in query_tids]
+            try:
+                client = stack.enter_context(self.connected_client())
+            except (ConnectionError, FileNotFoundError, EOFError) as e:
+                error = e
+            else:
+                thread = threading.Thread(target=query, args=(client, queries), name="UnihashQuery")
+                thread.start()
+
+        def finish():
+            if thread:
+                thread.join()
+                if error is not None:
+                    stack.__exit__(type(error), error, error.__traceback__)
+                else:
+                    stack.close()
+            if isinstance(error, (ConnectionError, FileNotFoundError, EOFError)):
+                bb.warn('Error contacting Hash Equivalence Server %s: %s' % (self.server, str(error)))
+            elif error is not None:
+                raise error
+            self._set_queried_unihashes(result, query_tids, unihashes)
+            return result
+
+        return finish
+
+    def _get_cached_unihashes(self, tids):
         result = {}
         query_tids = []
 
@@ -707,14 +877,28 @@ class SignatureGeneratorUniHashMixIn(object):
             else:
                 query_tids.append(tid)
 
-        if query_tids:
-            unihashes = []
-            try:
-                with self.client() as client:
-                    unihashes = client.get_unihash_batch((self._get_method(tid), self.taskhash[tid]) for tid in query_tids)
-            except (ConnectionError, FileNotFoundError, EOFError) as e:
-                bb.warn('Error contacting Hash Equivalence Server %s: %s' % (self.server, str(e)))
+        if self.local_cache and query_tids:
+            cached = self.local_cache.get(self.server, ((self._get_method(tid), self.taskhash[tid]) for tid in query_tids))
+            remaining = []
+            for tid in query_tids:
+                key = (self._get_method(tid), self.taskhash[tid])
+                if key not in cached:
+                    remaining.append(tid)
+                    continue
+                unihash = cached[key] or self.taskhash[tid]
+                hashequiv_logger.debug2('Using locally cached unihash %s for %s:%s' % (unihash, tid, self.taskhash[tid]))
+                self._set_unihash(tid, unihash)
+                result[tid] = unihash
+            query_tids = remaining
+
+        return result, query_tids
+
+    def _query_unihashes(self, query_tids):
+        with self.client() as client:
+            return client.get_unihash_batch((self._get_method(tid), self.taskhash[tid]) for tid in query_tids)
 
+    def _set_queried_unihashes(self, result, query_tids, unihashes):
+        cache_entries = []
         for idx, tid in enumerate(query_tids):
             # In the absence of being able to discover a unique hash from the
             # server, make it be equivalent to the taskhash. The unique "hash" only
@@ -742,11 +926,15 @@ class SignatureGeneratorUniHashMixIn(object):
                 hashequiv_logger.debug2('No reported unihash for %s:%s from %s' % (tid, taskhash, self.server))
                 unihash = taskhash
 
-            self.set_unihash(tid, unihash)
-            self.unihash[tid] = unihash
+            # Misses are only cached if the server actually answered
+            if unihashes:
+                cache_entries.append((self._get_method(tid), taskhash, unihashes[idx] or None))
+
+            self._set_unihash(tid, unihash)
             result[tid] = unihash
 
-        return result
+        if self.local_cache and cache_entries:
+            self.local_cache.set(self.server, cache_entries)
 
     def report_unihash(self, path, task, d):
         import importlib
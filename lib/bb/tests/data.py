@@ -234,6 +234,54 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(d.getVar("foo", False),
                          d.getVar("bar", False))
 
+    def test_unrelated_write_kept(self):
+        d = bb.data.init()
+        d.setVar("foo", "${bar} baz")
+        d.setVar("bar", "value of bar")
+        self.assertEqual(d.getVar("foo"), "value of bar baz")
+        d.setVar("other", "value of other")
+        d.setVarFlag("other", "flag", "value of flag")
+        self.assertIn("foo", d.expand_cache)
+        self.assertIn("bar", d.expand_cache)
+
+    def test_dependent_write_invalidated(self):
+        d = bb.data.init()
+        d.setVar("foo", "${bar} baz")
+        d.setVar("bar", "${qux}")
+        d.setVar("qux", "value of qux")
+        self.assertEqual(d.getVar("foo"), "value of qux baz")
+        d.setVar("qux", "second value of qux")
+        self.assertNotIn("foo", d.expand_cache)
+        self.assertEqual(d.getVar("foo"), "second value of qux baz")
+        d.setVar("bar:append", " more")
+        self.assertEqual(d.getVar("foo"), "second value of qux more baz")
+        d.setVar("foo:remove", "more")
+        self.assertEqual(d.getVar("foo"), "second value of qux  baz")
+        d.setVar("foo:remove", "${rem}")
+        d.setVar("rem", "baz")
+        self.assertEqual(d.getVar("foo"), "second value of qux  ")
+        d.setVar("rem", "qux")
+        self.assertEqual(d.getVar("foo"), "second value of   baz")
+
+    def test_override_write_invalidated(self):
+        d = bb.data.init()
+        d.setVar("OVERRIDES", "over")
+        d.setVar("foo", "${bar}")
+        d.setVar("bar", "value of bar")
+        self.assertEqual(d.getVar("foo"), "value of bar")
+        d.setVar("bar:over", "overridden bar")
+        self.assertEqual(d.getVar("foo"), "overridden bar")
+        d.delVar("bar:over")
+        self.assertEqual(d.getVar("foo"), "value of bar")
+
+    def test_python_write_invalidated(self):
+        d = bb.data.init()
+        d.setVar("foo", "${@d.getVar('bar' + 'qux')}")
+        d.setVar("barqux", "value of barqux")
+        self.assertEqual(d.getVar("foo"), "value of barqux")
+        d.setVar("barqux", "second value of barqux")
+        self.assertEqual(d.getVar("foo"), "second value of barqux")
+
 class TestConcat(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -618,6 +666,98 @@ class Serialize(unittest.TestCase):
         self.assertEqual(newd.getVar('HELLO'), 'world')
         self.assertEqual(newd.getVarFlag('HELLO', 'other'), 'planet')
 
+class Flatten(unittest.TestCase):
+    def setUp(self):
+        self.base = bb.data.init()
+        self.base.setVar("FOO", "foo")
+        self.base.setVar("BAR", "bar")
+        middle = bb.data.createCopy(self.base)
+        middle.setVar("BAR", "middle bar")
+        self.d = bb.data.createCopy(middle)
+        self.d.flatten()
+
+    def test_lookup(self):
+        self.assertEqual(self.d.getVar("FOO"), "foo")
+        self.assertEqual(self.d.getVar("BAR"), "middle bar")
+        self.assertEqual(self.d.getVar("UNSET"), None)
+        self.assertIn("FOO", self.d._lookupmemo)
+
+    def test_copy_on_write(self):
+        self.assertEqual(self.d.getVar("FOO"), "foo")
+        self.d.setVar("FOO", "new foo")
+        self.d.setVarFlag("BAR", "flag", "value")
+        self.assertEqual(self.d.getVar("FOO"), "new foo")
+        self.assertEqual(self.base.getVar("FOO"), "foo")
+        self.assertEqual(self.base.getVarFlag("BAR", "flag"), None)
+
+    def test_parent_changes(self):
+        self.assertEqual(self.d.getVar("FOO", False), "foo")
+        self.assertEqual(self.d.getVar("UNSET", False), None)
+        self.base.setVar("UNSET", "set")
+        self.base.setVar("FOO", "second foo")
+        self.assertEqual(self.d.getVar("UNSET", False), "set")
+        self.assertEqual(self.d.getVar("FOO", False), "second foo")
+        self.base.delVar("FOO")
+        self.assertEqual(self.d.getVar("FOO", False), None)
+
+    def test_copy(self):
+        self.assertEqual(self.d.getVar("BAR"), "middle bar")
+        newd = bb.data.createCopy(self.d)
+        self.assertEqual(newd.getVar("BAR"), "middle bar")
+        newd.setVar("BAR", "new bar")
+        self.assertEqual(newd.getVar("BAR"), "new bar")
+        self.assertEqual(self.d.getVar("BAR"), "middle bar")
+        self.assertCountEqual(newd.keys(), ["FOO", "BAR"])
+
+    def test_dead_parent(self):
+        base = bb.data.init()
+        base.setVar("FOO", "foo")
+        d = bb.data.createCopy(bb.data.createCopy(base))
+        d.flatten()
+        self.assertEqual(d.getVar("FOO", False), "foo")
+        base.setVar("FOO:append", " bar")
+        base.delVar("FOO")
+        self.assertEqual(d.getVar("FOO", False), None)
+
+    def test_pickle(self):
+        import pickle
+        self.assertEqual(self.d.getVar("BAR"), "middle bar")
+        newd = pickle.loads(pickle.dumps(self.d))
+        self.assertEqual(newd.getVar("FOO"), "foo")
+        self.assertEqual(newd.getVar("BAR"), "middle bar")
+
+class RecipeCopies(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("PN", "${@bb.parse.vars_from_file(d.getVar('FILE', False),d)[0] or 'defaultpkgname'}")
+        self.d.setVar("OVERRIDES", "linux:pn-${PN}")
+        self.d.setVar("FOO", "${BAR} foo")
+        self.d.setVar("BAR", "bar")
+        self.d.setVar("BAR:linux", "linux bar")
+        self.d.setVar("BAR:pn-a", "a bar")
+        self.d.flatten()
+
+    def recipe(self, fn):
+        d = bb.data.createCopy(self.d)
+        d.setVar("FILE", fn)
+        return d
+
+    def test_file_overrides(self):
+        self.assertEqual(self.d.getVar("FOO"), "linux bar foo")
+        a = self.recipe("/recipes/a_1.0.bb")
+        b = self.recipe("/recipes/b_1.0.bb")
+        self.assertEqual(a.getVar("OVERRIDES"), "linux:pn-a")
+        self.assertEqual(a.getVar("FOO"), "a bar foo")
+        self.assertEqual(b.getVar("OVERRIDES"), "linux:pn-b")
+        self.assertEqual(b.getVar("FOO"), "linux bar foo")
+        self.assertEqual(self.d.getVar("FOO"), "linux bar foo")
+
+    def test_file_changes(self):
+        d = self.recipe("/recipes/b_1.0.bb")
+        self.assertEqual(d.getVar("FOO"), "linux bar foo")
+        d.setVar("FILE", "/recipes/a_1.0.bb")
+        self.assertEqual(d.getVar("FOO"), "a bar foo")
+
 class EmitVar(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
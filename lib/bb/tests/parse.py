@@ -60,6 +60,64 @@ C = "3"
             with self.assertRaises(bb.parse.ParseError):
                 d = bb.parse.handle(f.name, self.d)['']
 
+    def test_statement_cache(self):
+        handler = bb.parse.BBHandler
+        origcache = handler.statementcache
+        self.addCleanup(setattr, handler, "statementcache", origcache)
+
+        def get_statements(fn):
+            handler.cached_statements.pop(fn, None)
+            d = bb.data.init()
+            handler.get_statements(fn, fn, os.path.basename(fn)).eval(d)
+            return d
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, "test.inc")
+            with open(fn, "w") as f:
+                f.write(self.testfile)
+            bb.parse.update_mtime(fn)
+
+            handler.statementcache = handler.StatementCache()
+            handler.statement_cache_init(tempdir)
+            self.assertEqual(get_statements(fn).getVar("A"), "1")
+            handler.statement_cache_save()
+            handler.statement_cache_savemerge()
+
+            handler.statementcache = handler.StatementCache()
+            handler.statement_cache_init(tempdir)
+            self.assertFalse(handler.statementcache.loaded)
+            self.assertEqual(get_statements(fn).getVar("A"), "1")
+            self.assertTrue(handler.statementcache.loaded)
+            self.assertFalse(any(handler.statementcache.cachedata_extras))
+
+            with open(fn, "w") as f:
+                f.write(self.testfile.replace('A = "1"', 'A = "10"'))
+            bb.parse.update_mtime(fn)
+            self.assertEqual(get_statements(fn).getVar("A"), "10")
+            self.assertTrue(any(handler.statementcache.cachedata_extras))
+
+            # Recipes are cached on disk too
+            recipe = os.path.join(tempdir, "test.bb")
+            with open(recipe, "w") as f:
+                f.write(self.testfile)
+            bb.parse.update_mtime(recipe)
+            self.assertEqual(get_statements(recipe).getVar("A"), "1")
+            self.assertNotIn(recipe, handler.cached_statements)
+            handler.statement_cache_save()
+            handler.statement_cache_savemerge()
+            self.assertIn(recipe, handler.statementcache.cachedata[0])
+
+            # Files which have gone are dropped when the caches are merged
+            os.remove(recipe)
+            handler.statementcache = handler.StatementCache()
+            handler.statement_cache_init(tempdir)
+            handler.statement_cache_savemerge()
+            handler.statementcache = handler.StatementCache()
+            handler.statement_cache_init(tempdir)
+            handler.statementcache.load()
+            self.assertNotIn(recipe, handler.statementcache.cachedata[0])
+            self.assertIn(fn, handler.statementcache.cachedata[0])
+
     unsettest = """
 A = "1"
 B = "2"
@@ -7,7 +7,10 @@
 #
 
 import unittest
+import glob
 import os
+import pickle
+import re
 import tempfile
 import subprocess
 import sys
@@ -26,7 +29,7 @@ class RunQueueTests(unittest.TestCase):
     a1_sstatevalid = "a1:do_package a1:do_package_qa a1:do_packagedata a1:do_package_write_ipk a1:do_package_write_rpm a1:do_populate_lic a1:do_populate_sysroot"
     b1_sstatevalid = "b1:do_package b1:do_package_qa b1:do_packagedata b1:do_package_write_ipk b1:do_package_write_rpm b1:do_populate_lic b1:do_populate_sysroot"
 
-    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False):
+    def run_bitbakecmd(self, cmd, builddir, sstatevalid="", slowtasks="", extraenv=None, cleanup=False, allowfailure=False, retoutput=False):
         env = os.environ.copy()
         env["BBPATH"] = os.path.realpath(os.path.join(os.path.dirname(__file__), "runqueue-tests"))
         env["BB_ENV_PASSTHROUGH_ADDITIONS"] = "SSTATEVALID SLOWTASKS TOPDIR"
@@ -51,6 +54,8 @@ class RunQueueTests(unittest.TestCase):
                 tasks = [line.rstrip() for line in f]
             if cleanup:
                 os.remove(tasklog)
+        if retoutput:
+            return tasks, output
         return tasks
 
     def test_no_setscenevalid(self):
@@ -63,6 +68,66 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_schedulers(self):
+        for scheduler in ["basic", "speed", "completion"]:
+            with self.subTest(scheduler=scheduler), tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+                cmd = ["bitbake", "a1", "b1"]
+                extraenv = {
+                    "BB_SCHEDULER" : scheduler
+                }
+                tasks = self.run_bitbakecmd(cmd, tempdir, "", extraenv=extraenv)
+                expected = ['a1:' + x for x in self.alltasks] + ['b1:' + x for x in self.alltasks]
+                self.assertEqual(set(tasks), set(expected))
+                self.assertEqual(len(tasks), len(expected))
+
+                self.shutdown(tempdir)
+
+    def test_worker_recipe_cache(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            cmd = ["bitbake", "-D", "a1", "b1"]
+            extraenv = {
+                "BB_WORKER_RECIPE_CACHE_SIZE" : "2"
+            }
+            sstatevalid = "a1:do_package"
+            tasks, output = self.run_bitbakecmd(cmd, tempdir, sstatevalid, extraenv=extraenv, retoutput=True)
+            expected = ['a1:package_setscene'] + ['a1:' + x for x in self.alltasks if x != 'package'] + ['b1:' + x for x in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+
+            # Each recipe is parsed once and all of its tasks reuse that datastore
+            setups = re.findall(r"Task \S+ setup took \S+ \((.*?)\)", output)
+            self.assertEqual(setups, ["cached datastore"] * len(tasks))
+            for recipe in ["a1", "b1"]:
+                self.assertEqual(len(re.findall(r"Parsing \S+/%s\.bb \(full\)" % recipe, output)), 1)
+
+            self.shutdown(tempdir)
+
+    def test_parse_times(self):
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            recipe = os.path.realpath(os.path.join(os.path.dirname(__file__), "runqueue-tests", "recipes", "a1.bb"))
+            parsetimes = tempdir + "/cache/bb_parsetimes.dat"
+            self.run_bitbakecmd(["bitbake", "-p"], tempdir)
+            with open(parsetimes, "rb") as f:
+                times, version = pickle.load(f)
+            self.assertIn(recipe, times)
+
+            # Reparsing starts with the recipes which took longest, seed times
+            # which don't match the alphabetical order
+            expected = sorted(times, reverse=True)
+            seeded = dict((fn, float(i)) for i, fn in enumerate(reversed(expected)))
+            with open(parsetimes, "wb") as f:
+                pickle.dump([seeded, version], f)
+            for f in glob.glob(tempdir + "/cache/bb_cache.dat*"):
+                os.remove(f)
+            extraenv = {"BB_NUMBER_PARSE_THREADS": "1"}
+            _, output = self.run_bitbakecmd(["bitbake", "-p", "-D"], tempdir, extraenv=extraenv, retoutput=True)
+            parsed = re.findall(r"Parsing (/\S+)$", output, re.MULTILINE)
+            self.assertEqual(parsed, expected)
+            with open(parsetimes, "rb") as f:
+                newtimes, _ = pickle.load(f)
+            self.assertEqual(set(times), set(newtimes))
+
+            self.shutdown(tempdir)
+
     def test_single_setscenevalid(self):
         with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
             cmd = ["bitbake", "a1"]
@@ -325,6 +390,33 @@ class RunQueueTests(unittest.TestCase):
 
             self.shutdown(tempdir)
 
+    def test_memres_rebuild(self):
+        # A memory resident server reuses the task graph between builds
+        with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
+            extraenv = {
+                "BB_SERVER_TIMEOUT" : "60",
+                "BB_SIGNATURE_HANDLER" : "basichash",
+            }
+            tasks = self.run_bitbakecmd(["bitbake", "a1"], tempdir, "", extraenv=extraenv, cleanup=True)
+            expected = ["a1:%s" % t for t in self.alltasks]
+            self.assertEqual(set(tasks), set(expected))
+
+            tasks, output = self.run_bitbakecmd(["bitbake", "a1", "-v"], tempdir, "", extraenv=extraenv, cleanup=True, retoutput=True)
+            self.assertEqual(set(tasks), set())
+            self.assertIn("Reusing the task dependency graph from the previous build", output)
+
+            tasks = self.run_bitbakecmd(["bitbake", "a1", "-c", "compile", "-f"], tempdir, "", extraenv=extraenv, cleanup=True)
+            self.assertEqual(set(tasks), set(["a1:compile"]))
+
+            rerun_tasks = self.alltasks[:]
+            for x in ("fetch", "unpack", "patch", "prepare_recipe_sysroot", "configure", "compile"):
+                rerun_tasks.remove(x)
+            tasks = self.run_bitbakecmd(["bitbake", "a1"], tempdir, "", extraenv=extraenv, cleanup=True)
+            self.assertEqual(set(tasks), set(["a1:%s" % t for t in rerun_tasks]))
+
+            self.run_bitbakecmd(["bitbake", "-m"], tempdir, "", extraenv=extraenv)
+            self.shutdown(tempdir)
+
     def test_hashserv_single(self):
         with tempfile.TemporaryDirectory(prefix="runqueuetest") as tempdir:
             extraenv = {
@@ -408,3 +500,270 @@ class RunQueueTests(unittest.TestCase):
         while (os.path.exists(tempdir + "/hashserve.sock") or os.path.exists(tempdir + "cache/hashserv.db-wal") or os.path.exists(tempdir + "/bitbake.lock")):
             time.sleep(0.5)
 
+
+class SchedulerTests(unittest.TestCase):
+
+    def make_scheduler(self, tids, number_threads={}, stamps={}):
+        import types
+        import unittest.mock
+        import bb.runqueue
+
+        class Config:
+            def getVarFlag(self, var, flag):
+                return number_threads.get(var)
+
+        rqdata = types.SimpleNamespace(runtaskentries=dict((tid, None) for tid in tids))
+        self.rq = types.SimpleNamespace(runq_buildable=set(tids), runq_running=set(), runq_complete=set(),
+                                        holdoff_tasks=set(), tasks_covered=set(), tasks_notcovered=set(tids),
+                                        build_stamps={}, cfgData=Config(), stats=types.SimpleNamespace(active=0),
+                                        max_cpu_pressure=None, max_io_pressure=None, max_memory_pressure=None,
+                                        max_loadfactor=None)
+
+        def stampfile_mcfn(taskname, taskfn, extrainfo=True):
+            return stamps.get(taskfn + ":" + taskname, taskfn + "." + taskname)
+
+        with unittest.mock.patch("bb.parse.siggen", types.SimpleNamespace(stampfile_mcfn=stampfile_mcfn), create=True):
+            return bb.runqueue.RunQueueScheduler(self.rq, rqdata)
+
+    def start(self, sched, tid):
+        self.rq.runq_running.add(tid)
+        self.rq.build_stamps[tid] = sched.stamps[tid]
+
+    def finish(self, sched, tid):
+        self.rq.runq_complete.add(tid)
+        sched.stamp_released(self.rq.build_stamps.pop(tid))
+        sched.task_finished(tid)
+
+    def test_holdoff(self):
+        sched = self.make_scheduler(["a.bb:do_fetch", "b.bb:do_fetch"])
+        self.rq.holdoff_tasks.add("a.bb:do_fetch")
+        self.assertEqual(sched.next_buildable_task(), "b.bb:do_fetch")
+        self.start(sched, "b.bb:do_fetch")
+        self.assertIsNone(sched.next_buildable_task())
+        self.assertEqual(sched.held, {"a.bb:do_fetch"})
+
+        self.rq.holdoff_tasks.clear()
+        sched.holdoff_changed()
+        self.assertEqual(sched.next_buildable_task(), "a.bb:do_fetch")
+
+    def test_number_threads(self):
+        sched = self.make_scheduler(["a.bb:do_compile", "b.bb:do_compile", "c.bb:do_fetch"], number_threads={"do_compile": "1"})
+        self.assertEqual(sched.next_buildable_task(), "a.bb:do_compile")
+        self.start(sched, "a.bb:do_compile")
+        self.assertEqual(sched.next_buildable_task(), "c.bb:do_fetch")
+        self.start(sched, "c.bb:do_fetch")
+        self.assertIsNone(sched.next_buildable_task())
+
+        # Another task finishing doesn't free up a do_compile slot
+        self.finish(sched, "c.bb:do_fetch")
+        self.assertIsNone(sched.next_buildable_task())
+
+        self.finish(sched, "a.bb:do_compile")
+        self.assertEqual(sched.next_buildable_task(), "b.bb:do_compile")
+
+    def test_stamp_clash(self):
+        sched = self.make_scheduler(["a.bb:do_fetch", "b.bb:do_fetch"], stamps={"b.bb:do_fetch": "a.bb.do_fetch"})
+        self.assertEqual(sched.next_buildable_task(), "a.bb:do_fetch")
+        self.start(sched, "a.bb:do_fetch")
+        self.assertIsNone(sched.next_buildable_task())
+        self.assertEqual(sched.held_stamps, {"a.bb.do_fetch": {"b.bb:do_fetch"}})
+
+        self.finish(sched, "a.bb:do_fetch")
+        self.assertEqual(sched.next_buildable_task(), "b.bb:do_fetch")
+
+class ScenequeueDataTests(unittest.TestCase):
+
+    def reference_scenequeue_data(self, runtaskentries, setscene_tids, target_tids):
+        # The set based computation build_scenequeue_data() used before the
+        # graph was numbered
+        sq_revdeps = {}
+        sq_revdeps_squash = {}
+        sq_collated_deps = {}
+
+        cantskip = set(target_tids).difference(setscene_tids)
+
+        endpoints = {}
+        for tid in runtaskentries:
+            sq_revdeps[tid] = set(runtaskentries[tid].revdeps)
+            sq_revdeps_squash[tid] = set()
+            if not sq_revdeps[tid] and tid not in setscene_tids:
+                endpoints[tid] = set()
+
+        for tid in setscene_tids:
+            sq_collated_deps[tid] = set()
+            for dep in runtaskentries[tid].depends:
+                sq_revdeps[dep].discard(tid)
+                endpoints.setdefault(dep, set()).add(tid)
+
+        while endpoints:
+            newendpoints = {}
+            for point, task in endpoints.items():
+                tasks = task | sq_revdeps_squash[point]
+                if point not in setscene_tids:
+                    for t in tasks:
+                        sq_collated_deps[t].add(point)
+                sq_revdeps_squash[point] = set()
+                if point in setscene_tids:
+                    sq_revdeps_squash[point] = tasks
+                    continue
+                for dep in runtaskentries[point].depends:
+                    sq_revdeps[dep].discard(point)
+                    sq_revdeps_squash[dep] |= tasks
+                    if not sq_revdeps[dep] and dep not in setscene_tids:
+                        newendpoints[dep] = task
+            endpoints = newendpoints
+
+        unskippable = set(tid for tid in runtaskentries if not runtaskentries[tid].revdeps)
+        unskippable |= cantskip
+        new = True
+        while new:
+            orig = unskippable.copy()
+            for tid in orig.difference(setscene_tids):
+                unskippable |= runtaskentries[tid].depends
+            new = unskippable != orig
+        buildable = set(tid for tid in unskippable.difference(setscene_tids) if not runtaskentries[tid].depends)
+
+        for tid in runtaskentries:
+            if tid not in setscene_tids:
+                self.assertFalse(sq_revdeps_squash[tid])
+                del sq_revdeps_squash[tid]
+
+        return sq_revdeps_squash, sq_collated_deps, unskippable, buildable
+
+    def make_graph(self, rand, numtasks):
+        import types
+
+        tids = ["/r%d.bb:do_task" % i for i in range(numtasks)]
+        runtaskentries = {}
+        for i, tid in enumerate(tids):
+            depends = set(rand.sample(tids[:i], rand.randint(0, min(i, 3))))
+            runtaskentries[tid] = types.SimpleNamespace(depends=depends, revdeps=set(), unihash="%064x" % i)
+        for tid in tids:
+            for dep in runtaskentries[tid].depends:
+                runtaskentries[dep].revdeps.add(tid)
+
+        setscene_tids = set(tid for tid in tids if rand.random() < 0.4)
+        target_tids = rand.sample(tids, rand.randint(1, min(numtasks, 3)))
+        return runtaskentries, setscene_tids, target_tids
+
+    def test_random_graphs(self):
+        import random
+        import types
+        import unittest.mock
+        import bb.progress
+        import bb.runqueue
+
+        siggen = types.SimpleNamespace(stampfile_mcfn=lambda taskname, taskfn, extrainfo=True: taskfn + "." + taskname)
+
+        for seed in range(200):
+            rand = random.Random(seed)
+            runtaskentries, setscene_tids, target_tids = self.make_graph(rand, rand.randint(1, 60))
+
+            rqdata = types.SimpleNamespace(
+                runtaskentries=runtaskentries,
+                runq_setscene_tids=setscene_tids,
+                target_tids=target_tids,
+                taskindex=bb.runqueue.TaskGraphIndex(runtaskentries, first=setscene_tids),
+                init_progress_reporter=bb.progress.DummyMultiStageProcessProgressReporter(),
+                taskData={"": types.SimpleNamespace(taskentries=dict((tid + "_setscene", types.SimpleNamespace(idepends=[])) for tid in setscene_tids), build_targets={})},
+                dataCaches={"": types.SimpleNamespace(pkg_fn=dict((bb.runqueue.fn_from_tid(tid), "r%d" % i) for i, tid in enumerate(runtaskentries)))})
+            buildable = set()
+            sqrq = types.SimpleNamespace(setbuildable=buildable.add, tasks_scenequeue_done=set(), sq_buildable=set())
+            sqdata = bb.runqueue.SQData()
+
+            with self.subTest(seed=seed), unittest.mock.patch("bb.parse.siggen", siggen, create=True):
+                bb.runqueue.build_scenequeue_data(sqdata, rqdata, sqrq)
+
+                sq_revdeps, sq_covered_tasks, unskippable, ref_buildable = self.reference_scenequeue_data(runtaskentries, setscene_tids, target_tids)
+                self.assertEqual(sqdata.sq_revdeps, sq_revdeps)
+                self.assertEqual(sqdata.sq_covered_tasks, sq_covered_tasks)
+                self.assertEqual(sqdata.unskippable, unskippable)
+                self.assertEqual(buildable, ref_buildable)
+                self.assertEqual(sqrq.tasks_scenequeue_done, unskippable.difference(setscene_tids))
+
+class RunQueuePipeTests(unittest.TestCase):
+
+    def setUp(self):
+        import types
+        import unittest.mock
+        import bb.runqueue
+
+        self.events = []
+        self.exitcodes = []
+
+        def runqueue_process_waitpid(task, status, fakerootlog=None):
+            self.exitcodes.append((task, status, fakerootlog))
+
+        patcher = unittest.mock.patch("bb.event.fire_from_worker", lambda event, d: self.events.append(event))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        r, self.pipeout = os.pipe()
+        pipein = os.fdopen(r, "rb", buffering=0)
+        self.addCleanup(pipein.close)
+        self.addCleanup(os.close, self.pipeout)
+
+        rq = types.SimpleNamespace(worker={}, fakeworker={}, teardown=False)
+        rqexec = types.SimpleNamespace(runqueue_process_waitpid=runqueue_process_waitpid, updated_taskhash_queue=[])
+        self.pipe = bb.runqueue.runQueuePipe(pipein, None, None, rq, rqexec)
+
+    def frame(self, msgtype, data):
+        import bb.runqueue
+
+        data = pickle.dumps(data)
+        return bb.runqueue.WORKER_FRAME_HEADER.pack(msgtype, len(data)) + data
+
+    def feed(self, data):
+        os.write(self.pipeout, data)
+        return self.pipe.read()
+
+    def test_partial_frames(self):
+        import bb.runqueue
+
+        data = self.frame(bb.runqueue.WORKER_FRAME_EVENT, "event1") + self.frame(bb.runqueue.WORKER_FRAME_EVENT, "event2")
+        first = bb.runqueue.WORKER_FRAME_HEADER.size + 4
+        second = len(data) - 3
+
+        # Split within the first frame's header
+        self.assertTrue(self.feed(data[:2]))
+        self.assertEqual(self.events, [])
+
+        # Split within the first frame's payload
+        self.assertTrue(self.feed(data[2:first]))
+        self.assertEqual(self.events, [])
+
+        # Complete the first frame and split the second
+        self.assertTrue(self.feed(data[first:second]))
+        self.assertEqual(self.events, ["event1"])
+
+        self.assertTrue(self.feed(data[second:]))
+        self.assertEqual(self.events, ["event1", "event2"])
+        self.assertEqual(len(self.pipe.queue), 0)
+
+        self.assertFalse(self.pipe.read())
+
+    def test_frame_and_tagged_event(self):
+        import bb.runqueue
+
+        data = self.frame(bb.runqueue.WORKER_FRAME_EVENT, "framed")
+        data += b"<event>" + pickle.dumps("tagged") + b"</event>"
+        data += self.frame(bb.runqueue.WORKER_FRAME_EVENT, "framed2")
+
+        self.assertTrue(self.feed(data))
+        self.assertEqual(self.events, ["framed", "tagged", "framed2"])
+        self.assertEqual(len(self.pipe.queue), 0)
+
+    def test_exitcode_frame(self):
+        import bb.runqueue
+
+        data = self.frame(bb.runqueue.WORKER_FRAME_EVENT, "event")
+        data += self.frame(bb.runqueue.WORKER_FRAME_EXITCODE, ("/a.bb:do_compile", 1))
+
+        # Hold back the last byte so only the event is complete
+        self.assertTrue(self.feed(data[:-1]))
+        self.assertEqual(self.events, ["event"])
+        self.assertEqual(self.exitcodes, [])
+
+        self.assertTrue(self.feed(data[-1:]))
+        self.assertEqual(self.exitcodes, [("/a.bb:do_compile", 1, None)])
+        self.assertEqual(len(self.pipe.queue), 0)
@@ -10,6 +10,7 @@ import unittest
 import logging
 import bb
 import bb.data
+import threading
 import time
 from contextlib import contextmanager
 
@@ -57,6 +58,123 @@ class SiggenTest(unittest.TestCase):
         self.assertEqual(siggen.unihash, {})
         self.assertEqual(siggen.unitaskhashes, {})
 
+    def test_get_unihashes_async_environment(self):
+        import os
+        import unittest.mock
+
+        calling_thread = threading.current_thread()
+        started = threading.Event()
+        proceed = threading.Event()
+        seen = {}
+
+        class TestClient:
+            def connect(self):
+                seen["connect"] = (threading.current_thread(), os.environ.get("BB_TEST_HASHSERV_PROXY"))
+
+            def get_unihash_batch(self, query):
+                seen["query"] = (threading.current_thread(), os.environ.get("BB_TEST_HASHSERV_PROXY"), list(query))
+                started.set()
+                proceed.wait(10)
+                return ["c" * 64]
+
+        @contextmanager
+        def pooled_client(addr, username=None, password=None):
+            yield TestClient()
+
+        class TestSiggen(bb.siggen.SignatureGeneratorUniHashMixIn):
+            def __init__(self):
+                self.server = "test-server"
+                self.method = "test-method"
+                self.extramethod = {}
+                self.username = None
+                self.password = None
+                self.env = {"BB_TEST_HASHSERV_PROXY": "proxy"}
+                self.local_cache = None
+                self.taskhash = {"test.bb:do_compile": "a" * 64}
+                self.unihash = {}
+                self.unitaskhashes = {}
+                self.tidtopn = {"test.bb:do_compile": "test"}
+                self.setscenetasks = set()
+
+        siggen = TestSiggen()
+        with unittest.mock.patch("hashserv.pooled_client", pooled_client):
+            finish = siggen.get_unihashes_async(["test.bb:do_compile"])
+            self.assertTrue(started.wait(10))
+            # The environment is only changed on this thread while connecting,
+            # not while the query is in flight
+            self.assertNotIn("BB_TEST_HASHSERV_PROXY", os.environ)
+            proceed.set()
+            self.assertEqual(finish(), {"test.bb:do_compile": "c" * 64})
+
+        self.assertEqual(seen["connect"], (calling_thread, "proxy"))
+        self.assertIsNot(seen["query"][0], calling_thread)
+        self.assertEqual(seen["query"][1:], (None, [("test-method", "a" * 64)]))
+
+    def test_get_unihashes_local_cache(self):
+        import tempfile
+
+        queries = []
+
+        class TestClient:
+            def get_unihash_batch(self, query):
+                query = list(query)
+                queries.append(query)
+                return ["c" * 64 if taskhash == "a" * 64 else None for method, taskhash in query]
+
+        class TestSiggen(bb.siggen.SignatureGeneratorUniHashMixIn):
+            def __init__(self, local_cache):
+                self.server = "test-server"
+                self.method = "test-method"
+                self.extramethod = {}
+                self.taskhash = {"test.bb:do_compile": "a" * 64, "test.bb:do_install": "b" * 64}
+                self.unihash = {}
+                self.unitaskhashes = {}
+                self.tidtopn = {"test.bb:do_compile": "test", "test.bb:do_install": "test"}
+                self.setscenetasks = set()
+                self.local_cache = local_cache
+
+            @contextmanager
+            def client(self):
+                yield TestClient()
+
+        tids = ["test.bb:do_compile", "test.bb:do_install"]
+        expected = {"test.bb:do_compile": "c" * 64, "test.bb:do_install": "b" * 64}
+
+        with tempfile.TemporaryDirectory(prefix="bitbake-siggen-") as tempdir:
+            path = tempdir + "/unihashes.db"
+
+            cache = bb.siggen.UnihashLocalCache(path, 3600, 3600)
+            self.assertEqual(TestSiggen(cache).get_unihashes(tids), expected)
+            self.assertEqual(len(queries), 1)
+            cache.close()
+
+            # Both the found unihash and the miss are answered from the cache
+            cache = bb.siggen.UnihashLocalCache(path, 3600, 3600)
+            self.assertEqual(TestSiggen(cache).get_unihashes(tids), expected)
+            self.assertEqual(len(queries), 1)
+            cache.close()
+
+            # Expired entries are queried again
+            cache = bb.siggen.UnihashLocalCache(path, 3600, 3600)
+            cache.negative_ttl = -1
+            cache.set("test-server", [("test-method", "b" * 64, None)])
+            self.assertEqual(TestSiggen(cache).get_unihashes(tids), expected)
+            self.assertEqual(queries[1], [("test-method", "b" * 64)])
+            cache.close()
+
+            # Different servers don't share entries
+            cache = bb.siggen.UnihashLocalCache(path, 3600, 3600)
+            siggen = TestSiggen(cache)
+            siggen.server = "other-server"
+            self.assertEqual(siggen.get_unihashes(tids), expected)
+            self.assertEqual(len(queries[2]), 2)
+
+            # The cache can be closed from another thread
+            thread = threading.Thread(target=cache.close)
+            thread.start()
+            thread.join()
+            self.assertIsNone(cache.db)
+
     def test_report_unihash_reads_bb_unihash_without_expansion(self):
         class TestSiggen(bb.siggen.SignatureGeneratorUniHashMixIn):
             def __init__(self):
@@ -10,7 +10,7 @@ import json
 import re
 from collections import namedtuple
 from urllib.parse import urlparse
-from bb.asyncrpc.client import parse_address, ADDR_TYPE_UNIX, ADDR_TYPE_WS
+from bb.asyncrpc.client import parse_address, ADDR_TYPE_UNIX, ADDR_TYPE_WS, client_pool
 
 __version__ = "2.19.0"
 
@@ -18,6 +18,15 @@ User = namedtuple("User", ("username", "permissions"))
 
 UNIHASH_REGEX = re.compile(r"^[0-9a-f]{64}$")
 
+# Database writes from concurrent clients are committed together in batches
+# of up to WRITE_BATCH_SIZE; all the writes that arrive while one batch is
+# being committed form the next one. While writes are arriving concurrently,
+# the database backends can additionally wait up to WRITE_BATCH_DELAY seconds
+# for more to join a batch, which may help if commits are very expensive, but
+# holds up the writer otherwise.
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_DELAY = 0
+
 
 def is_valid_unihash(value):
     return isinstance(value, str) and UNIHASH_REGEX.fullmatch(value) is not None
@@ -36,6 +45,9 @@ def create_server(
     admin_username=None,
     admin_password=None,
     reuseport=False,
+    cache_size=None,
+    backfill_workers=None,
+    upstream_prewarm=0,
 ):
     def sqlite_engine():
         from .sqlite import DatabaseEngine
@@ -57,6 +69,12 @@ def create_server(
     if anon_perms is None:
         anon_perms = server.DEFAULT_ANON_PERMS
 
+    if cache_size is None:
+        cache_size = server.DEFAULT_CACHE_SIZE
+
+    if backfill_workers is None:
+        backfill_workers = server.DEFAULT_BACKFILL_WORKERS
+
     s = server.Server(
         db_engine,
         upstream=upstream,
@@ -64,6 +82,9 @@ def create_server(
         anon_perms=anon_perms,
         admin_username=admin_username,
         admin_password=admin_password,
+        cache_size=cache_size,
+        backfill_workers=backfill_workers,
+        upstream_prewarm=upstream_prewarm,
     )
 
     (typ, a) = parse_address(addr)
@@ -97,6 +118,24 @@ def create_client(addr, username=None, password=None):
         raise e
 
 
+def pooled_client(addr, username=None, password=None):
+    """
+    Context manager borrowing a client connected (and authenticated) to addr
+    from the process wide connection pool, instead of connecting a new one
+    """
+    return client_pool.client(
+        ("hashserv", addr, username, password),
+        lambda: create_client(addr, username, password),
+    )
+
+
+def close_pooled_clients(addr, username=None, password=None):
+    """
+    Closes the idle connections to addr that pooled_client() keeps
+    """
+    client_pool.close(("hashserv", addr, username, password))
+
+
 async def create_async_client(addr, username=None, password=None):
     from . import client
 
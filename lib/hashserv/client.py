@@ -79,6 +79,7 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     MODE_GET_STREAM = 1
     MODE_EXIST_STREAM = 2
     MODE_MARK_STREAM = 3
+    MODE_REPORT_STREAM = 4
 
     def __init__(self, username=None, password=None):
         super().__init__("OEHASHEQUIV", "1.1", logger)
@@ -167,6 +168,8 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
             await normal_to_stream("exists-stream")
         elif new_mode == self.MODE_MARK_STREAM:
             await normal_to_stream("gc-mark-stream")
+        elif new_mode == self.MODE_REPORT_STREAM:
+            await normal_to_stream("report-stream")
         elif new_mode != self.MODE_NORMAL:
             raise Exception("Undefined mode transition {self.mode!r} -> {new_mode!r}")
 
@@ -191,6 +194,20 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
         m["unihash"] = unihash
         return await self.invoke({"report": m})
 
+    async def report_unihash_batch(self, reports):
+        """
+        Reports multiple output hashes using stream mode, so that many reports
+        can be in flight at once. `reports` is an iterable of dictionaries
+        with the same keys as the `report` message (i.e. "taskhash",
+        "method", "outhash", "unihash" and any extra data), and may be a
+        generator. Returns the list of responses, in order.
+        """
+        result = await self.send_stream_batch(
+            self.MODE_REPORT_STREAM,
+            (json.dumps(r) for r in reports),
+        )
+        return [json.loads(r) for r in result]
+
     async def report_unihash_equiv(self, taskhash, method, unihash, extra={}):
         m = extra.copy()
         m["taskhash"] = taskhash
@@ -223,6 +240,14 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
             }
         )
 
+    async def get_recent(self, limit):
+        """
+        Returns up to `limit` of the most recently reported unihashes of the
+        server, as a list of dictionaries with "method", "taskhash" and
+        "unihash" keys. The server may cap `limit`
+        """
+        return await self.invoke({"get-recent": {"limit": limit}})
+
     async def get_stats(self):
         return await self.invoke({"get-stats": None})
 
@@ -297,7 +322,7 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
     async def gc_status(self):
         return await self.invoke({"gc-status": {}})
 
-    async def gc_mark(self, mark, where):
+    async def gc_mark(self, mark, where, batch_size=None, delay=0):
         """
         Starts a new garbage collection operation identified by "mark". If
         garbage collection is already in progress with "mark", the collection
@@ -306,8 +331,17 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
         All unihash entries that match the "where" clause are marked to be
         kept. In addition, any new entries added to the database after this
         command will be automatically marked with "mark"
+
+        If "batch_size" is given, the entries are instead marked incrementally
+        by the server in the background, in batches of up to "batch_size"
+        entries, sleeping "delay" seconds between batches. The progress can be
+        followed with `gc_status`
         """
-        return await self.invoke({"gc-mark": {"mark": mark, "where": where}})
+        m = {"mark": mark, "where": where}
+        if batch_size is not None:
+            m["batch_size"] = batch_size
+            m["delay"] = delay
+        return await self.invoke({"gc-mark": m})
 
     async def gc_mark_stream(self, mark, rows):
         """
@@ -327,15 +361,22 @@ class AsyncClient(bb.asyncrpc.AsyncClient):
 
         return {"count": sum(int(json.loads(r)["count"]) for r in responses)}
 
-    async def gc_sweep(self, mark):
+    async def gc_sweep(self, mark, batch_size=None, delay=0):
         """
         Finishes garbage collection for "mark". All unihash entries that have
         not been marked will be deleted.
 
+        If "batch_size" is given, the entries are instead deleted incrementally
+        by the server in the background, as for `gc_mark`
+
         It is recommended to clean unused outhash entries after running this to
         cleanup any dangling outhashes
         """
-        return await self.invoke({"gc-sweep": {"mark": mark}})
+        m = {"mark": mark}
+        if batch_size is not None:
+            m["batch_size"] = batch_size
+            m["delay"] = delay
+        return await self.invoke({"gc-sweep": m})
 
 
 class Client(bb.asyncrpc.Client):
@@ -350,11 +391,13 @@ class Client(bb.asyncrpc.Client):
             "get_unihash",
             "get_unihash_batch",
             "report_unihash",
+            "report_unihash_batch",
             "report_unihash_equiv",
             "get_taskhash",
             "unihash_exists",
             "unihash_exists_batch",
             "get_outhash",
+            "get_recent",
             "get_stats",
             "reset_stats",
             "backfill_wait",
@@ -12,9 +12,12 @@ import os
 import base64
 import json
 import hashlib
+from collections import OrderedDict, deque
+import ctypes
 from . import create_async_client
 from . import is_valid_unihash
 import bb.asyncrpc
+from bb import multiprocessing
 
 logger = logging.getLogger("hashserv.server")
 
@@ -51,6 +54,33 @@ TOKEN_SIZE = 48
 
 SALT_SIZE = 8
 
+# Maximum number of taskhash -> unihash lookups kept in memory by the server
+DEFAULT_CACHE_SIZE = 100000
+
+# How often (in seconds) each worker of a multi-process server publishes its
+# statistics for the other workers to report
+STATS_PUBLISH_INTERVAL = 1
+
+# Lookups that miss the local database of a server with an upstream are sent
+# to the upstream in streamed batches of up to this many requests
+UPSTREAM_BATCH_SIZE = 1000
+
+# Number of concurrent tasks writing the unihashes pulled from the upstream
+# server back to the local database
+DEFAULT_BACKFILL_WORKERS = 4
+
+# An incremental garbage collection operation that hasn't recorded any progress
+# for this many seconds (on top of its delay between batches) is assumed to
+# have died along with the server running it
+GC_STALE_TIMEOUT = 60
+
+# Maximum number of rows a get-recent request returns, larger limits are capped
+MAX_RECENT_LIMIT = 100000
+
+# Maximum number of requests of a single stream that are handled concurrently
+# (e.g. while waiting on the upstream server)
+STREAM_PIPELINE_DEPTH = 1000
+
 
 class Measurement(object):
     def __init__(self, sample):
@@ -97,6 +127,8 @@ class Sample(object):
 
 
 class Stats(object):
+    STATE = ("num", "total_time", "max_time", "m", "s")
+
     def __init__(self):
         self.reset()
 
@@ -126,6 +158,32 @@ class Stats(object):
     def start_sample(self):
         return Sample(self)
 
+    def getstate(self):
+        return tuple(getattr(self, k) for k in self.STATE)
+
+    def setstate(self, state):
+        for k, v in zip(self.STATE, state):
+            setattr(self, k, v)
+
+    def merge(self, other):
+        """
+        Combine the samples of another Stats object into this one
+        """
+        if other.num == 0:
+            return
+
+        if self.num == 0:
+            self.setstate(other.getstate())
+            return
+
+        num = self.num + other.num
+        delta = other.m - self.m
+        self.s = self.s + other.s + delta * delta * self.num * other.num / num
+        self.m = self.m + delta * other.num / num
+        self.num = num
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+
     @property
     def average(self):
         if self.num == 0:
@@ -145,6 +203,221 @@ class Stats(object):
         }
 
 
+class UnihashCache(object):
+    """
+    Bounded LRU cache of (method, taskhash) -> unihash lookups shared by all
+    client connections of a server. Only positive answers are cached, and
+    since existing unihash mappings are never modified, entries only need to
+    be dropped when rows are removed from the database.
+    """
+
+    def __init__(self, size, generation=None):
+        self.size = size
+        self.entries = OrderedDict()
+        # Bumped whenever the cache is invalidated so that lookups racing
+        # with the invalidation don't add back stale entries. It may be in
+        # shared memory, in which case invalidating the cache of one worker
+        # process of a server invalidates it in all of them
+        if generation is None:
+            generation = multiprocessing.Value(ctypes.c_uint64, 0)
+        self.shared_generation = generation
+        self.generation = generation.value
+        self.reset_stats()
+
+    def _sync(self):
+        if self.generation != self.shared_generation.value:
+            self.generation = self.shared_generation.value
+            self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, method, taskhash):
+        self._sync()
+        key = (method, taskhash)
+        unihash = self.entries.get(key)
+        if unihash is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return unihash
+
+    def add(self, method, taskhash, unihash, generation):
+        if self.size <= 0 or generation != self.shared_generation.value:
+            return
+
+        key = (method, taskhash)
+        self.entries[key] = unihash
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, method, taskhash):
+        self.entries.pop((method, taskhash), None)
+
+    def clear(self):
+        with self.shared_generation.get_lock():
+            self.shared_generation.value += 1
+        self._sync()
+
+    def todict(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class UpstreamBatcher(object):
+    """
+    Coalesces the lookups made to the upstream server by all the client
+    connections of a server. The lookups queued while a batch is in flight are
+    sent together as the next batch, using the streaming batch functions of
+    the client, so that the upstream round trip latency is paid once per batch
+    instead of once per miss. Identical lookups in flight at the same time are
+    only sent once.
+
+    `func` is called as func(client, keys) and must return the list of
+    results for keys, in order.
+    """
+
+    def __init__(self, upstream, func, batch_size=UPSTREAM_BATCH_SIZE):
+        self.upstream = upstream
+        self.func = func
+        self.batch_size = batch_size
+        self.pending = {}
+        self.queued = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self, loop):
+        self.task = loop.create_task(self.run())
+
+    def _restart(self):
+        # run() only returns if connecting to or talking to the upstream
+        # server failed, reconnect for the new lookups
+        if not self.task.cancelled() and self.task.exception() is not None:
+            logger.warning("Upstream lookups failed, reconnecting: %s", self.task.exception())
+        self.start(asyncio.get_running_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def lookup(self, key):
+        if self.task is not None and self.task.done():
+            self._restart()
+
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            self.queued.append(key)
+            self.wakeup.set()
+
+        # Don't let a client going away cancel the lookup for the others
+        # waiting on it
+        return await asyncio.shield(future)
+
+    def _finish(self, keys, results=None, exception=None):
+        for idx, key in enumerate(keys):
+            future = self.pending.pop(key)
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+                # All the waiters may have gone away already
+                future.exception()
+            else:
+                future.set_result(results[idx])
+
+    async def run(self):
+        keys = []
+        try:
+            async with await create_async_client(self.upstream) as client:
+                while True:
+                    await self.wakeup.wait()
+                    self.wakeup.clear()
+
+                    while self.queued:
+                        keys = self.queued[: self.batch_size]
+                        del self.queued[: self.batch_size]
+
+                        try:
+                            results = await self.func(client, keys)
+                        except Exception as e:
+                            self._finish(keys, exception=e)
+                        else:
+                            self._finish(keys, results)
+                        keys = []
+        finally:
+            e = bb.asyncrpc.ServerError("Upstream lookups stopped")
+            self._finish(keys + self.queued, exception=e)
+            self.queued = []
+
+
+class WorkerStats(object):
+    """
+    Statistics of all the workers of a multi-process server, kept in shared
+    memory so that whichever worker handles a get-stats request can report
+    the totals. Each worker only ever writes its own slot.
+    """
+
+    CACHE_STATE = ("size", "max_size", "hits", "misses")
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.slot_size = len(Stats.STATE) + len(self.CACHE_STATE)
+        self.values = multiprocessing.RawArray("d", num_workers * self.slot_size)
+        # Bumped by reset-stats so that every worker resets its own counters
+        self.reset_count = multiprocessing.Value(ctypes.c_uint64, 0)
+
+    def publish(self, index, request_stats, cache):
+        base = index * self.slot_size
+        cache_stats = cache.todict()
+        state = request_stats.getstate() + tuple(
+            cache_stats[k] for k in self.CACHE_STATE
+        )
+        self.values[base : base + self.slot_size] = state
+
+    def reset(self):
+        with self.reset_count.get_lock():
+            self.reset_count.value += 1
+        self.values[:] = [0] * len(self.values)
+
+    def todict(self):
+        requests = Stats()
+        cache = dict.fromkeys(self.CACHE_STATE, 0)
+        num_requests = len(Stats.STATE)
+
+        for index in range(self.num_workers):
+            base = index * self.slot_size
+            state = self.values[base : base + self.slot_size]
+
+            s = Stats()
+            s.setstate(state[:num_requests])
+            s.num = int(s.num)
+            requests.merge(s)
+
+            for k, v in zip(self.CACHE_STATE, state[num_requests:]):
+                cache[k] += int(v)
+
+        return {
+            "requests": requests.todict(),
+            "cache": cache,
+            "workers": self.num_workers,
+        }
+
+
 token_refresh_semaphore = asyncio.Lock()
 
 
@@ -240,6 +513,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
             {
                 "get": self.handle_get,
                 "get-outhash": self.handle_get_outhash,
+                "get-recent": self.handle_get_recent,
                 "get-stream": self.handle_get_stream,
                 "exists-stream": self.handle_exists_stream,
                 "get-stats": self.handle_get_stats,
@@ -248,6 +522,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 # Not always read-only, but internally checks if the server is
                 # read-only
                 "report": self.handle_report,
+                "report-stream": self.handle_report_stream,
                 "auth": self.handle_auth,
                 "get-user": self.handle_get_user,
                 "get-all-users": self.handle_get_all_users,
@@ -345,16 +620,30 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 d = await self.upstream_client.get_taskhash(method, taskhash, True)
                 await self.update_unified(d)
         else:
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                d = {k: row[k] for k in row.keys()}
+            if unihash is not None:
+                d = {"taskhash": taskhash, "method": method, "unihash": unihash}
             elif self.upstream_client is not None:
                 d = await self.upstream_client.get_taskhash(method, taskhash)
                 await self.insert_unihash(d["method"], d["taskhash"], d["unihash"])
 
         return d
 
+    async def get_equivalent(self, method, taskhash):
+        cache = self.server.unihash_cache
+        unihash = cache.get(method, taskhash)
+        if unihash is not None:
+            return unihash
+
+        generation = cache.generation
+        row = await self.db.get_equivalent(method, taskhash)
+        if row is None:
+            return None
+
+        cache.add(method, taskhash, row["unihash"], generation)
+        return row["unihash"]
+
     @permissions(READ_PERM)
     async def handle_get_outhash(self, request):
         method = request["method"]
@@ -364,6 +653,15 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
         return await self.get_outhash(method, outhash, taskhash, with_unihash)
 
+    @permissions(READ_PERM)
+    async def handle_get_recent(self, request):
+        limit = request["limit"]
+        if not isinstance(limit, int) or limit < 0:
+            raise bb.asyncrpc.InvokeError("Bad limit %r" % limit)
+
+        rows = await self.db.get_recent_unihashes(min(limit, MAX_RECENT_LIMIT))
+        return [{k: row[k] for k in row.keys()} for row in rows]
+
     async def get_outhash(self, method, outhash, taskhash, with_unihash=True):
         d = None
         if with_unihash:
@@ -388,6 +686,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
     async def insert_unihash(self, method, taskhash, unihash):
         validate_unihash(unihash)
+        self.server.unihash_cache.discard(method, taskhash)
         return await self.db.insert_unihash(method, taskhash, unihash)
 
     async def _stream_handler(self, handler):
@@ -421,25 +720,83 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         await self.socket.send("ok")
         return self.NO_RESPONSE
 
+    async def _pipelined_stream_handler(self, handler):
+        """
+        Like _stream_handler(), except that the requests are handled
+        concurrently, so that a stream doesn't have to wait for each request
+        that needs a round trip to the upstream server before handling the
+        next one. The responses are still sent in the order of the requests.
+        """
+        await self.socket.send_message("ok")
+
+        async def handle(l):
+            sample = self.server.request_stats.start_sample()
+            measure = sample.measure()
+            measure.start()
+            try:
+                return await handler(l)
+            finally:
+                measure.end()
+                sample.end()
+
+        pending = deque()
+        recv_task = None
+        try:
+            while True:
+                if recv_task is None and len(pending) < STREAM_PIPELINE_DEPTH:
+                    recv_task = asyncio.ensure_future(self.socket.recv())
+
+                wait = set()
+                if pending:
+                    wait.add(pending[0])
+                if recv_task is not None:
+                    wait.add(recv_task)
+                await asyncio.wait(wait, return_when=asyncio.FIRST_COMPLETED)
+
+                while pending and pending[0].done():
+                    await self.socket.send(pending.popleft().result())
+
+                if recv_task is not None and recv_task.done():
+                    l = recv_task.result()
+                    recv_task = None
+                    if not l or l == "END":
+                        break
+                    pending.append(asyncio.ensure_future(handle(l)))
+
+            while pending:
+                await self.socket.send(await pending.popleft())
+        finally:
+            if recv_task is not None:
+                recv_task.cancel()
+            for t in pending:
+                t.cancel()
+
+        await self.socket.send("ok")
+        return self.NO_RESPONSE
+
     @permissions(READ_PERM)
     async def handle_get_stream(self, request):
         async def handler(l):
             (method, taskhash) = l.split()
             # self.logger.debug('Looking up %s %s' % (method, taskhash))
-            row = await self.db.get_equivalent(method, taskhash)
+            unihash = await self.get_equivalent(method, taskhash)
 
-            if row is not None:
-                # self.logger.debug('Found equivalent task %s -> %s', (row['taskhash'], row['unihash']))
-                return row["unihash"]
+            if unihash is not None:
+                # self.logger.debug('Found equivalent task %s -> %s', (taskhash, unihash))
+                return unihash
 
             if self.upstream_client is not None:
-                upstream = await self.upstream_client.get_unihash(method, taskhash)
+                upstream = await self.server.upstream_unihashes.lookup(
+                    (method, taskhash)
+                )
                 if upstream:
-                    await self.server.backfill_queue.put((method, taskhash))
+                    await self.server.backfill_queue.put((method, taskhash, upstream))
                     return upstream
 
             return ""
 
+        if self.upstream_client is not None:
+            return await self._pipelined_stream_handler(handler)
         return await self._stream_handler(handler)
 
     @permissions(READ_PERM)
@@ -449,11 +806,13 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 return "true"
 
             if self.upstream_client is not None:
-                if await self.upstream_client.unihash_exists(l):
+                if await self.server.upstream_exists.lookup(l):
                     return "true"
 
             return "false"
 
+        if self.upstream_client is not None:
+            return await self._pipelined_stream_handler(handler)
         return await self._stream_handler(handler)
 
     async def report_readonly(self, data):
@@ -477,6 +836,31 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
     # report is made inside the function
     @permissions(READ_PERM)
     async def handle_report(self, data):
+        return await self.report(data)
+
+    @permissions(READ_PERM)
+    async def handle_report_stream(self, request):
+        async def handler(line):
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise bb.asyncrpc.InvokeError(
+                    "Could not decode JSONL input '%s'" % line
+                ) from exc
+
+            if not isinstance(data, dict):
+                raise bb.asyncrpc.InvokeError("Bad report type %s" % type(data))
+
+            try:
+                return json.dumps(await self.report(data))
+            except KeyError as exc:
+                raise bb.asyncrpc.InvokeError(
+                    "Input line is missing key '%s' " % exc
+                ) from exc
+
+        return await self._stream_handler(handler)
+
+    async def report(self, data):
         validate_unihash(data.get("unihash"))
 
         if self.server.read_only or not self.user_has_permissions(REPORT_PERM):
@@ -557,17 +941,12 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
     @permissions(READ_PERM)
     async def handle_get_stats(self, request):
-        return {
-            "requests": self.server.request_stats.todict(),
-        }
+        return self.server.get_stats()
 
     @permissions(DB_ADMIN_PERM)
     async def handle_reset_stats(self, request):
-        d = {
-            "requests": self.server.request_stats.todict(),
-        }
-
-        self.server.request_stats.reset()
+        d = self.server.get_stats()
+        self.server.reset_stats()
         return d
 
     @permissions(READ_PERM)
@@ -584,7 +963,23 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         if not isinstance(condition, dict):
             raise TypeError("Bad condition type %s" % type(condition))
 
-        return {"count": await self.db.remove(condition)}
+        count = await self.db.remove(condition)
+        self.server.unihash_cache.clear()
+        return {"count": count}
+
+    def get_gc_batching(self, request):
+        batch_size = request.get("batch_size")
+        delay = request.get("delay", 0)
+
+        if batch_size is not None and (
+            not isinstance(batch_size, int) or batch_size < 1
+        ):
+            raise bb.asyncrpc.InvokeError("Bad batch size %r" % batch_size)
+
+        if not isinstance(delay, (int, float)) or delay < 0:
+            raise bb.asyncrpc.InvokeError("Bad delay %r" % delay)
+
+        return batch_size, delay
 
     @permissions(DB_ADMIN_PERM)
     async def handle_gc_mark(self, request):
@@ -597,6 +992,17 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         if not isinstance(mark, str):
             raise TypeError("Bad mark type %s" % type(mark))
 
+        batch_size, delay = self.get_gc_batching(request)
+        await self.server.check_gc_idle(self.db)
+
+        if batch_size is not None:
+
+            async def mark_batch(db, after_id):
+                return await db.gc_mark_batch(mark, condition, after_id, batch_size)
+
+            await self.server.start_gc(self.db, "mark", mark, mark_batch, delay)
+            return {"count": 0, "background": True}
+
         return {"count": await self.db.gc_mark(mark, condition)}
 
     @permissions(DB_ADMIN_PERM)
@@ -624,6 +1030,7 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
 
             return json.dumps({"count": await self.db.gc_mark(mark, condition)})
 
+        await self.server.check_gc_idle(self.db)
         return await self._stream_handler(handler)
 
     @permissions(DB_ADMIN_PERM)
@@ -633,6 +1040,9 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
         if not isinstance(mark, str):
             raise TypeError("Bad mark type %s" % type(mark))
 
+        batch_size, delay = self.get_gc_batching(request)
+        await self.server.check_gc_idle(self.db)
+
         current_mark = await self.db.get_current_gc_mark()
 
         if not current_mark or mark != current_mark:
@@ -640,19 +1050,35 @@ class ServerClient(bb.asyncrpc.AsyncServerConnection):
                 f"'{mark}' is not the current mark. Refusing to sweep"
             )
 
+        if batch_size is not None:
+
+            async def sweep_batch(db, after_id):
+                return await db.gc_sweep_batch(after_id, batch_size)
+
+            await self.server.start_gc(self.db, "sweep", mark, sweep_batch, delay)
+            return {"count": 0, "background": True}
+
         count = await self.db.gc_sweep()
+        self.server.unihash_cache.clear()
 
         return {"count": count}
 
     @permissions(DB_ADMIN_PERM)
     async def handle_gc_status(self, request):
         (keep_rows, remove_rows, current_mark) = await self.db.gc_status()
-        return {
+        d = {
             "keep": keep_rows,
             "remove": remove_rows,
             "mark": current_mark,
         }
 
+        # Progress of the last incremental operation, if there was one
+        progress = await self.db.get_gc_progress()
+        if progress is not None:
+            d["progress"] = progress
+
+        return d
+
     @permissions(DB_ADMIN_PERM)
     async def handle_clean_unused(self, request):
         max_age = request["max_age_seconds"]
@@ -835,6 +1261,9 @@ class Server(bb.asyncrpc.AsyncServer):
         anon_perms=DEFAULT_ANON_PERMS,
         admin_username=None,
         admin_password=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        backfill_workers=DEFAULT_BACKFILL_WORKERS,
+        upstream_prewarm=0,
     ):
         if upstream and read_only:
             raise bb.asyncrpc.ServerError(
@@ -853,13 +1282,23 @@ class Server(bb.asyncrpc.AsyncServer):
         super().__init__(logger)
 
         self.request_stats = Stats()
+        self.unihash_cache = UnihashCache(cache_size)
         self.db_engine = db_engine
         self.upstream = upstream
         self.read_only = read_only
         self.backfill_queue = None
+        self.backfill_workers = max(backfill_workers, 1)
+        self.upstream_prewarm = upstream_prewarm
+        self.upstream_unihashes = None
+        self.upstream_exists = None
+        self.prewarm = None
+        self.gc_task = None
         self.anon_perms = set(anon_perms)
         self.admin_username = admin_username
         self.admin_password = admin_password
+        self.worker_stats = None
+        self.stats_reset_count = 0
+        self.publish_stats_task = None
 
         self.logger.info(
             "Anonymous user permissions are: %s", ", ".join(self.anon_perms)
@@ -868,6 +1307,47 @@ class Server(bb.asyncrpc.AsyncServer):
     def accept_client(self, socket):
         return ServerClient(socket, self)
 
+    def serve_forever_workers(self, num_workers, queue=None):
+        self.worker_stats = WorkerStats(num_workers)
+        self.unihash_cache = UnihashCache(
+            self.unihash_cache.size, multiprocessing.Value(ctypes.c_uint64, 0)
+        )
+        super().serve_forever_workers(num_workers, queue)
+
+    def publish_stats(self):
+        if self.stats_reset_count != self.worker_stats.reset_count.value:
+            self.stats_reset_count = self.worker_stats.reset_count.value
+            self.request_stats.reset()
+            self.unihash_cache.reset_stats()
+
+        self.worker_stats.publish(
+            self.worker_index, self.request_stats, self.unihash_cache
+        )
+
+    async def publish_stats_worker(self):
+        while True:
+            self.publish_stats()
+            await asyncio.sleep(STATS_PUBLISH_INTERVAL)
+
+    def get_stats(self):
+        if self.worker_stats is None:
+            return {
+                "requests": self.request_stats.todict(),
+                "cache": self.unihash_cache.todict(),
+            }
+
+        # The other workers may not have published their latest statistics
+        # yet, but at least make sure the ones of this worker are current
+        self.publish_stats()
+        return self.worker_stats.todict()
+
+    def reset_stats(self):
+        self.request_stats.reset()
+        self.unihash_cache.reset_stats()
+        if self.worker_stats is not None:
+            self.worker_stats.reset()
+            self.stats_reset_count = self.worker_stats.reset_count.value
+
     async def create_admin_user(self):
         admin_permissions = (ALL_PERM,)
         async with self.db_engine.connect(self.logger) as db:
@@ -890,38 +1370,192 @@ class Server(bb.asyncrpc.AsyncServer):
                 self.logger.info("Admin user '%s' updated", self.admin_username)
 
     async def backfill_worker_task(self):
-        async with await create_async_client(
-            self.upstream
-        ) as client, self.db_engine.connect(self.logger) as db:
+        # The unihashes were already returned by the upstream server, so all
+        # that is left is writing them to the database. Several of these
+        # workers run concurrently so that their writes are committed together
+        async with self.db_engine.connect(self.logger) as db:
             while True:
                 item = await self.backfill_queue.get()
                 if item is None:
                     self.backfill_queue.task_done()
                     break
 
-                method, taskhash = item
-                d = await client.get_taskhash(method, taskhash)
-                if d is not None:
-                    if is_valid_unihash(d.get("unihash")):
-                        await db.insert_unihash(d["method"], d["taskhash"], d["unihash"])
+                method, taskhash, unihash = item
+                try:
+                    if is_valid_unihash(unihash):
+                        self.unihash_cache.discard(method, taskhash)
+                        await db.insert_unihash(method, taskhash, unihash)
                     else:
                         self.logger.warning("Upstream server returned invalid unihash")
-                self.backfill_queue.task_done()
+                finally:
+                    self.backfill_queue.task_done()
+
+    async def prewarm_task(self):
+        async with await create_async_client(self.upstream) as client:
+            try:
+                rows = await client.get_recent(self.upstream_prewarm)
+            except Exception as e:
+                # Pre-warming is only an optimization, so don't fail on e.g.
+                # older upstream servers that don't support it
+                self.logger.warning("Unable to pre-warm from upstream server: %s", e)
+                return
+
+        for row in rows:
+            await self.backfill_queue.put(
+                (row["method"], row["taskhash"], row["unihash"])
+            )
+
+        self.logger.info("Pre-warming %d unihashes from upstream server", len(rows))
+
+    async def check_gc_idle(self, db):
+        # The operation may be running in another worker process, or another
+        # server sharing the database. Returns the recorded progress
+        progress = await db.get_gc_progress()
+        if (self.gc_task is not None and not self.gc_task.done()) or (
+            progress is not None
+            and progress["state"] == "running"
+            and time.time() - progress["updated"]
+            < progress["delay"] + GC_STALE_TIMEOUT
+        ):
+            raise bb.asyncrpc.InvokeError(
+                "Incremental garbage collection is in progress"
+            )
+        return progress
+
+    async def start_gc(self, db, operation, mark, batch_func, delay):
+        """
+        Starts an incremental garbage collection operation in the background.
+        batch_func(db, after_id) processes the next batch of rows after
+        after_id, and returns the id to continue after (or None when done) and
+        the count of rows processed. Each batch is a separate transaction, so
+        other clients are only held up for the duration of one batch, and the
+        operation sleeps for delay seconds between batches to leave the
+        database to them. The progress is recorded in the database so that
+        any worker process can report it
+        """
+        progress = {
+            "operation": operation,
+            "mark": mark,
+            "state": "running",
+            "count": 0,
+            "batches": 0,
+            "position": 0,
+            "delay": delay,
+            "updated": time.time(),
+        }
+
+        # Record the operation before returning, so that it is immediately
+        # visible to all the workers. It is only recorded if the progress is
+        # still what was found to be idle (compared as the JSON it was stored
+        # as), so that if two clients race to start an operation only one of
+        # them does
+        old = await self.check_gc_idle(db)
+        if not await db.claim_gc_progress(old, progress):
+            raise bb.asyncrpc.InvokeError(
+                "Incremental garbage collection is in progress"
+            )
+
+        self.gc_task = self.loop.create_task(
+            self.gc_worker_task(progress, batch_func, delay)
+        )
+
+    async def gc_worker_task(self, progress, batch_func, delay):
+        operation = progress["operation"]
+
+        async with self.db_engine.connect(self.logger) as db:
+
+            async def update():
+                progress["updated"] = time.time()
+                await db.set_gc_progress(progress)
+
+            try:
+                while True:
+                    last_id, count = await batch_func(db, progress["position"])
+                    progress["count"] += count
+                    progress["batches"] += 1
+
+                    if operation == "sweep" and count:
+                        self.unihash_cache.clear()
+
+                    if last_id is None:
+                        break
+
+                    progress["position"] = last_id
+                    await update()
+                    await asyncio.sleep(delay)
+
+                progress["state"] = "done"
+                self.logger.info(
+                    "Incremental gc-%s of '%s' done: %d rows",
+                    operation,
+                    progress["mark"],
+                    progress["count"],
+                )
+            except asyncio.CancelledError:
+                # Nothing is lost by stopping between batches; the operation
+                # can be started again
+                progress["state"] = "stopped"
+                await update()
+                raise
+            except Exception as e:
+                self.logger.exception("Incremental gc-%s failed", operation)
+                progress["state"] = "failed"
+                progress["error"] = str(e)
+
+            await update()
 
     def start(self):
         tasks = super().start()
         if self.upstream:
             self.backfill_queue = asyncio.Queue()
-            tasks += [self.backfill_worker_task()]
+            tasks += [self.backfill_worker_task() for _ in range(self.backfill_workers)]
+
+            self.upstream_unihashes = UpstreamBatcher(
+                self.upstream, lambda client, keys: client.get_unihash_batch(keys)
+            )
+            self.upstream_exists = UpstreamBatcher(
+                self.upstream, lambda client, keys: client.unihash_exists_batch(keys)
+            )
+            self.upstream_unihashes.start(self.loop)
+            self.upstream_exists.start(self.loop)
+
+            if self.upstream_prewarm:
+                self.prewarm = self.loop.create_task(self.prewarm_task())
 
         self.loop.run_until_complete(self.db_engine.create())
 
         if self.admin_username:
             self.loop.run_until_complete(self.create_admin_user())
 
+        if self.worker_stats is not None:
+            self.publish_stats_task = self.loop.create_task(
+                self.publish_stats_worker()
+            )
+
         return tasks
 
+    def _serve_forever(self, tasks):
+        try:
+            super()._serve_forever(tasks)
+        finally:
+            # Everything using the database has finished by now
+            self.loop.run_until_complete(self.db_engine.close())
+
     async def stop(self):
+        if self.publish_stats_task is not None:
+            self.publish_stats_task.cancel()
+        if self.gc_task is not None:
+            self.gc_task.cancel()
+            try:
+                await self.gc_task
+            except asyncio.CancelledError:
+                pass
+        if self.prewarm is not None:
+            self.prewarm.cancel()
+        if self.upstream_unihashes is not None:
+            await self.upstream_unihashes.stop()
+            await self.upstream_exists.stop()
         if self.backfill_queue is not None:
-            await self.backfill_queue.put(None)
+            for _ in range(self.backfill_workers):
+                await self.backfill_queue.put(None)
         await super().stop()
@@ -5,9 +5,11 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+import asyncio
+import json
 import logging
 from datetime import datetime
-from . import User
+from . import User, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY
 
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.pool import NullPool
@@ -124,6 +126,20 @@ class DatabaseEngine(object):
         if password is not None:
             self.url = self.url.set(password=password)
 
+        self.engine = None
+        self.insert_queue = []
+        self.insert_task = None
+
+    async def close(self):
+        """
+        Wait for the queued inserts and close the connections of the engine
+        """
+        if self.insert_task is not None:
+            await self.insert_task
+            self.insert_task = None
+        if self.engine is not None:
+            await self.engine.dispose()
+
     async def create(self):
         def check_table_exists(conn, name):
             return inspect(conn).has_table(name)
@@ -159,7 +175,70 @@ class DatabaseEngine(object):
                 self.logger.info("Upgrade complete")
 
     def connect(self, logger):
-        return Database(self.engine, logger)
+        return Database(self.engine, logger, self)
+
+    async def insert(self, statement):
+        """
+        Execute an insert statement that ignores (or raises IntegrityError
+        for) existing rows, returning True if a row was inserted. The inserts
+        of concurrent clients are committed together in batches.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.insert_queue.append((statement, future))
+
+        if self.insert_task is None or self.insert_task.done():
+            self.insert_task = asyncio.create_task(self._insert_worker())
+
+        return await future
+
+    async def _insert_worker(self):
+        # Runs until the queue is empty, so that no task is left behind when
+        # the server shuts down
+        batch = []
+        while self.insert_queue:
+            # Only wait for more inserts if there are concurrent writers
+            if len(batch) > 1 and WRITE_BATCH_DELAY:
+                await asyncio.sleep(WRITE_BATCH_DELAY)
+
+            batch = self.insert_queue[:WRITE_BATCH_SIZE]
+            del self.insert_queue[:WRITE_BATCH_SIZE]
+
+            try:
+                results = await self._insert_batch(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for result, (_, future) in zip(results, batch):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def _insert_batch(self, batch):
+        try:
+            async with self.engine.begin() as conn:
+                results = []
+                for statement, _ in batch:
+                    self.logger.debug("%s", statement)
+                    result = await conn.execute(statement)
+                    results.append(result.rowcount != 0)
+                return results
+        except IntegrityError:
+            if len(batch) == 1:
+                return [False]
+
+        # One of the inserts conflicted with an existing row (which aborts the
+        # transaction on most databases), so fall back to inserting each one
+        # in its own transaction
+        results = []
+        for item in batch:
+            try:
+                results.extend(await self._insert_batch([item]))
+            except Exception as e:
+                results.append(e)
+        return results
 
 
 def map_row(row):
@@ -187,8 +266,9 @@ def _make_condition_statement(table, condition):
 
 
 class Database(object):
-    def __init__(self, engine, logger):
+    def __init__(self, engine, logger, db_engine):
         self.engine = engine
+        self.db_engine = db_engine
         self.db = None
         self.logger = logger
 
@@ -285,6 +365,28 @@ class Database(object):
             )
             return map_row(result.first())
 
+    async def get_recent_unihashes(self, limit):
+        async with self.db.begin():
+            result = await self._execute(
+                select(
+                    UnihashesV3.method,
+                    UnihashesV3.taskhash,
+                    UnihashesV3.unihash,
+                )
+                .join(
+                    OuthashesV2,
+                    and_(
+                        UnihashesV3.method == OuthashesV2.method,
+                        UnihashesV3.taskhash == OuthashesV2.taskhash,
+                    ),
+                )
+                .order_by(
+                    OuthashesV2.created.desc(),
+                )
+                .limit(limit)
+            )
+            return [map_row(row) for row in result]
+
     async def unihash_exists(self, unihash):
         async with self.db.begin():
             result = await self._execute(
@@ -419,6 +521,105 @@ class Database(object):
 
             return result.rowcount
 
+    async def gc_mark_batch(self, mark, condition, after_id, batch_size):
+        async with self.db.begin():
+            await self._set_config("gc-mark", mark)
+
+            where = _make_condition_statement(UnihashesV3, condition)
+            if not where:
+                return (None, 0)
+
+            result = await self._execute(
+                select(UnihashesV3.id)
+                .where(UnihashesV3.id > after_id, *where)
+                .order_by(UnihashesV3.id)
+                .limit(batch_size)
+            )
+            ids = [row.id for row in result]
+            if not ids:
+                return (None, 0)
+
+            result = await self._execute(
+                update(UnihashesV3)
+                .values(gc_mark=self._get_config_subquery("gc-mark", ""))
+                .where(
+                    UnihashesV3.id > after_id,
+                    UnihashesV3.id <= ids[-1],
+                    *where,
+                )
+            )
+            count = result.rowcount
+
+            if len(ids) < batch_size:
+                return (None, count)
+            return (ids[-1], count)
+
+    async def gc_sweep_batch(self, after_id, batch_size):
+        async with self.db.begin():
+            result = await self._execute(
+                select(UnihashesV3.id)
+                .where(UnihashesV3.id > after_id)
+                .order_by(UnihashesV3.id)
+                .offset(batch_size - 1)
+                .limit(1)
+            )
+            row = result.first()
+            last_id = row.id if row is not None else None
+
+            where = [
+                UnihashesV3.id > after_id,
+                # If the config mark is NULL, this will not match any rows
+                # (see gc_sweep())
+                UnihashesV3.gc_mark != self._get_config_subquery("gc-mark"),
+            ]
+            if last_id is not None:
+                where.append(UnihashesV3.id <= last_id)
+
+            result = await self._execute(delete(UnihashesV3).where(*where))
+            count = result.rowcount
+
+            if last_id is None:
+                await self._set_config("gc-mark", None)
+
+            return (last_id, count)
+
+    async def get_gc_progress(self):
+        async with self.db.begin():
+            value = await self._get_config("gc-progress")
+            if value is None:
+                return None
+            return json.loads(value)
+
+    async def set_gc_progress(self, progress):
+        async with self.db.begin():
+            await self._set_config("gc-progress", json.dumps(progress))
+
+    async def claim_gc_progress(self, old, progress):
+        if old is None:
+            # The insert aborts the transaction if another client raced to
+            # add the row first
+            try:
+                async with self.db.begin():
+                    await self._execute(
+                        insert(Config).values(
+                            name="gc-progress", value=json.dumps(progress)
+                        )
+                    )
+            except IntegrityError:
+                return False
+            return True
+
+        async with self.db.begin():
+            result = await self._execute(
+                update(Config)
+                .where(
+                    Config.name == "gc-progress",
+                    Config.value == json.dumps(old),
+                )
+                .values(value=json.dumps(progress))
+            )
+            return result.rowcount == 1
+
     async def clean_unused(self, oldest):
         async with self.db.begin():
             result = await self._execute(
@@ -458,15 +659,12 @@ class Database(object):
                 gc_mark=self._get_config_subquery("gc-mark", ""),
             )
 
-        try:
-            async with self.db.begin():
-                result = await self._execute(statement)
-                return result.rowcount != 0
-        except IntegrityError:
+        inserted = await self.db_engine.insert(statement)
+        if not inserted:
             self.logger.debug(
                 "%s, %s, %s already in unihash database", method, taskhash, unihash
             )
-            return False
+        return inserted
 
     async def insert_outhash(self, data):
         outhash_columns = set(c.key for c in OuthashesV2.__table__.columns)
@@ -488,15 +686,12 @@ class Database(object):
         else:
             statement = insert(OuthashesV2).values(**data)
 
-        try:
-            async with self.db.begin():
-                result = await self._execute(statement)
-                return result.rowcount != 0
-        except IntegrityError:
+        inserted = await self.db_engine.insert(statement)
+        if not inserted:
             self.logger.debug(
                 "%s, %s already in outhash database", data["method"], data["outhash"]
             )
-            return False
+        return inserted
 
     async def _get_user(self, username):
         async with self.db.begin():
@@ -5,13 +5,27 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 from datetime import datetime, timezone
+import asyncio
+import json
+import os
+import queue
 import sqlite3
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from . import User
+from . import User, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY
 
 logger = logging.getLogger("hashserv.sqlite")
 
+# Number of threads (each with their own connection) used for queries. All
+# writes go through a single further thread so they never contend with each
+# other, while WAL mode lets the reads proceed alongside them. The writer
+# thread commits the writes in batches, so concurrent clients share the cost
+# of each commit.
+DEFAULT_READ_THREADS = 4
+
 UNIHASH_TABLE_DEFINITION = (
     ("method", "TEXT NOT NULL", "UNIQUE"),
     ("taskhash", "TEXT NOT NULL", "UNIQUE"),
@@ -127,26 +141,175 @@ def _schema_table_name(version):
 
 
 class DatabaseEngine(object):
-    def __init__(self, dbname, sync):
+    def __init__(self, dbname, sync, read_threads=DEFAULT_READ_THREADS):
         self.dbname = dbname
         self.logger = logger
         self.sync = sync
-
-    async def create(self):
-        db = sqlite3.connect(self.dbname)
-        db.row_factory = sqlite3.Row
+        self.read_threads = read_threads
+        self.sqlite_version = None
+        self.local = None
+        self.read_executor = None
+        self.write_queue = None
+        self.write_thread = None
+        self.connections = []
+        self.pid = None
+
+    def _start(self):
+        # The engine may be created before the server process forks, so the
+        # threads (and their connections) are only started on first use
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.local = threading.local()
+            self.read_executor = ThreadPoolExecutor(
+                self.read_threads, thread_name_prefix="hashserv-sqlite-read"
+            )
+            self.write_queue = queue.SimpleQueue()
+            self.connections = []
+            self.write_thread = threading.Thread(
+                target=self._write_worker, name="hashserv-sqlite-write", daemon=True
+            )
+            self.write_thread.start()
+
+    def _connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # Only ever used by this thread, but closed by close() once the
+            # thread has stopped
+            db = sqlite3.connect(self.dbname, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+
+            with closing(db.cursor()) as cursor:
+                cursor.execute("PRAGMA journal_mode = WAL")
+                cursor.execute(
+                    "PRAGMA synchronous = %s" % ("NORMAL" if self.sync else "OFF")
+                )
+                self.sqlite_version = _get_sqlite_version(cursor)
+
+            self.local.db = db
+            self.connections.append(db)
+        return db
+
+    def _write_worker(self):
+        write_queue = self.write_queue
+        batch = []
+        while True:
+            # Only wait for more writes to arrive if the previous batch showed
+            # that there are concurrent writers; a lone client shouldn't have
+            # its writes delayed
+            delay = WRITE_BATCH_DELAY if len(batch) > 1 else 0
+            item = write_queue.get()
+            deadline = time.monotonic() + delay
+
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    break
+                try:
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        item = write_queue.get(timeout=timeout)
+                    else:
+                        item = write_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write_batch(batch)
+            if item is None:
+                # Queued by close()
+                break
+
+    def _write_batch(self, batch):
+        db = self._connection()
+        results = []
 
         with closing(db.cursor()) as cursor:
+            try:
+                if not db.in_transaction:
+                    cursor.execute("BEGIN")
+
+                # Each write is done in its own savepoint, so that a failure
+                # only undoes that one write and not the rest of the batch
+                for func, args, _, _ in batch:
+                    cursor.execute("SAVEPOINT write")
+                    try:
+                        results.append((True, func(db, cursor, *args)))
+                        cursor.execute("RELEASE write")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write")
+                        cursor.execute("RELEASE write")
+                        results.append((False, e))
+
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                results = [(False, e)] * len(batch)
+
+        for (success, value), (_, _, loop, future) in zip(results, batch):
+            try:
+                loop.call_soon_threadsafe(_set_future_result, future, success, value)
+            except RuntimeError:
+                # The event loop has been closed
+                pass
+
+    async def _run(self, executor, func, *args):
+        def run():
+            db = self._connection()
+            with closing(db.cursor()) as cursor:
+                return func(db, cursor, *args)
+
+        return await asyncio.get_running_loop().run_in_executor(executor, run)
+
+    async def read(self, func, *args):
+        """
+        Run func(db, cursor, *args) on one of the reader threads
+        """
+        self._start()
+        return await self._run(self.read_executor, func, *args)
+
+    async def write(self, func, *args):
+        """
+        Run func(db, cursor, *args) on the writer thread. The changes it makes
+        are committed (together with any other writes in the same batch)
+        before this returns
+        """
+        self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.write_queue.put((func, args, loop, future))
+        return await future
+
+    async def close(self):
+        """
+        Stop the reader and writer threads, once they have finished what was
+        queued for them, and close their connections
+        """
+        if self.pid != os.getpid():
+            return
+
+        def shutdown():
+            self.write_queue.put(None)
+            self.write_thread.join()
+            self.read_executor.shutdown()
+            for db in self.connections:
+                db.close()
+
+        await asyncio.get_running_loop().run_in_executor(None, shutdown)
+        self.pid = None
+        self.local = None
+        self.read_executor = None
+        self.write_queue = None
+        self.write_thread = None
+        self.connections = []
+
+    async def create(self):
+        def do_create(db, cursor):
             _make_table(cursor, "unihashes_v3", UNIHASH_TABLE_DEFINITION)
             _make_table(cursor, "outhashes_v2", OUTHASH_TABLE_DEFINITION)
             _make_table(cursor, "users", USERS_TABLE_DEFINITION)
             _make_table(cursor, "config", CONFIG_TABLE_DEFINITION)
 
-            cursor.execute("PRAGMA journal_mode = WAL")
-            cursor.execute(
-                "PRAGMA synchronous = %s" % ("NORMAL" if self.sync else "OFF")
-            )
-
             # Drop old indexes
             cursor.execute("DROP INDEX IF EXISTS taskhash_lookup")
             cursor.execute("DROP INDEX IF EXISTS outhash_lookup")
@@ -169,11 +332,9 @@ class DatabaseEngine(object):
             )
             cursor.execute("CREATE INDEX IF NOT EXISTS config_lookup ON config (name)")
 
-            sqlite_version = _get_sqlite_version(cursor)
-
             cursor.execute(
                 f"""
-                SELECT name FROM {_schema_table_name(sqlite_version)} WHERE type = 'table' AND name = 'unihashes_v2'
+                SELECT name FROM {_schema_table_name(self.sqlite_version)} WHERE type = 'table' AND name = 'unihashes_v2'
                 """
             )
             if cursor.fetchone():
@@ -185,28 +346,54 @@ class DatabaseEngine(object):
                     """
                 )
                 cursor.execute("DROP TABLE unihashes_v2")
-                db.commit()
                 self.logger.info("Upgrade complete")
 
+        await self.write(do_create)
+
     def connect(self, logger):
-        return Database(logger, self.dbname, self.sync)
+        return Database(logger, self)
 
 
-class Database(object):
-    def __init__(self, logger, dbname, sync):
-        self.dbname = dbname
-        self.logger = logger
+def _set_future_result(future, success, value):
+    if future.cancelled():
+        return
+    if success:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
 
-        self.db = sqlite3.connect(self.dbname)
-        self.db.row_factory = sqlite3.Row
 
-        with closing(self.db.cursor()) as cursor:
-            cursor.execute("PRAGMA journal_mode = WAL")
-            cursor.execute(
-                "PRAGMA synchronous = %s" % ("NORMAL" if sync else "OFF")
-            )
+def _set_config(cursor, name, value):
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO config (id, name, value) VALUES
+        ((SELECT id FROM config WHERE name=:name), :name, :value)
+        """,
+        {
+            "name": name,
+            "value": value,
+        },
+    )
+
+
+def _get_config(cursor, name):
+    cursor.execute(
+        "SELECT value FROM config WHERE name=:name",
+        {
+            "name": name,
+        },
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row["value"]
 
-            self.sqlite_version = _get_sqlite_version(cursor)
+
+class Database(object):
+    def __init__(self, logger, engine):
+        self.engine = engine
+        self.dbname = engine.dbname
+        self.logger = logger
 
     async def __aenter__(self):
         return self
@@ -214,35 +401,12 @@ class Database(object):
     async def __aexit__(self, exc_type, exc_value, traceback):
         await self.close()
 
-    async def _set_config(self, cursor, name, value):
-        cursor.execute(
-            """
-            INSERT OR REPLACE INTO config (id, name, value) VALUES
-            ((SELECT id FROM config WHERE name=:name), :name, :value)
-            """,
-            {
-                "name": name,
-                "value": value,
-            },
-        )
-
-    async def _get_config(self, cursor, name):
-        cursor.execute(
-            "SELECT value FROM config WHERE name=:name",
-            {
-                "name": name,
-            },
-        )
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return row["value"]
-
     async def close(self):
-        self.db.close()
+        # The connections belong to the engine's threads
+        pass
 
     async def get_unihash_by_taskhash_full(self, method, taskhash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT *, unihashes_v3.unihash AS unihash FROM outhashes_v2
@@ -258,8 +422,10 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
     async def get_unihash_by_outhash(self, method, outhash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT *, unihashes_v3.unihash AS unihash FROM outhashes_v2
@@ -275,8 +441,27 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
+    async def get_recent_unihashes(self, limit):
+        def query(db, cursor):
+            cursor.execute(
+                """
+                SELECT unihashes_v3.method, unihashes_v3.taskhash, unihashes_v3.unihash FROM outhashes_v2
+                INNER JOIN unihashes_v3 ON unihashes_v3.method=outhashes_v2.method AND unihashes_v3.taskhash=outhashes_v2.taskhash
+                ORDER BY outhashes_v2.created DESC
+                LIMIT :limit
+                """,
+                {
+                    "limit": limit,
+                },
+            )
+            return cursor.fetchall()
+
+        return await self.engine.read(query)
+
     async def unihash_exists(self, unihash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT * FROM unihashes_v3 WHERE unihash=:unihash
@@ -288,8 +473,10 @@ class Database(object):
             )
             return cursor.fetchone() is not None
 
+        return await self.engine.read(query)
+
     async def get_outhash(self, method, outhash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT * FROM outhashes_v2
@@ -304,8 +491,10 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
     async def get_equivalent_for_outhash(self, method, outhash, taskhash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT outhashes_v2.taskhash AS taskhash, unihashes_v3.unihash AS unihash FROM outhashes_v2
@@ -324,8 +513,10 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
     async def get_equivalent(self, method, taskhash):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 "SELECT taskhash, method, unihash FROM unihashes_v3 WHERE method=:method AND taskhash=:taskhash",
                 {
@@ -335,6 +526,8 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
     async def remove(self, condition):
         def do_remove(columns, table_name, cursor):
             where, clause = _make_condition_statement(columns, condition)
@@ -345,20 +538,22 @@ class Database(object):
 
             return 0
 
-        count = 0
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
+            count = 0
             count += do_remove(OUTHASH_TABLE_COLUMNS, "outhashes_v2", cursor)
             count += do_remove(UNIHASH_TABLE_COLUMNS, "unihashes_v3", cursor)
-            self.db.commit()
+            return count
 
-        return count
+        return await self.engine.write(query)
 
     async def get_current_gc_mark(self):
-        with closing(self.db.cursor()) as cursor:
-            return await self._get_config(cursor, "gc-mark")
+        def query(db, cursor):
+            return _get_config(cursor, "gc-mark")
+
+        return await self.engine.read(query)
 
     async def gc_status(self):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT COUNT() FROM unihashes_v3 WHERE
@@ -375,13 +570,15 @@ class Database(object):
             )
             remove_rows = cursor.fetchone()[0]
 
-            current_mark = await self._get_config(cursor, "gc-mark")
+            current_mark = _get_config(cursor, "gc-mark")
 
             return (keep_rows, remove_rows, current_mark)
 
+        return await self.engine.read(query)
+
     async def gc_mark(self, mark, condition):
-        with closing(self.db.cursor()) as cursor:
-            await self._set_config(cursor, "gc-mark", mark)
+        def query(db, cursor):
+            _set_config(cursor, "gc-mark", mark)
 
             where, clause = _make_condition_statement(UNIHASH_TABLE_COLUMNS, condition)
 
@@ -397,11 +594,12 @@ class Database(object):
                 )
                 new_rows = cursor.rowcount
 
-            self.db.commit()
             return new_rows
 
+        return await self.engine.write(query)
+
     async def gc_sweep(self):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             # NOTE: COALESCE is not used in this query so that if the current
             # mark is NULL, nothing will happen
             cursor.execute(
@@ -411,13 +609,153 @@ class Database(object):
                 """
             )
             count = cursor.rowcount
-            await self._set_config(cursor, "gc-mark", None)
+            _set_config(cursor, "gc-mark", None)
 
-            self.db.commit()
             return count
 
+        return await self.engine.write(query)
+
+    async def gc_mark_batch(self, mark, condition, after_id, batch_size):
+        """
+        Like gc_mark(), but only marks the next batch_size matching rows
+        after after_id. Returns the id to continue after, or None once all
+        matching rows have been marked, and the count of rows marked
+        """
+
+        def query(db, cursor):
+            _set_config(cursor, "gc-mark", mark)
+
+            where, clause = _make_condition_statement(UNIHASH_TABLE_COLUMNS, condition)
+            if not where:
+                return (None, 0)
+
+            params = dict(where, after_id=after_id, batch_size=batch_size)
+            cursor.execute(
+                f"""
+                SELECT id FROM unihashes_v3 WHERE id>:after_id AND {clause}
+                ORDER BY id
+                LIMIT :batch_size
+                """,
+                params,
+            )
+            ids = [row["id"] for row in cursor.fetchall()]
+            if not ids:
+                return (None, 0)
+
+            params["last_id"] = ids[-1]
+            cursor.execute(
+                f"""
+                UPDATE unihashes_v3 SET
+                    gc_mark=COALESCE((SELECT value FROM config WHERE name='gc-mark'), '')
+                WHERE id>:after_id AND id<=:last_id AND {clause}
+                """,
+                params,
+            )
+            count = cursor.rowcount
+
+            if len(ids) < batch_size:
+                return (None, count)
+            return (ids[-1], count)
+
+        return await self.engine.write(query)
+
+    async def gc_sweep_batch(self, after_id, batch_size):
+        """
+        Like gc_sweep(), but only looks at the next batch_size rows after
+        after_id. Returns the id to continue after, or None once the sweep is
+        finished (and the mark has been cleared), and the count of rows
+        removed
+        """
+
+        def query(db, cursor):
+            cursor.execute(
+                """
+                SELECT id FROM unihashes_v3 WHERE id>:after_id
+                ORDER BY id
+                LIMIT 1 OFFSET :offset
+                """,
+                {
+                    "after_id": after_id,
+                    "offset": batch_size - 1,
+                },
+            )
+            row = cursor.fetchone()
+            last_id = row["id"] if row is not None else None
+
+            # NOTE: The mark is compared without COALESCE so that if the
+            # current mark is NULL, nothing will happen
+            if last_id is None:
+                cursor.execute(
+                    """
+                    DELETE FROM unihashes_v3 WHERE id>:after_id AND
+                        gc_mark!=(SELECT value FROM config WHERE name='gc-mark')
+                    """,
+                    {
+                        "after_id": after_id,
+                    },
+                )
+                count = cursor.rowcount
+                _set_config(cursor, "gc-mark", None)
+            else:
+                cursor.execute(
+                    """
+                    DELETE FROM unihashes_v3 WHERE id>:after_id AND id<=:last_id AND
+                        gc_mark!=(SELECT value FROM config WHERE name='gc-mark')
+                    """,
+                    {
+                        "after_id": after_id,
+                        "last_id": last_id,
+                    },
+                )
+                count = cursor.rowcount
+
+            return (last_id, count)
+
+        return await self.engine.write(query)
+
+    async def get_gc_progress(self):
+        def query(db, cursor):
+            value = _get_config(cursor, "gc-progress")
+            if value is None:
+                return None
+            return json.loads(value)
+
+        return await self.engine.read(query)
+
+    async def set_gc_progress(self, progress):
+        def query(db, cursor):
+            _set_config(cursor, "gc-progress", json.dumps(progress))
+
+        return await self.engine.write(query)
+
+    async def claim_gc_progress(self, old, progress):
+        def query(db, cursor):
+            if old is None:
+                cursor.execute(
+                    """
+                    INSERT INTO config (name, value)
+                    SELECT :name, :value WHERE NOT EXISTS (SELECT 1 FROM config WHERE name=:name)
+                    """,
+                    {
+                        "name": "gc-progress",
+                        "value": json.dumps(progress),
+                    },
+                )
+            else:
+                cursor.execute(
+                    "UPDATE config SET value=:value WHERE name=:name AND value=:old",
+                    {
+                        "name": "gc-progress",
+                        "value": json.dumps(progress),
+                        "old": json.dumps(old),
+                    },
+                )
+            return cursor.rowcount == 1
+
+        return await self.engine.write(query)
+
     async def clean_unused(self, oldest):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 DELETE FROM outhashes_v2 WHERE created<:oldest AND NOT EXISTS (
@@ -428,12 +766,12 @@ class Database(object):
                     "oldest": oldest,
                 },
             )
-            self.db.commit()
             return cursor.rowcount
 
+        return await self.engine.write(query)
+
     async def insert_unihash(self, method, taskhash, unihash):
-        with closing(self.db.cursor()) as cursor:
-            prevrowid = cursor.lastrowid
+        def query(db, cursor):
             cursor.execute(
                 """
                 INSERT OR IGNORE INTO unihashes_v3 (method, taskhash, unihash, gc_mark) VALUES
@@ -450,24 +788,26 @@ class Database(object):
                     "unihash": unihash,
                 },
             )
-            self.db.commit()
-            return cursor.lastrowid != prevrowid
+            return cursor.rowcount != 0
+
+        return await self.engine.write(query)
 
     async def insert_outhash(self, data):
         data = {k: v for k, v in data.items() if k in OUTHASH_TABLE_COLUMNS}
         keys = sorted(data.keys())
-        query = "INSERT OR IGNORE INTO outhashes_v2 ({fields}) VALUES({values})".format(
+        statement = "INSERT OR IGNORE INTO outhashes_v2 ({fields}) VALUES({values})".format(
             fields=", ".join(keys),
             values=", ".join(":" + k for k in keys),
         )
-        with closing(self.db.cursor()) as cursor:
-            prevrowid = cursor.lastrowid
-            cursor.execute(query, data)
-            self.db.commit()
-            return cursor.lastrowid != prevrowid
-
-    def _get_user(self, username):
-        with closing(self.db.cursor()) as cursor:
+
+        def query(db, cursor):
+            cursor.execute(statement, data)
+            return cursor.rowcount != 0
+
+        return await self.engine.write(query)
+
+    async def _get_user(self, username):
+        def query(db, cursor):
             cursor.execute(
                 """
                 SELECT username, permissions, token FROM users WHERE username=:username
@@ -478,17 +818,19 @@ class Database(object):
             )
             return cursor.fetchone()
 
+        return await self.engine.read(query)
+
     async def lookup_user_token(self, username):
-        row = self._get_user(username)
+        row = await self._get_user(username)
         if row is None:
             return None, None
         return map_user(row), row["token"]
 
     async def lookup_user(self, username):
-        return map_user(self._get_user(username))
+        return map_user(await self._get_user(username))
 
     async def set_user_token(self, username, token):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 UPDATE users SET token=:token WHERE username=:username
@@ -498,11 +840,12 @@ class Database(object):
                     "token": token,
                 },
             )
-            self.db.commit()
             return cursor.rowcount != 0
 
+        return await self.engine.write(query)
+
     async def set_user_perms(self, username, permissions):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 UPDATE users SET permissions=:permissions WHERE username=:username
@@ -512,16 +855,19 @@ class Database(object):
                     "permissions": " ".join(permissions),
                 },
             )
-            self.db.commit()
             return cursor.rowcount != 0
 
+        return await self.engine.write(query)
+
     async def get_all_users(self):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute("SELECT username, permissions FROM users")
             return [map_user(r) for r in cursor.fetchall()]
 
+        return await self.engine.read(query)
+
     async def new_user(self, username, permissions, token):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             try:
                 cursor.execute(
                     """
@@ -533,13 +879,14 @@ class Database(object):
                         "permissions": " ".join(permissions),
                     },
                 )
-                self.db.commit()
                 return True
             except sqlite3.IntegrityError:
                 return False
 
+        return await self.engine.write(query)
+
     async def delete_user(self, username):
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
             cursor.execute(
                 """
                 DELETE FROM users WHERE username=:username
@@ -548,15 +895,16 @@ class Database(object):
                     "username": username,
                 },
             )
-            self.db.commit()
             return cursor.rowcount != 0
 
+        return await self.engine.write(query)
+
     async def get_usage(self):
-        usage = {}
-        with closing(self.db.cursor()) as cursor:
+        def query(db, cursor):
+            usage = {}
             cursor.execute(
                 f"""
-                SELECT name FROM {_schema_table_name(self.sqlite_version)} WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+                SELECT name FROM {_schema_table_name(self.engine.sqlite_version)} WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
                 """
             )
             for row in cursor.fetchall():
@@ -569,7 +917,9 @@ class Database(object):
                 usage[row["name"]] = {
                     "rows": cursor.fetchone()[0],
                 }
-        return usage
+            return usage
+
+        return await self.engine.read(query)
 
     async def get_query_columns(self):
         columns = set()
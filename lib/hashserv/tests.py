@@ -5,9 +5,11 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
-from . import create_server, create_client
-from .server import DEFAULT_ANON_PERMS, ALL_PERMISSIONS
+from . import create_server, create_client, pooled_client
+from .server import DEFAULT_ANON_PERMS, ALL_PERMISSIONS, UpstreamBatcher
 from bb.asyncrpc import InvokeError
+import bb.asyncrpc
+import asyncio
 import hashlib
 import logging
 from bb import multiprocessing
@@ -17,6 +19,7 @@ import tempfile
 import threading
 import unittest
 import socket
+import sqlite3
 import time
 import signal
 import subprocess
@@ -40,8 +43,9 @@ class HashEquivalenceTestSetup(object):
 
     server_index = 0
     client_index = 0
+    server_workers = 1
 
-    def start_server(self, dbpath=None, upstream=None, read_only=False, prefunc=server_prefunc, anon_perms=DEFAULT_ANON_PERMS, admin_username=None, admin_password=None):
+    def start_server(self, dbpath=None, upstream=None, read_only=False, prefunc=server_prefunc, anon_perms=DEFAULT_ANON_PERMS, admin_username=None, admin_password=None, upstream_prewarm=0):
         self.server_index += 1
         if dbpath is None:
             dbpath = self.make_dbpath()
@@ -53,17 +57,24 @@ class HashEquivalenceTestSetup(object):
             server.process.terminate()
             server.process.join()
 
-        server = create_server(self.get_server_addr(self.server_index),
+        address = self.get_server_addr(self.server_index)
+        server = create_server(address,
                                dbpath,
                                upstream=upstream,
                                read_only=read_only,
                                anon_perms=anon_perms,
                                admin_username=admin_username,
-                               admin_password=admin_password)
+                               admin_password=admin_password,
+                               reuseport=self.server_workers > 1,
+                               upstream_prewarm=upstream_prewarm)
         server.dbpath = dbpath
 
-        server.serve_as_process(prefunc=prefunc, args=(self.server_index,))
-        self.addCleanup(cleanup_server, server)
+        if self.server_workers > 1:
+            server.serve_workers_as_process(self.server_workers)
+            self.addCleanup(cleanup_server, server)
+        else:
+            server.serve_as_process(prefunc=prefunc, args=(self.server_index,))
+            self.addCleanup(cleanup_server, server)
 
         return server
 
@@ -132,6 +143,16 @@ class HashEquivalenceTestSetup(object):
         self.assertEqual(result['unihash'], unihash, 'Server returned bad unihash')
         return taskhash, outhash, unihash
 
+    def create_test_hashes(self, client, count):
+        # Creates distinct hashes, using the same value for the taskhash,
+        # outhash and unihash of each
+        hashes = []
+        for i in range(count):
+            h = hashlib.sha256(str(i).encode('utf-8')).hexdigest()
+            client.report_unihash(h, self.METHOD, h, h)
+            hashes.append(h)
+        return hashes
+
     def run_hashclient(self, args, **kwargs):
         try:
             p = subprocess.run(
@@ -190,6 +211,35 @@ class HashEquivalenceCommonTests(object):
         result = self.client.report_unihash(taskhash2, self.METHOD, outhash, unihash2)
         self.assertEqual(result['unihash'], unihash, 'Server returned bad unihash')
 
+    def test_report_stream(self):
+        # Tests that reports sent in stream mode get the same responses as
+        # they would have individually
+        outhash = '5a9cb1649625f0bf41fc7791b635cd9c2d7118c7f021ba87dcd03f72b67ce7a8'
+        reports = [
+            {
+                "taskhash": '53b8dce672cb6d0c73170be43f540460bfc347b4',
+                "method": self.METHOD,
+                "outhash": outhash,
+                "unihash": '46edb5140d2613049332d0bf3745d9fafec9c559dac8cc61813739a28007fcdf',
+            },
+            {
+                "taskhash": '3bf6f1e89d26205aec90da04854fbdbf73afe6b4',
+                "method": self.METHOD,
+                "outhash": outhash,
+                "unihash": 'bf6e81926066f770e960f9f777cd088c62bea9addb7745f3e77deaa81a645747',
+                "PN": "test",
+            },
+        ]
+
+        result = self.client.report_unihash_batch(reports)
+        self.assertEqual(result, [
+            {"taskhash": r["taskhash"], "method": self.METHOD, "unihash": reports[0]["unihash"]}
+            for r in reports
+        ])
+
+        # The stream mode must be ended correctly before the next request
+        self.assertClientGetHash(self.client, reports[1]["taskhash"], reports[0]["unihash"])
+
     def test_duplicate_taskhash(self):
         # Tests that duplicate reports of the same taskhash with different
         # outhash & unihash always return the unihash from the first reported
@@ -213,6 +263,24 @@ class HashEquivalenceCommonTests(object):
 
         self.assertClientGetHash(self.client, taskhash, unihash)
 
+    def test_unihash_cache(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        stats = self.client.get_stats()["cache"]
+
+        # Both the single and streamed lookups should be served from the cache
+        self.assertClientGetHash(self.client, taskhash, unihash)
+        result = self.client.get_taskhash(self.METHOD, taskhash)
+        self.assertEqual(result["unihash"], unihash)
+
+        new_stats = self.client.get_stats()["cache"]
+        self.assertGreaterEqual(new_stats["hits"], stats["hits"] + 2)
+
+        # Removing the hash must invalidate the cached entry
+        result = self.client.remove({"taskhash": taskhash})
+        self.assertGreater(result["count"], 0)
+        self.assertClientGetHash(self.client, taskhash, None)
+
     def test_remove_taskhash(self):
         taskhash, outhash, unihash = self.create_test_hash(self.client)
         result = self.client.remove({"taskhash": taskhash})
@@ -264,6 +332,44 @@ class HashEquivalenceCommonTests(object):
         result_outhash = self.client.get_outhash(self.METHOD, outhash, taskhash, False)
         self.assertIsNone(result_outhash)
 
+    def test_invoke_pipelined(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        msgs = [
+            {"get": {"taskhash": taskhash, "method": self.METHOD, "all": False}},
+            {"get-outhash": {"outhash": outhash, "taskhash": taskhash, "method": self.METHOD, "with_unihash": True}},
+            {"ping": {}},
+        ] * 10
+
+        result = self.client.invoke_pipelined(msgs)
+        self.assertEqual(len(result), len(msgs))
+        for r in result[0::3]:
+            self.assertEqual(r["unihash"], unihash)
+        for r in result[1::3]:
+            self.assertEqual(r["outhash"], outhash)
+        for r in result[2::3]:
+            self.assertEqual(r, {"alive": True})
+
+        # An error for any of the messages is raised, and the client recovers
+        # afterwards
+        with self.assertRaises(InvokeError):
+            self.client.invoke_pipelined([
+                {"ping": {}},
+                {"report": {"taskhash": taskhash, "method": self.METHOD, "outhash": outhash, "unihash": "bad"}},
+                {"ping": {}},
+            ])
+        self.assertClientGetHash(self.client, taskhash, unihash)
+
+    def test_request_id_wrap(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        # Request IDs are 32 bit and wrap around to 1
+        self.client.client.next_request_id = 0xFFFFFFFF - 2
+        result = self.client.invoke_pipelined([{"ping": {}}] * 6)
+        self.assertEqual(result, [{"alive": True}] * 6)
+        self.assertEqual(self.client.client.next_request_id, 4)
+        self.assertClientGetHash(self.client, taskhash, unihash)
+
     def test_huge_message(self):
         # Simple test that hashes can be created
         taskhash = 'c665584ee6817aa99edfc77a44dd853828279370'
@@ -469,6 +575,62 @@ class HashEquivalenceCommonTests(object):
         self.assertEqual(result['taskhash'], taskhash9, 'Server failed to copy unihash from upstream')
         self.assertEqual(result['method'], self.METHOD)
 
+    def test_upstream_batch(self):
+        down_server = self.start_server(upstream=self.server_address)
+        down_client = self.start_client(down_server.address)
+        side_server = self.start_server(dbpath=down_server.dbpath)
+        side_client = self.start_client(side_server.address)
+
+        hashes = self.create_test_hashes(self.client, 10)
+        unknown = '6662e699d6e3d894b24408ff9a4031ef9b038ee8'
+
+        # Misses in the downstream server are looked up in the upstream server
+        # together, including duplicates in the same batch
+        queries = hashes + hashes[:2] + [unknown]
+        self.assertEqual(
+            down_client.get_unihash_batch([(self.METHOD, h) for h in queries]),
+            hashes + hashes[:2] + [None],
+        )
+        self.assertEqual(
+            down_client.unihash_exists_batch(queries),
+            [True] * (len(hashes) + 2) + [False],
+        )
+
+        # The results are written back to the downstream database
+        down_client.backfill_wait()
+        for h in hashes:
+            self.assertClientGetHash(side_client, h, h)
+
+    def test_get_recent(self):
+        hashes = self.create_test_hashes(self.client, 3)
+
+        rows = self.client.get_recent(2)
+        self.assertEqual(
+            [(r["method"], r["taskhash"], r["unihash"]) for r in rows],
+            [(self.METHOD, h, h) for h in reversed(hashes[1:])],
+        )
+
+    def test_upstream_prewarm(self):
+        hashes = self.create_test_hashes(self.client, 3)
+
+        down_server = self.start_server(upstream=self.server_address, upstream_prewarm=2)
+        side_server = self.start_server(dbpath=down_server.dbpath)
+        side_client = self.start_client(side_server.address)
+
+        # The two most recent hashes are pulled into the downstream database
+        # without anything asking for them
+        deadline = time.monotonic() + 30
+        while side_client.get_unihash(self.METHOD, hashes[-1]) is None:
+            self.assertLess(time.monotonic(), deadline, "Timeout waiting for pre-warm")
+            time.sleep(0.1)
+
+        down_client = self.start_client(down_server.address)
+        down_client.backfill_wait()
+
+        self.assertClientGetHash(side_client, hashes[0], None)
+        for h in hashes[1:]:
+            self.assertClientGetHash(side_client, h, h)
+
     def test_unihash_exsits(self):
         taskhash, outhash, unihash = self.create_test_hash(self.client)
         self.assertTrue(self.client.unihash_exists(unihash))
@@ -1055,6 +1217,88 @@ class HashEquivalenceCommonTests(object):
         # First hash is still present
         self.assertClientGetHash(self.client, taskhash, unihash)
 
+    def wait_gc(self, client):
+        deadline = time.monotonic() + 30
+        while True:
+            progress = client.gc_status()["progress"]
+            if progress["state"] != "running":
+                return progress
+            self.assertLess(time.monotonic(), deadline, "Timeout waiting for garbage collection")
+            time.sleep(0.1)
+
+    def test_gc_incremental(self):
+        hashes = self.create_test_hashes(self.client, 10)
+
+        ret = self.client.gc_mark("ABC", {"method": self.METHOD}, batch_size=3)
+        self.assertEqual(ret, {"count": 0, "background": True})
+        progress = self.wait_gc(self.client)
+        self.assertEqual(progress["operation"], "mark")
+        self.assertEqual(progress["state"], "done")
+        self.assertEqual(progress["count"], 10)
+        self.assertEqual(progress["batches"], 4)
+
+        ret = self.client.gc_status()
+        self.assertEqual(ret["mark"], "ABC")
+        self.assertEqual(ret["keep"], 10)
+
+        # Start over, only keeping the first hash
+        self.client.gc_mark("DEF", {"unihash": hashes[0]})
+
+        ret = self.client.gc_sweep("DEF", batch_size=3, delay=0.5)
+        self.assertEqual(ret, {"count": 0, "background": True})
+
+        # Other operations are refused while one is in progress
+        with self.assertRaises(InvokeError):
+            self.client.gc_sweep("DEF")
+        with self.assertRaises(InvokeError):
+            self.client.gc_mark("DEF", {"unihash": hashes[1]})
+
+        progress = self.wait_gc(self.client)
+        self.assertEqual(progress["operation"], "sweep")
+        self.assertEqual(progress["state"], "done")
+        self.assertEqual(progress["count"], 9)
+        self.assertEqual(progress["batches"], 4)
+
+        # The sweep finishes the garbage collection
+        ret = self.client.gc_status()
+        self.assertIsNone(ret["mark"])
+
+        self.assertClientGetHash(self.client, hashes[0], hashes[0])
+        for h in hashes[1:]:
+            self.assertClientGetHash(self.client, h, None)
+
+    def test_gc_concurrent_mark(self):
+        self.create_test_hashes(self.client, 3)
+
+        clients = [self.start_client(self.server_address) for _ in range(2)]
+        for client in clients:
+            client.ping()
+
+        barrier = threading.Barrier(len(clients))
+        results = []
+
+        def mark(client):
+            barrier.wait()
+            try:
+                results.append(client.gc_mark("ABC", {"method": self.METHOD}, batch_size=1, delay=0.5))
+            except InvokeError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=mark, args=(client,)) for client in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Only one of the clients may start the background operation
+        self.assertEqual(len([r for r in results if isinstance(r, InvokeError)]), 1)
+        self.assertIn({"count": 0, "background": True}, results)
+
+        progress = self.wait_gc(self.client)
+        self.assertEqual(progress["state"], "done")
+        self.assertEqual(progress["count"], 3)
+        self.assertEqual(progress["batches"], 4)
+
     def test_gc_stream(self):
         taskhash = '53b8dce672cb6d0c73170be43f540460bfc347b4'
         outhash = '5a9cb1649625f0bf41fc7791b635cd9c2d7118c7f021ba87dcd03f72b67ce7a8'
@@ -1416,6 +1660,23 @@ class TestHashEquivalenceClient(HashEquivalenceTestSetup, unittest.TestCase):
         self.assertIn("Username:", p.stdout)
         self.assertIn("Permissions:", p.stdout)
 
+    def test_report_stream(self):
+        reports = []
+        for i in range(10):
+            taskhash = hashlib.sha256(("taskhash %d" % i).encode("utf-8")).hexdigest()
+            outhash = hashlib.sha256(("outhash %d" % i).encode("utf-8")).hexdigest()
+            unihash = hashlib.sha256(("unihash %d" % i).encode("utf-8")).hexdigest()
+            reports.append({"taskhash": taskhash, "method": self.METHOD, "outhash": outhash, "unihash": unihash})
+
+        p = self.run_hashclient([
+            "--address", self.server_address,
+            "report-stream",
+        ], check=True, input="".join(json.dumps(r) + "\n" for r in reports))
+
+        self.assertIn("Reported 10 hashes", p.stdout)
+        for r in reports:
+            self.assertClientGetHash(self.client, r["taskhash"], r["unihash"])
+
     def test_get_all_users(self):
         admin_client = self.start_auth_server()
 
@@ -1525,11 +1786,192 @@ class TestHashEquivalenceClient(HashEquivalenceTestSetup, unittest.TestCase):
         self.assertClientGetHash(self.client, taskhash, unihash)
 
 
+    def test_gc_incremental(self):
+        hashes = self.create_test_hashes(self.client, 3)
+
+        p = self.run_hashclient([
+            "--address", self.server_address,
+            "gc-mark", "ABC",
+            "--where", "unihash", hashes[0],
+            "--batch-size", "1",
+        ], check=True)
+        self.assertIn("New hashes marked: 1", p.stdout)
+
+        p = self.run_hashclient([
+            "--address", self.server_address,
+            "gc-sweep", "ABC",
+            "--batch-size", "1",
+            "--delay", "0.1",
+        ], check=True)
+        self.assertIn("Removed 2 rows", p.stdout)
+
+        p = self.run_hashclient([
+            "--address", self.server_address,
+            "gc-status",
+        ], check=True)
+        self.assertIn("Incremental gc-sweep of 'ABC': done, 2 rows in 4 batches", p.stdout)
+
+        self.assertClientGetHash(self.client, hashes[0], hashes[0])
+        self.assertClientGetHash(self.client, hashes[1], None)
+
+
 class TestHashEquivalenceUnixServer(HashEquivalenceTestSetup, HashEquivalenceCommonTests, unittest.TestCase):
     def get_server_addr(self, server_idx):
         return "unix://" + os.path.join(self.temp_dir.name, 'sock%d' % server_idx)
 
 
+class TestHashEquivalenceUnixServerTextFraming(TestHashEquivalenceUnixServer):
+    # Run the tests using the original newline delimited framing instead of
+    # the binary framing
+    def setUp(self):
+        def restore(value):
+            bb.asyncrpc.AsyncClient.binary_framing = value
+
+        self.addCleanup(restore, bb.asyncrpc.AsyncClient.binary_framing)
+        bb.asyncrpc.AsyncClient.binary_framing = False
+        super().setUp()
+
+
+class TestClientPool(HashEquivalenceTestSetup, unittest.TestCase):
+    class FakeClient(object):
+        def __init__(self):
+            self.alive = True
+            self.closed = False
+
+        def ping(self):
+            if not self.alive:
+                raise ConnectionError("Dead")
+            return {"alive": True}
+
+        def close(self):
+            self.closed = True
+
+    def get_server_addr(self, server_idx):
+        return "unix://" + os.path.join(self.temp_dir.name, 'sock%d' % server_idx)
+
+    def test_pooled_client(self):
+        # Pooled connections must be closed before the server is stopped
+        self.addCleanup(bb.asyncrpc.client_pool.close)
+
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        with pooled_client(self.server_address) as client:
+            self.assertClientGetHash(client, taskhash, unihash)
+
+        with pooled_client(self.server_address) as client2:
+            self.assertIs(client2, client)
+
+            # Concurrent users each get their own client
+            with pooled_client(self.server_address) as client3:
+                self.assertIsNot(client3, client2)
+                self.assertClientGetHash(client3, taskhash, unihash)
+
+    def test_health_check(self):
+        pool = bb.asyncrpc.ClientPool(max_idle=1, health_check_interval=0)
+        self.addCleanup(pool.close)
+
+        with pool.client("key", self.FakeClient) as client:
+            pass
+
+        # A dead idle connection is replaced by a new one
+        client.alive = False
+        with pool.client("key", self.FakeClient) as client2:
+            self.assertIsNot(client2, client)
+            self.assertTrue(client.closed)
+
+        # Clients in excess of max_idle are closed
+        with pool.client("key", self.FakeClient) as client3:
+            with pool.client("key", self.FakeClient) as client4:
+                pass
+        self.assertFalse(client4.closed)
+        self.assertTrue(client3.closed)
+
+    def test_close_key(self):
+        pool = bb.asyncrpc.ClientPool()
+        self.addCleanup(pool.close)
+
+        with pool.client("key", self.FakeClient) as client:
+            pass
+        with pool.client("other", self.FakeClient) as other:
+            pass
+
+        # Only the clients of the given key are closed
+        pool.close("key")
+        self.assertTrue(client.closed)
+        self.assertFalse(other.closed)
+        with pool.client("other", self.FakeClient) as other2:
+            self.assertIs(other2, other)
+
+    def test_fork(self):
+        pool = bb.asyncrpc.ClientPool()
+        self.addCleanup(pool.close)
+
+        with pool.client("key", self.FakeClient) as client:
+            pass
+
+        def child(queue):
+            with pool.client("key", self.FakeClient) as c:
+                queue.put(c.closed)
+            pool.close()
+
+        # The child must not use (or close) the connection of its parent
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=child, args=(queue,))
+        p.start()
+        self.assertFalse(queue.get())
+        p.join()
+
+        with pool.client("key", self.FakeClient) as client2:
+            self.assertIs(client2, client)
+            self.assertFalse(client.closed)
+
+
+class TestUpstreamBatcher(unittest.TestCase):
+    def test_restart(self):
+        async def lookup(client, keys):
+            return [key.upper() for key in keys]
+
+        async def run():
+            # The upstream client connects lazily and is never used here
+            batcher = UpstreamBatcher("unix:///nonexistent", lookup)
+            batcher.start(asyncio.get_running_loop())
+            self.assertEqual(await batcher.lookup("a"), "A")
+
+            # Lookups still complete after the batching task went away
+            batcher.task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await batcher.task
+            self.assertEqual(await asyncio.wait_for(batcher.lookup("b"), 10), "B")
+            await batcher.stop()
+
+        asyncio.run(run())
+
+
+class TestSqliteEngine(unittest.TestCase):
+    def test_close(self):
+        from .sqlite import DatabaseEngine
+
+        temp_dir = tempfile.TemporaryDirectory(prefix="bb-hashserv")
+        self.addCleanup(temp_dir.cleanup)
+        engine = DatabaseEngine(os.path.join(temp_dir.name, "db.sqlite"), False)
+
+        async def run():
+            await engine.create()
+            async with engine.connect(logging.getLogger()) as db:
+                self.assertEqual(await db.get_recent_unihashes(1), [])
+            write_thread = engine.write_thread
+            connections = engine.connections
+            self.assertEqual(len(connections), 2)
+
+            await engine.close()
+            self.assertFalse(write_thread.is_alive())
+            for conn in connections:
+                with self.assertRaises(sqlite3.ProgrammingError):
+                    conn.execute("SELECT 1")
+
+        asyncio.run(run())
+
+
 class TestHashEquivalenceUnixServerLongPath(HashEquivalenceTestSetup, unittest.TestCase):
     DEEP_DIRECTORY = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa/bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb/ccccccccccccccccccccccccccccccccccccccccccc"
     def get_server_addr(self, server_idx):
@@ -1557,6 +1999,30 @@ class TestHashEquivalenceTCPServer(HashEquivalenceTestSetup, HashEquivalenceComm
         return socket.gethostbyname("localhost") + ":0"
 
 
+class TestHashEquivalenceTCPWorkersServer(HashEquivalenceTestSetup, HashEquivalenceCommonTests, unittest.TestCase):
+    server_workers = 2
+
+    def get_server_addr(self, server_idx):
+        # The first worker is given a port and the others bind the same one
+        return socket.gethostbyname("localhost") + ":0"
+
+    def test_workers_shared_state(self):
+        taskhash, outhash, unihash = self.create_test_hash(self.client)
+
+        # Each connection is served by any one of the workers
+        clients = [self.start_client(self.server_address) for _ in range(8)]
+        for client in clients:
+            self.assertClientGetHash(client, taskhash, unihash)
+
+        stats = self.client.get_stats()
+        self.assertEqual(stats["workers"], self.server_workers)
+
+        # Removing the hash in one worker must invalidate the caches of all
+        self.client.remove({"taskhash": taskhash})
+        for client in clients:
+            self.assertClientGetHash(client, taskhash, None)
+
+
 class TestHashEquivalenceWebsocketServer(HashEquivalenceTestSetup, HashEquivalenceCommonTests, unittest.TestCase):
     def setUp(self):
         try:
@@ -10,7 +10,7 @@ __version__ = "2.19.0"
 import logging
 logger = logging.getLogger("BitBake.PRserv")
 
-from bb.asyncrpc.client import parse_address, ADDR_TYPE_UNIX, ADDR_TYPE_WS
+from bb.asyncrpc.client import parse_address, ADDR_TYPE_UNIX, ADDR_TYPE_WS, client_pool
 
 def create_server(addr, dbpath, upstream=None, read_only=False):
     from . import serv
@@ -80,6 +80,13 @@ def create_client(addr):
         c.close()
         raise e
 
+def pooled_client(addr):
+    """
+    Context manager borrowing a client connected to addr from the process
+    wide connection pool, instead of connecting a new one
+    """
+    return client_pool.client(("prserv", addr), lambda: create_client(addr))
+
 async def create_async_client(addr):
     from . import client
 
@@ -24,12 +24,36 @@ logger = logging.getLogger("BitBake.PRserv")
 # tuple (version, pkgarch, checksum), otherwise return historical value.
 # Value can decrement if returning to a previous build.
 
+class PRIndexEntry(object):
+    """The values known for a (version, pkgarch), by checksum"""
+
+    __slots__ = ("checksums", "max_value")
+
+    def __init__(self):
+        self.checksums = {}
+        self.max_value = None
+
+    def add(self, checksum, value):
+        self.checksums.setdefault(checksum, []).append(value)
+        if self.max_value is None or revision_greater(value, self.max_value):
+            self.max_value = value
+
 class PRTable(object):
     def __init__(self, conn, table, read_only):
         self.conn = conn
         self.read_only = read_only
         self.table = table
 
+        # In-memory index of the table, filled in one (version, pkgarch) at a
+        # time as they are looked up, so that most requests don't need any
+        # queries. A read-only table may be shared with a server writing to
+        # it, so it is always queried instead.
+        self.index = None if read_only else {}
+
+        # Values stored in the index but not written to the database yet (see
+        # sync())
+        self.pending = []
+
         # Creating the table even if the server is read-only.
         # This avoids a race condition if a shared database
         # is accessed by a read-only server first.
@@ -43,11 +67,10 @@ class PRTable(object):
                         PRIMARY KEY (version, pkgarch, checksum, value));" % self.table)
             self.conn.commit()
 
-    def _extremum_value(self, rows, is_max):
+    def _extremum_value(self, values, is_max):
         value = None
 
-        for row in rows:
-            current_value = row[0]
+        for current_value in values:
             if value is None:
                 value = current_value
             else:
@@ -59,60 +82,50 @@ class PRTable(object):
                     value = current_value
         return value
 
-    def _max_value(self, rows):
-        return self._extremum_value(rows, True)
+    def _max_value(self, values):
+        return self._extremum_value(values, True)
 
-    def _min_value(self, rows):
-        return self._extremum_value(rows, False)
+    def _min_value(self, values):
+        return self._extremum_value(values, False)
+
+    def _load_entry(self, version, pkgarch):
+        entry = PRIndexEntry()
+        with closing(self.conn.cursor()) as cursor:
+            data = cursor.execute("SELECT checksum, value FROM %s WHERE version=? AND pkgarch=?;" % self.table,
+                                 (version, pkgarch))
+            for row in data:
+                entry.add(row["checksum"], row["value"])
+        return entry
+
+    def _entry(self, version, pkgarch):
+        if self.index is None:
+            return self._load_entry(version, pkgarch)
+
+        key = (version, pkgarch)
+        entry = self.index.get(key)
+        if entry is None:
+            entry = self.index[key] = self._load_entry(version, pkgarch)
+        return entry
 
     def test_package(self, version, pkgarch):
         """Returns whether the specified package version is found in the database for the specified architecture"""
 
-        # Just returns the value if found or None otherwise
-        with closing(self.conn.cursor()) as cursor:
-            data=cursor.execute("SELECT value FROM %s WHERE version=? AND pkgarch=?;" % self.table,
-                               (version, pkgarch))
-            row=data.fetchone()
-            if row is not None:
-                return True
-            else:
-                return False
+        return bool(self._entry(version, pkgarch).checksums)
 
     def test_checksum_value(self, version, pkgarch, checksum, value):
         """Returns whether the specified value is found in the database for the specified package, architecture and checksum"""
 
-        with closing(self.conn.cursor()) as cursor:
-            data=cursor.execute("SELECT value FROM %s WHERE version=? AND pkgarch=? and checksum=? and value=?;" % self.table,
-                               (version, pkgarch, checksum, value))
-            row=data.fetchone()
-            if row is not None:
-                return True
-            else:
-                return False
+        return value in self._entry(version, pkgarch).checksums.get(checksum, ())
 
     def test_value(self, version, pkgarch, value):
         """Returns whether the specified value is found in the database for the specified package and architecture"""
 
-        # Just returns the value if found or None otherwise
-        with closing(self.conn.cursor()) as cursor:
-            data=cursor.execute("SELECT value FROM %s WHERE version=? AND pkgarch=? and value=?;" % self.table,
-                               (version, pkgarch, value))
-            row=data.fetchone()
-            if row is not None:
-                return True
-            else:
-                return False
-
+        return any(value in values for values in self._entry(version, pkgarch).checksums.values())
 
     def find_package_max_value(self, version, pkgarch):
         """Returns the greatest value for (version, pkgarch), or None if not found. Doesn't create a new value"""
 
-        with closing(self.conn.cursor()) as cursor:
-            data = cursor.execute("SELECT value FROM %s where version=? AND pkgarch=?;" % (self.table),
-                                 (version, pkgarch))
-            rows = data.fetchall()
-            value = self._max_value(rows)
-            return value
+        return self._entry(version, pkgarch).max_value
 
     def find_value(self, version, pkgarch, checksum, history=False):
         """Returns the value for the specified checksum if found or None otherwise."""
@@ -127,11 +140,8 @@ class PRTable(object):
         """Returns the maximum (if is_max is True) or minimum (if is_max is False) value
            for (version, pkgarch, checksum), or None if not found. Doesn't create a new value"""
 
-        with closing(self.conn.cursor()) as cursor:
-            data = cursor.execute("SELECT value FROM %s where version=? AND pkgarch=? AND checksum=?;" % (self.table),
-                                 (version, pkgarch, checksum))
-            rows = data.fetchall()
-            return self._extremum_value(rows, is_max)
+        values = self._entry(version, pkgarch).checksums.get(checksum, ())
+        return self._extremum_value(values, is_max)
 
     def find_max_value(self, version, pkgarch, checksum):
         return self._find_extremum_value(version, pkgarch, checksum, True)
@@ -143,25 +153,40 @@ class PRTable(object):
         """Take and increase the greatest "<base>.y" value for (version, pkgarch), or return "<base>.0" if not found.
         This doesn't store a new value."""
 
-        with closing(self.conn.cursor()) as cursor:
-            data = cursor.execute("SELECT value FROM %s where version=? AND pkgarch=? AND value LIKE '%s.%%';" % (self.table, base),
-                                 (version, pkgarch))
-            rows = data.fetchall()
-            value = self._max_value(rows)
+        prefix = base + "."
+        value = self._max_value(v for values in self._entry(version, pkgarch).checksums.values()
+                                for v in values if v.startswith(prefix))
 
-            if value is not None:
-                return increase_revision(value)
-            else:
-                return base + ".0"
+        if value is not None:
+            return increase_revision(value)
+        else:
+            return base + ".0"
 
     def store_value(self, version, pkgarch, checksum, value):
-        """Store value in the database"""
+        """Store value in the database. It is only written to the database by
+        the next sync(), but is visible to the lookups straight away"""
 
         if not self.read_only and not self.test_checksum_value(version, pkgarch, checksum, value):
+            self._entry(version, pkgarch).add(checksum, value)
+            self.pending.append((version, pkgarch, checksum, value))
+
+    def sync(self):
+        """Writes all the stored values to the database, in a single transaction"""
+
+        if not self.pending:
+            return
+
+        pending = self.pending
+        self.pending = []
+        try:
             with closing(self.conn.cursor()) as cursor:
-                cursor.execute("INSERT INTO %s VALUES (?, ?, ?, ?);"  % (self.table),
-                           (version, pkgarch, checksum, value))
-                self.conn.commit()
+                cursor.executemany("INSERT INTO %s VALUES (?, ?, ?, ?);" % (self.table), pending)
+            self.conn.commit()
+        except:
+            # The index no longer matches the database
+            self.conn.rollback()
+            self.index.clear()
+            raise
 
     def _get_value(self, version, pkgarch, checksum, history):
 
@@ -197,6 +222,7 @@ class PRTable(object):
         return value
 
     def export(self, version, pkgarch, checksum, colinfo, history=False):
+        self.sync()
         metainfo = {}
         with closing(self.conn.cursor()) as cursor:
             #column info
@@ -252,6 +278,7 @@ class PRTable(object):
         return (metainfo, datainfo)
 
     def dump_db(self, fd):
+        self.sync()
         writeCount = 0
         for line in self.conn.iterdump():
             writeCount = writeCount + len(line) + 1
@@ -279,7 +306,12 @@ class PRData(object):
         self.connection.commit()
         self._tables={}
 
+    def sync(self):
+        for table in self._tables.values():
+            table.sync()
+
     def disconnect(self):
+        self.sync()
         self.connection.commit()
         self.connection.close()
 
@@ -5,6 +5,7 @@
 #
 
 import os,sys,logging
+import asyncio
 import signal, time
 import socket
 import io
@@ -71,6 +72,11 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
         return {"value": value}
 
     async def handle_get_pr(self, request):
+        response = await self.get_pr(request)
+        await self.server.commit()
+        return response
+
+    async def get_pr(self, request):
         version = request["version"]
         pkgarch = request["pkgarch"]
         checksum = request["checksum"]
@@ -181,6 +187,7 @@ class PRServerClient(bb.asyncrpc.AsyncServerConnection):
             value = request["value"]
 
             value = self.server.table.importone(version, pkgarch, checksum, value)
+            await self.server.commit()
             if value is not None:
                 response = {"value": value}
 
@@ -211,10 +218,37 @@ class PRServer(bb.asyncrpc.AsyncServer):
         self.table = None
         self.read_only = read_only
         self.upstream = upstream
+        self.commit_future = None
 
     def accept_client(self, socket):
         return PRServerClient(socket, self)
 
+    async def commit(self):
+        """
+        Waits until the values stored so far have been written to the
+        database. The values stored while handling all the requests that are
+        ready in one iteration of the event loop are written together, in a
+        single transaction
+        """
+        if not self.table.pending:
+            return
+
+        if self.commit_future is None:
+            self.commit_future = self.loop.create_future()
+            self.loop.call_soon(self._commit)
+
+        await asyncio.shield(self.commit_future)
+
+    def _commit(self):
+        future = self.commit_future
+        self.commit_future = None
+        try:
+            self.table.sync()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
     def start(self):
         tasks = super().start()
         self.db = prserv.db.PRData(self.dbfile, read_only=self.read_only)
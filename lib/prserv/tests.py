@@ -143,6 +143,37 @@ class FunctionTests(unittest.TestCase):
         self.assertEqual(self.table.find_min_value(version, pkgarch, checksum1), "1")
         self.assertEqual(self.table.find_max_value(version, pkgarch, checksum1), "1.20")
 
+    def test_db_sync(self):
+        dbfile = os.path.join(self.temp_dir.name, "testtable.sqlite3")
+
+        self.db = db.PRData(dbfile)
+        self.table = self.db["PRMAIN"]
+
+        ro_db = db.PRData(dbfile, read_only=True)
+        self.addCleanup(ro_db.disconnect)
+        ro_table = ro_db["PRMAIN"]
+
+        self.table.store_value(version, pkgarch, checksum0, "0")
+        self.table.store_value(version, pkgarch, checksum1, "1")
+
+        # Stored values are only written to the database by sync()
+        self.assertEqual(self.table.find_package_max_value(version, pkgarch), "1")
+        self.assertFalse(ro_table.test_package(version, pkgarch))
+
+        self.table.sync()
+        self.assertEqual(ro_table.find_package_max_value(version, pkgarch), "1")
+        self.assertEqual(ro_table.find_value(version, pkgarch, checksum0), "0")
+
+        # Values already in the database are loaded in the index
+        self.db.disconnect()
+        self.db = db.PRData(dbfile)
+        self.table = self.db["PRMAIN"]
+        self.assertEqual(self.table.find_package_max_value(version, pkgarch), "1")
+        self.assertEqual(self.table.get_value(version, pkgarch, checksum2, False), "2")
+        self.db.disconnect()
+
+        self.assertEqual(ro_table.find_value(version, pkgarch, checksum2), "2")
+
 class PRBasicTests(PRTestSetup, unittest.TestCase):
 
     def setUp(self):
@@ -154,6 +185,17 @@ class PRBasicTests(PRTestSetup, unittest.TestCase):
         self.server1 = self.start_server("basic", dbfile)
         self.client1 = self.start_client(self.server1.address)
 
+    def test_invoke_pipelined(self):
+        checksums = [checksum0, checksum1, checksum2, checksum3, checksum4]
+        result = self.client1.invoke_pipelined(
+            {"get-pr": {"version": version, "pkgarch": pkgarch, "checksum": c, "history": False}}
+            for c in checksums
+        )
+        self.assertEqual([r["value"] for r in result], ["0", "1", "2", "3", "4"])
+
+        for c, value in zip(checksums, ["0", "1", "2", "3", "4"]):
+            self.assertEqual(self.client1.test_pr(version, pkgarch, c), value)
+
     def test_basic(self):
 
         # Checks on non existing configuration